@@ -0,0 +1,339 @@
+'''A local stand-in for the CKAN action API, for benchmarks.
+
+It implements the actions used by the processors, keeping datasets,
+resources and DataStore row counts in memory. Uploaded files are read and
+counted, but not kept. Each request can be slowed down by a fixed latency
+and a bandwidth limit, and a share of requests can be throttled.'''
+
+import io
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+
+import logging
+log = logging.getLogger(__name__)
+
+
+ACTION_PATH = '/api/3/action/'
+
+
+class CkanError(Exception):
+
+    def __init__(self, status, error):
+        super(CkanError, self).__init__(error)
+        self.status = status
+        self.error = error
+
+
+def not_found(what):
+    return CkanError(404, {'__type': 'Not Found Error',
+                           'message': 'Not found: {}'.format(what)})
+
+
+class FakeCkan(object):
+    '''A fake CKAN server on a local port. `latency` seconds are added to
+    each request, bodies are sent and received at no more than `bandwidth`
+    bytes per second if given, and `error_rate` of the requests are refused
+    with a 503 response, which clients may retry.'''
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.requests = {}
+        self.bytes_received = 0
+        self.datasets = {}
+        self.resources = {}
+        self.datastore = {}
+        self.aliases = {}
+        self.__random = random.Random(seed)
+        self.__lock = threading.RLock()
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        '''Start serving in a background thread, and return the url.'''
+        self.__server = _Server(('127.0.0.1', 0), _Handler)
+        self.__server.ckan = self
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         daemon=True)
+        self.__thread.start()
+        return self.url
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, action, params, size):
+        '''Return the status and response dict of a call to `action`.'''
+        with self.__lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            self.bytes_received += size
+            throttled = self.__random.random() < self.error_rate
+        self.wait(size)
+        if throttled:
+            return 503, None
+        handler = getattr(self, 'action_' + action, None)
+        if handler is None:
+            return 400, {'success': False, 'error': {
+                '__type': 'Bad Request',
+                'message': 'Unknown action: {}'.format(action)}}
+        try:
+            with self.__lock:
+                result = handler(params)
+        except CkanError as e:
+            return e.status, {'success': False, 'error': e.error}
+        return 200, {'success': True, 'result': result}
+
+    def wait(self, size):
+        '''Sleep for the latency and for `size` bytes at the bandwidth.'''
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / float(self.bandwidth)
+        if delay:
+            time.sleep(delay)
+
+    # Datasets
+
+    def _dataset(self, name_or_id):
+        for dataset in self.datasets.values():
+            if name_or_id in (dataset['id'], dataset['name']):
+                return dataset
+        raise not_found('dataset {}'.format(name_or_id))
+
+    def _show(self, dataset):
+        dataset = dict(dataset)
+        dataset['resources'] = [dict(self.resources[resource_id])
+                                for resource_id in dataset['resources']]
+        return dataset
+
+    def _set_resources(self, dataset, resources):
+        dataset['resources'] = []
+        for resource in resources:
+            resource = dict(resource, package_id=dataset['id'])
+            resource.setdefault('id', str(uuid.uuid4()))
+            self.resources[resource['id']] = resource
+            dataset['resources'].append(resource['id'])
+
+    def action_package_create(self, params):
+        if any(d['name'] == params.get('name')
+               for d in self.datasets.values()):
+            raise CkanError(409, {'__type': 'Validation Error',
+                                  'name': ['That URL is already in use.']})
+        dataset = dict(params, id=str(uuid.uuid4()))
+        self._set_resources(dataset, params.get('resources', []))
+        self.datasets[dataset['id']] = dataset
+        return self._show(dataset)
+
+    def action_package_update(self, params):
+        current = self._dataset(params.get('id') or params.get('name'))
+        dataset = dict(params, id=current['id'])
+        self._set_resources(dataset, params.get('resources', []))
+        self.datasets[dataset['id']] = dataset
+        return self._show(dataset)
+
+    def action_package_patch(self, params):
+        dataset = self._dataset(params['id'])
+        resources = params.pop('resources', None)
+        dataset.update(params)
+        if resources is not None:
+            self._set_resources(dataset, resources)
+        return self._show(dataset)
+
+    def action_package_show(self, params):
+        return self._show(self._dataset(params['id']))
+
+    # Resources
+
+    def _resource(self, resource_id):
+        if resource_id not in self.resources:
+            raise not_found('resource {}'.format(resource_id))
+        return self.resources[resource_id]
+
+    def action_resource_create(self, params):
+        dataset = self._dataset(params['package_id'])
+        resource = dict(params, id=str(uuid.uuid4()))
+        self.resources[resource['id']] = resource
+        dataset['resources'].append(resource['id'])
+        return dict(resource)
+
+    def action_resource_patch(self, params):
+        resource = self._resource(params['id'])
+        resource.update(params)
+        return dict(resource)
+
+    action_resource_update = action_resource_patch
+
+    def action_resource_show(self, params):
+        return dict(self._resource(params['id']))
+
+    def action_resource_delete(self, params):
+        resource = self.resources.pop(params['id'], None)
+        if resource is None:
+            raise not_found('resource {}'.format(params['id']))
+        dataset = self.datasets.get(resource['package_id'])
+        if dataset is not None and params['id'] in dataset['resources']:
+            dataset['resources'].remove(params['id'])
+        self._drop_table(params['id'])
+        return None
+
+    # DataStore
+
+    def action_datastore_create(self, params):
+        if 'resource' in params:
+            if 'url' in params['resource']:
+                # CKAN would submit the url to the DataPusher instead of
+                # creating the table, and there is no DataPusher here
+                raise CkanError(409, {
+                    '__type': 'Validation Error',
+                    'resource': ['The datapusher has to be enabled.']})
+            resource = self.action_resource_create(
+                dict(params['resource'], url='_datastore_only_resource',
+                     url_type='datastore'))
+            resource_id = resource['id']
+        else:
+            resource_id = self._resource(params['resource_id'])['id']
+        # Creating an existing table again only changes its definition
+        self.datastore.setdefault(resource_id, 0)
+        self._resource(resource_id)['datastore_active'] = True
+        if 'aliases' in params:
+            self._set_aliases(resource_id, params['aliases'])
+        return {'resource_id': resource_id,
+                'fields': params.get('fields', [])}
+
+    def action_datastore_upsert(self, params):
+        if params['resource_id'] not in self.datastore:
+            raise not_found('table {}'.format(params['resource_id']))
+        self.datastore[params['resource_id']] += len(params['records'])
+        return {'resource_id': params['resource_id']}
+
+    def action_datastore_delete(self, params):
+        if params['resource_id'] not in self.datastore:
+            raise not_found('table {}'.format(params['resource_id']))
+        if params.get('filters'):
+            # Only some rows are deleted
+            return {'resource_id': params['resource_id']}
+        self._drop_table(params['resource_id'])
+        return {'resource_id': params['resource_id']}
+
+    def action_datastore_search(self, params):
+        if params['resource_id'] != '_table_metadata':
+            raise not_found('table {}'.format(params['resource_id']))
+        name = params.get('filters', {}).get('name')
+        records = [{'name': alias, 'alias_of': table}
+                   for alias, table in sorted(self.aliases.items())
+                   if name in (None, alias)]
+        return {'records': records, 'total': len(records)}
+
+    def _set_aliases(self, resource_id, aliases):
+        for alias in aliases:
+            if self.aliases.get(alias, resource_id) != resource_id:
+                raise CkanError(409, {
+                    '__type': 'Validation Error',
+                    'alias': ['"{}" already exists'.format(alias)]})
+        for alias, table in list(self.aliases.items()):
+            if table == resource_id:
+                del self.aliases[alias]
+        for alias in aliases:
+            self.aliases[alias] = resource_id
+
+    def _drop_table(self, resource_id):
+        self.datastore.pop(resource_id, None)
+        self._set_aliases(resource_id, [])
+
+    def action_status_show(self, params):
+        return {'ckan_version': '2.9.0', 'extensions': ['datastore']}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        body = self._read_body()
+        params = dict(parse_qsl(parts.query))
+        params.update(self._parse_body(body))
+        action = parts.path[len(ACTION_PATH):] \
+            if parts.path.startswith(ACTION_PATH) else ''
+
+        status, response = self.server.ckan.handle(action, params, len(body))
+        content = b'' if response is None else \
+            json.dumps(response).encode('utf-8')
+        self.server.ckan.wait(len(content) if self.server.ckan.bandwidth
+                              else 0)
+        self.send_response(status)
+        if status == 503:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _parse_body(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json') or \
+           (body[:1] in (b'{', b'[') and 'multipart' not in content_type):
+            return json.loads(body.decode('utf-8'))
+        if not content_type.startswith('multipart/form-data'):
+            return dict(parse_qsl(body.decode('utf-8')))
+        message = BytesParser(policy=HTTP).parse(io.BytesIO(
+            'Content-Type: {}\r\n\r\n'.format(content_type).encode('ascii')
+            + body))
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            content = part.get_payload(decode=True)
+            if part.get_filename() is not None:
+                params['size'] = len(content)
+                params['upload_hash'] = hashlib.md5(content).hexdigest()
+            else:
+                params[name] = content.decode('utf-8')
+        return params
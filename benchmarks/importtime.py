@@ -0,0 +1,117 @@
+'''Benchmark the start-up time of the processors.
+
+For each processor, times its module-level imports in a fresh interpreter,
+and a whole run against a local fake CKAN server, taking the median of
+several runs. On Python 3.7 and later, the imports are also run with
+`python -X importtime`, and the slowest imported modules are listed.
+
+    python -m benchmarks.importtime --repeat 10'''
+
+import ast
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from benchmarks.fake_ckan import FakeCkan
+from benchmarks.run import (
+    DUMP_PROCESSOR, ADD_RESOURCE_PROCESSOR, run_processor
+)
+
+
+TIMING_SCRIPT = '''
+import sys, time, json
+started = time.perf_counter()
+{imports}
+print(json.dumps({{'seconds': time.perf_counter() - started,
+                  'modules': len(sys.modules)}}))
+'''
+
+
+def module_imports(path):
+    '''Return the module-level import statements of the processor at
+    `path`, as source code.'''
+    with open(path) as processor_file:
+        tree = ast.parse(processor_file.read())
+    statements = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            statements.extend('import {}'.format(alias.name)
+                              for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            statements.append('from {} import {}'.format(
+                node.module, ', '.join(alias.name for alias in node.names)))
+    return '\n'.join(statements)
+
+
+def time_imports(imports, importtime=False):
+    '''Run `imports` in a fresh interpreter, and return the seconds they
+    took, the number of modules loaded and, with `importtime`, the
+    cumulative microseconds of each module imported.'''
+    command = [sys.executable, '-W', 'ignore']
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', TIMING_SCRIPT.format(imports=imports)]
+    process = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True)
+    result = json.loads(process.stdout.decode('utf-8').strip())
+    modules = {}
+    for line in process.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return result['seconds'], result['modules'], modules
+
+
+def time_runs(ckan, repeat):
+    '''Return the median seconds of whole runs of each processor against
+    the fake server `ckan`.'''
+    ckan.handle('package_create', {'name': 'importtime'}, 0)
+    resource = ckan.handle('resource_create', {
+        'package_id': 'importtime',
+        'name': 'resource',
+        'url': 'https://example.com/resource.csv'
+    }, 0)[1]['result']
+    runs = {
+        DUMP_PROCESSOR: ({'ckan-host': ckan.url,
+                          'overwrite_existing': True},
+                         {'name': 'importtime', 'resources': []}),
+        ADD_RESOURCE_PROCESSOR: ({'ckan-host': ckan.url,
+                                  'resource-id': resource['id']},
+                                 {'name': 'importtime', 'resources': []})
+    }
+    return dict(
+        (path, statistics.median(
+            run_processor(path, parameters, datapackage)[1]
+            for _ in range(repeat)))
+        for path, (parameters, datapackage) in runs.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15,
+                        help='the number of slowest modules to list')
+    args = parser.parse_args(argv)
+    importtime = sys.version_info >= (3, 7)
+
+    with FakeCkan() as ckan:
+        run_seconds = time_runs(ckan, args.repeat)
+
+    for path in [DUMP_PROCESSOR, ADD_RESOURCE_PROCESSOR]:
+        imports = module_imports(path)
+        timings = [time_imports(imports) for _ in range(args.repeat)]
+        print('{}: imports {:.1f}ms ({} modules), whole run {:.1f}ms'.format(
+            path, statistics.median(t[0] for t in timings) * 1000,
+            timings[0][1], run_seconds[path] * 1000))
+        if importtime:
+            modules = time_imports(imports, importtime=True)[2]
+            for name, cumulative in sorted(modules.items(),
+                                           key=lambda m: -m[1])[:args.top]:
+                print('  {:>8.1f}ms  {}'.format(cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
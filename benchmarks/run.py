@@ -0,0 +1,198 @@
+'''Benchmark the processors against a local fake CKAN server.
+
+Runs `ckan.dump.to_ckan`, then `ckan.add_ckan_resource` on the resources it
+created, for each combination of resource count, row count and row width,
+each in its own process as datapackage-pipelines runs them. Reports rows
+and megabytes per second, peak RSS and the number of CKAN requests.
+
+    python -m benchmarks.run --resources 1 10 --rows 1000 100000 --width 5
+
+Processor parameters can be added with --param, e.g.
+`--param push_resources_to_datastore=true`, to compare their cost.'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import subprocess
+
+import datapackage_pipelines_ckan.processors
+
+from benchmarks.fake_ckan import FakeCkan
+
+
+PROCESSORS_DIR = \
+    os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+DUMP_PROCESSOR = os.path.join(PROCESSORS_DIR, 'dump', 'to_ckan.py')
+ADD_RESOURCE_PROCESSOR = os.path.join(PROCESSORS_DIR, 'add_ckan_resource.py')
+
+
+def make_datapackage(resources, width):
+    '''Return a datapackage of `resources` streamed resources, each with
+    `width` columns.'''
+    fields = [{'name': 'id', 'type': 'integer'}] + \
+        [{'name': 'column_{}'.format(i), 'type': 'string'}
+         for i in range(width - 1)]
+    return {
+        'name': 'benchmark',
+        'title': 'Benchmark',
+        'resources': [{
+            'name': 'resource_{}'.format(i),
+            'path': 'data/resource_{}.csv'.format(i),
+            'dpp:streaming': True,
+            'schema': {'fields': fields}
+        } for i in range(resources)]
+    }
+
+
+def make_rows(rows, width):
+    '''Yield `rows` JSON rows of `width` columns, as the processors read
+    them.'''
+    values = dict(('column_{}'.format(i), 'value {}'.format(i))
+                  for i in range(width - 1))
+    for row in range(rows):
+        values['id'] = row
+        yield json.dumps(values)
+
+
+def run_processor(path, parameters, datapackage, resource_rows=()):
+    '''Run the processor at `path` as datapackage-pipelines would, feeding
+    it `datapackage` and the JSON rows of each of `resource_rows`. Return
+    its stats, the seconds it took and its peak RSS in bytes.'''
+    process = subprocess.Popen(
+        [sys.executable, path, '0', json.dumps(parameters), 'False', ''],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            process.stdin.write(b'{}\n')
+            process.stdin.write(json.dumps(datapackage).encode('utf-8'))
+            process.stdin.write(b'\n\n')
+            for rows in resource_rows:
+                for row in rows:
+                    process.stdin.write(row.encode('utf-8') + b'\n')
+                process.stdin.write(b'\n')
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    started = time.time()
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    last_line = None
+    for line in process.stdout:
+        if line.strip():
+            last_line = line
+    feeder.join()
+    # Wait for this process only, to read its own peak memory
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - started
+    process.returncode = status
+    if status != 0:
+        raise RuntimeError('{} failed with status {}'.format(
+            os.path.basename(path), status))
+    stats = json.loads(last_line.decode('utf-8')) if last_line else {}
+    # ru_maxrss is in kilobytes on Linux
+    return stats, seconds, usage.ru_maxrss * 1024
+
+
+def run_case(resources, rows, width, parameters, server_options):
+    '''Benchmark a dump and a read back of `resources` resources of `rows`
+    rows and `width` columns, and return the results.'''
+    results = {'resources': resources, 'rows': rows, 'width': width}
+    datapackage = make_datapackage(resources, width)
+    with FakeCkan(**server_options) as ckan:
+        dump_parameters = dict({
+            'ckan-host': ckan.url,
+            'ckan-api-key': 'benchmark',
+            'overwrite_existing': True
+        }, **parameters)
+        stats, seconds, peak_rss = run_processor(
+            DUMP_PROCESSOR, dump_parameters, datapackage,
+            [make_rows(rows, width) for _ in range(resources)])
+        results['dump'] = {
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(resources * rows / seconds, 1),
+            'mb_per_second': round((stats.get('bytes') or 0) /
+                                   seconds / 1e6, 3),
+            'peak_rss_mb': round(peak_rss / 1e6, 1),
+            'requests': dict(ckan.requests),
+            'stats': stats
+        }
+
+        ckan.requests.clear()
+        resource_ids = sorted(ckan.resources)
+        _, seconds, peak_rss = run_processor(
+            ADD_RESOURCE_PROCESSOR,
+            {'ckan-host': ckan.url, 'resource-id': resource_ids},
+            {'name': 'benchmark', 'resources': []})
+        results['add_ckan_resource'] = {
+            'seconds': round(seconds, 3),
+            'resources_per_second': round(len(resource_ids) / seconds, 1),
+            'peak_rss_mb': round(peak_rss / 1e6, 1),
+            'requests': dict(ckan.requests)
+        }
+    return results
+
+
+def parse_parameter(value):
+    '''Parse a `name=value` processor parameter, with a JSON value.'''
+    name, _, value = value.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--resources', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[1000, 100000])
+    parser.add_argument('--width', type=int, nargs='+', default=[5, 50])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to each request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bytes per second of each request body')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests throttled with a 503')
+    parser.add_argument('--param', action='append', default=[],
+                        type=parse_parameter,
+                        help='a to_ckan parameter, as name=json-value')
+    parser.add_argument('--output',
+                        help='a file to write the results to as JSON')
+    args = parser.parse_args(argv)
+
+    server_options = {'latency': args.latency, 'bandwidth': args.bandwidth,
+                      'error_rate': args.error_rate}
+    row_format = '{:>9} {:>8} {:>5} | {:>8} {:>10} {:>7} {:>7} {:>5} | ' \
+        '{:>8} {:>7} {:>5}'
+    print(row_format.format('resources', 'rows', 'width', 'dump s',
+                            'rows/s', 'MB/s', 'RSS MB', 'reqs', 'read s',
+                            'RSS MB', 'reqs'))
+    results = []
+    for resources, rows, width in itertools.product(
+            args.resources, args.rows, args.width):
+        result = run_case(resources, rows, width, dict(args.param),
+                          server_options)
+        results.append(result)
+        dump, read = result['dump'], result['add_ckan_resource']
+        print(row_format.format(
+            resources, rows, width, dump['seconds'],
+            dump['rows_per_second'], dump['mb_per_second'],
+            dump['peak_rss_mb'], sum(dump['requests'].values()),
+            read['seconds'], read['peak_rss_mb'],
+            sum(read['requests'].values())))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_MAX_IN_FLIGHT = 10
+
+
+class AsyncCkanClient(object):
+    '''Run blocking CKAN API calls concurrently on a bounded thread pool,
+    with at most `max_in_flight` of them in flight at once.
+
+    This is not a non-blocking HTTP client: each call is a blocking
+    function, such as `make_ckan_request` with its pooled sessions, run by
+    one of `max_in_flight` executor threads, which is what limits the calls
+    in flight. An asyncio event loop in a background thread only schedules
+    the calls, so that synchronous code (such as the row generators passed
+    to `spew`) can `submit()` independent calls and collect their results
+    later.'''
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.loop = asyncio.new_event_loop()
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.__thread = threading.Thread(target=self.loop.run_forever,
+                                         daemon=True)
+        self.__thread.start()
+
+    async def call(self, function, *args, **kwargs):
+        '''Call the blocking `function` once an executor thread is free, and
+        return its result.'''
+        return await self.loop.run_in_executor(
+            self.__executor, functools.partial(function, *args, **kwargs))
+
+    def submit(self, function, *args, **kwargs):
+        '''Schedule a call of `function` from any thread, and return a
+        concurrent.futures.Future of its result.'''
+        return asyncio.run_coroutine_threadsafe(
+            self.call(function, *args, **kwargs), self.loop)
+
+    def map(self, function, iterable):
+        '''Call `function` with each item of `iterable` concurrently, and
+        return the results in order.'''
+        futures = [self.submit(function, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def close(self):
+        '''Stop the event loop. Calls that have not started are dropped, so
+        wait for the results of any calls needed first.'''
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.__thread.join()
+        self.__executor.shutdown(wait=True)
+        self.loop.close()
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import tempfile
+from email.utils import format_datetime
+
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+
+# CKAN timestamps, which are in UTC
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+
+def get_modified(result):
+    '''Return when a CKAN dataset or resource dict was last modified, as an
+    aware datetime, or None.'''
+    for key in ('metadata_modified', 'last_modified'):
+        value = result.get(key)
+        if not value:
+            continue
+        for timestamp_format in TIMESTAMP_FORMATS:
+            try:
+                modified = datetime.datetime.strptime(value, timestamp_format)
+            except ValueError:
+                continue
+            return modified.replace(tzinfo=datetime.timezone.utc)
+    return None
+
+
+class MetadataCache(object):
+    '''An on-disk cache of CKAN action results, keyed by host, action and
+    id, and by a hash of the `api_key` they are fetched with, so that private
+    results are not shared with other keys. Entries younger than `ttl`
+    seconds are used as they are; older ones are revalidated with a
+    conditional request. When the cache grows beyond `max_size` bytes, the
+    least recently stored entries are removed.'''
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE,
+                 api_key=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.__api_key_hash = ''
+        if api_key:
+            self.__api_key_hash = \
+                hashlib.sha256(api_key.encode('utf8')).hexdigest()
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, host, action, name_or_id):
+        key = '\n'.join([host.rstrip('/'), action, name_or_id,
+                         self.__api_key_hash]).encode('utf8')
+        return os.path.join(self.path,
+                            hashlib.sha1(key).hexdigest() + '.json')
+
+    def get(self, host, action, name_or_id):
+        '''Return the cached entry, or None. An entry is a dict with the
+        `result`, its `etag` (or None) and a `fresh` flag.'''
+        entry_path = self._entry_path(host, action, name_or_id)
+        try:
+            with open(entry_path, encoding='utf8') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        entry['fresh'] = time.time() - entry['stored'] < self.ttl
+        return entry
+
+    def set(self, host, action, name_or_id, result, etag=None):
+        '''Store `result` and its `etag`, then evict entries if the cache is
+        too big.'''
+        entry = {'stored': time.time(), 'etag': etag, 'result': result}
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf8') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_path, self._entry_path(host, action, name_or_id))
+        self.evict()
+
+    def touch(self, host, action, name_or_id):
+        '''Mark a revalidated entry as fresh again.'''
+        entry = self.get(host, action, name_or_id)
+        if entry is not None:
+            self.set(host, action, name_or_id, entry['result'],
+                     entry['etag'])
+
+    def conditional_headers(self, entry):
+        '''Return the headers to revalidate `entry` with.'''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        modified = get_modified(entry['result'])
+        if modified is not None:
+            headers['If-Modified-Since'] = \
+                format_datetime(modified, usegmt=True)
+        return headers
+
+    def evict(self):
+        '''Remove the least recently stored entries until the cache fits in
+        `max_size` bytes.'''
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total_size -= size
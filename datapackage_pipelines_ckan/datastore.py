@@ -0,0 +1,375 @@
+import json
+import time
+import queue
+import itertools
+import sqlite3
+import hashlib
+import concurrent.futures
+import datetime
+import decimal
+import threading
+
+import isodate
+
+from datapackage_pipelines_ckan.utils import make_ckan_request, get_ckan_error
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _json_default(value):
+    '''Serialize the typed values a pipeline row may hold.'''
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        # Keep the exact value, which CKAN casts to the column's type
+        return str(value)
+    if isinstance(value, (datetime.timedelta, isodate.Duration)):
+        return isodate.duration_isoformat(value)
+    if isinstance(value, set):
+        return list(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _primary_key(schema):
+    '''Return the list of primary key fields of `schema`, or None.'''
+    primary_key = schema.get('primaryKey')
+    if isinstance(primary_key, str):
+        primary_key = [primary_key]
+    return primary_key or None
+
+
+class DatastoreWriter(object):
+    '''Write already-typed pipeline rows to a CKAN DataStore table, sending
+    them to datastore_upsert in batches of `batch_size` records.
+
+    With more than one worker, batches are sent concurrently by `workers`
+    threads. For 'upsert' and 'update' on a table with a primary key, each
+    row goes to the worker chosen by its key, so that writes to the same key
+    are still sent in order. If an AsyncCkanClient `client` is given, the
+    batches are sent through it instead of worker threads, with one batch
+    per worker in flight.
+
+    With `defer_indexes`, the table is created without its primary key and
+    indexes, which are only added by a last datastore_create once all the
+    rows are written, so that they are built once rather than updated for
+    every row. This is only possible with the 'insert' method.'''
+
+    def __init__(self, base_endpoint, schema, method='insert',
+                 batch_size=DEFAULT_BATCH_SIZE, workers=1, api_key=None,
+                 client=None, defer_indexes=False):
+        if defer_indexes and method != 'insert':
+            raise RuntimeError(
+                'Indexes can only be deferred with the \'insert\' method.')
+        self.base_endpoint = base_endpoint
+        self.schema = schema
+        self.method = method
+        self.batch_size = batch_size
+        self.workers = max(workers, 1)
+        self.api_key = api_key
+        self.client = client
+        self.defer_indexes = defer_indexes
+        self.resource_id = None
+        self.rows_written = 0
+        self.rows_deleted = 0
+        self.seconds = 0.0
+        self.__field_names = [f['name'] for f in schema['fields']]
+        self.__primary_key = None
+        if method in ('upsert', 'update'):
+            self.__primary_key = _primary_key(schema)
+        self.__batches = [[] for _ in range(self.workers)]
+        self.__cursor = 0
+        self.__queues = []
+        self.__threads = []
+        self.__pending = [None] * self.workers
+        self.__errors = []
+        self.__lock = threading.Lock()
+        self.__started = None
+        self.__deferred_indexes = {}
+
+    def create(self, resource_id=None, resource=None):
+        '''Create the DataStore table for `resource_id`, or for a new CKAN
+        resource created from the `resource` dict, which must not have a url
+        for CKAN to create the table. Return the resource id.'''
+        # Only imported when writing to the DataStore, to start up faster
+        from tableschema_ckan_datastore.mapper import Mapper
+
+        datastore_dict = \
+            Mapper().descriptor_to_datastore_dict(self.schema, resource_id)
+        if resource is not None:
+            del datastore_dict['resource_id']
+            datastore_dict['resource'] = resource
+        if self.defer_indexes:
+            self.__deferred_indexes = dict(
+                (key, datastore_dict.pop(key))
+                for key in ('primary_key', 'indexes')
+                if key in datastore_dict)
+        result = self._datastore_request('datastore_create', datastore_dict)
+        self.resource_id = result['resource_id']
+        return self.resource_id
+
+    def delete(self, resource_id):
+        '''Delete the DataStore table of `resource_id`, if it has one.'''
+        self._datastore_request('datastore_delete', {
+            'resource_id': resource_id,
+            'force': True
+        }, allow_not_found=True)
+
+    def set_aliases(self, aliases, resource_id=None, allow_not_found=False):
+        '''Make `aliases` the only aliases of the DataStore table of
+        `resource_id`, or of the table written to.'''
+        self._datastore_request('datastore_create', {
+            'resource_id': resource_id or self.resource_id,
+            'aliases': aliases,
+            'force': True
+        }, allow_not_found=allow_not_found)
+
+    def delete_rows(self, keys):
+        '''Delete the rows with the primary `keys`, each a list of values in
+        the order of the schema's primary key, in batches where the key has
+        a single field.'''
+        primary_key = _primary_key(self.schema)
+        keys = iter(keys)
+        while True:
+            if len(primary_key) == 1:
+                batch = [key[0] for key in itertools.islice(
+                    keys, self.batch_size)]
+                filters = {primary_key[0]: batch}
+            else:
+                batch = list(itertools.islice(keys, 1))
+                filters = dict(zip(primary_key, batch[0])) if batch else {}
+            if not batch:
+                return
+            self._datastore_request('datastore_delete', {
+                'resource_id': self.resource_id,
+                'filters': filters,
+                'force': True
+            })
+            self.rows_deleted += len(batch)
+
+    def alias_of(self, alias):
+        '''Return the resource id of the DataStore table that has `alias`,
+        or None.'''
+        result = self._datastore_request('datastore_search', {
+            'resource_id': '_table_metadata',
+            'filters': {'name': alias}
+        }, allow_not_found=True)
+        records = (result or {}).get('records', [])
+        return records[0].get('alias_of') if records else None
+
+    def write(self, row):
+        '''Queue `row` for writing, sending a batch when it is full.'''
+        if self.__started is None:
+            self.__started = time.time()
+            self._start_workers()
+        if self.__primary_key:
+            key = [row.get(name) for name in self.__primary_key]
+            partition = hash(json.dumps(key, default=_json_default)) \
+                % self.workers
+        else:
+            partition = self.__cursor
+        batch = self.__batches[partition]
+        batch.append(
+            dict((name, row.get(name)) for name in self.__field_names))
+        if len(batch) >= self.batch_size:
+            self._send(partition)
+
+    def flush(self):
+        '''Send the queued rows.'''
+        for partition in range(self.workers):
+            self._send(partition)
+
+    def close(self):
+        '''Send any remaining rows and wait for all batches to be written,
+        raising the first error. Then add any deferred indexes.'''
+        try:
+            self.flush()
+        finally:
+            for batches in self.__queues:
+                batches.put(None)
+            for thread in self.__threads:
+                thread.join()
+            self.__queues, self.__threads = [], []
+            pending = [f for f in self.__pending if f is not None]
+            concurrent.futures.wait(pending)
+            self.__pending = [None] * self.workers
+            self.__errors.extend(f.exception() for f in pending
+                                 if f.exception() is not None)
+        if self.__started is not None:
+            self.seconds = time.time() - self.__started
+        self._raise_errors()
+        self._create_deferred_indexes()
+
+    def _create_deferred_indexes(self):
+        if not self.__deferred_indexes:
+            return
+        data_dict = dict(self.__deferred_indexes,
+                         resource_id=self.resource_id, force=True)
+        self.__deferred_indexes = {}
+        self._datastore_request('datastore_create', data_dict)
+
+    def _start_workers(self):
+        if self.workers == 1 or self.client is not None:
+            return
+        for _ in range(self.workers):
+            batches = queue.Queue(maxsize=2)
+            thread = threading.Thread(target=self._work, args=(batches,),
+                                      daemon=True)
+            thread.start()
+            self.__queues.append(batches)
+            self.__threads.append(thread)
+
+    def _work(self, batches):
+        while True:
+            records = batches.get()
+            if records is None:
+                return
+            if self.__errors:
+                continue
+            try:
+                self._upsert(records)
+            except Exception as e:
+                self.__errors.append(e)
+
+    def _send(self, partition):
+        records = self.__batches[partition]
+        if not records:
+            return
+        self.__batches[partition] = []
+        if not self.__primary_key:
+            self.__cursor = (self.__cursor + 1) % self.workers
+        self._raise_errors()
+        if self.client is not None:
+            # Wait for the partition's previous batch, to keep their order
+            pending = self.__pending[partition]
+            if pending is not None:
+                pending.result()
+            self.__pending[partition] = \
+                self.client.submit(self._upsert, records)
+        elif self.__queues:
+            self.__queues[partition].put(records)
+        else:
+            self._upsert(records)
+
+    def _upsert(self, records):
+        # inserting a batch twice would duplicate its rows
+        self._datastore_request('datastore_upsert', {
+            'resource_id': self.resource_id,
+            'method': self.method,
+            'force': True,
+            'records': records
+        }, idempotent=self.method != 'insert')
+        with self.__lock:
+            self.rows_written += len(records)
+
+    def _raise_errors(self):
+        if self.__errors:
+            raise self.__errors[0]
+
+    def _datastore_request(self, action, data_dict, allow_not_found=False,
+                           idempotent=None):
+        url = '{}/{}'.format(self.base_endpoint, action)
+        response = make_ckan_request(
+            url, method='POST', api_key=self.api_key, idempotent=idempotent,
+            headers={'Content-Type': 'application/json'},
+            data=json.dumps(data_dict, default=_json_default))
+
+        ckan_error = get_ckan_error(response)
+        if ckan_error and allow_not_found \
+           and ckan_error.get('__type') == 'Not Found Error':
+            return None
+        if ckan_error:
+            log.exception('CKAN returned an error when calling {}: {}'.format(
+                action, json.dumps(ckan_error)))
+            raise Exception
+        return response.get('result')
+
+
+class RowSnapshot(object):
+    '''A compact record of the rows last written to a DataStore table, so
+    that only the rows that changed since are written again. It keeps a
+    digest of each row by its primary key in the SQLite file at `path`,
+    along with the id of the resource and a digest of the `schema` they
+    were written with.
+
+    Each row of a run is passed to `changed()`. The keys of the rows that
+    were not are then listed by `removed()`, and `commit()` saves the run's
+    rows as the snapshot. Until then, the previous snapshot is kept.'''
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.rows_unchanged = 0
+        self.__primary_key = _primary_key(schema)
+        self.__field_names = [f['name'] for f in schema['fields']]
+        self.__schema_digest = hashlib.md5(json.dumps(
+            schema, sort_keys=True).encode('utf-8')).hexdigest()
+        self.__connection = sqlite3.connect(path)
+        self.__connection.executescript('''
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS rows (
+                key TEXT PRIMARY KEY, digest BLOB, run INTEGER)
+                WITHOUT ROWID;
+        ''')
+        self.__meta = dict(self.__connection.execute(
+            'SELECT name, value FROM meta'))
+        self.__run = int(self.__meta.get('run', 0)) + 1
+
+    def matches(self, resource_id):
+        '''Return True if the snapshot is of the DataStore table of
+        `resource_id`, written with the same schema.'''
+        return self.__meta.get('resource_id') == resource_id and \
+            self.__meta.get('schema') == self.__schema_digest
+
+    def clear(self):
+        '''Forget the rows of the previous snapshot.'''
+        self.__connection.execute('DELETE FROM rows')
+
+    def changed(self, row):
+        '''Record `row` in this run, and return True if it is new or has
+        changed since the snapshot.'''
+        key = json.dumps([row.get(name) for name in self.__primary_key],
+                         default=_json_default)
+        digest = hashlib.md5(json.dumps(
+            [row.get(name) for name in self.__field_names],
+            default=_json_default).encode('utf-8')).digest()
+        if self.__connection.execute(
+                'UPDATE rows SET run = ? WHERE key = ? AND digest = ?',
+                (self.__run, key, digest)).rowcount:
+            self.rows_unchanged += 1
+            return False
+        self.__connection.execute(
+            'INSERT OR REPLACE INTO rows VALUES (?, ?, ?)',
+            (key, digest, self.__run))
+        return True
+
+    def removed(self):
+        '''Yield the primary keys, as lists of values, of the rows of the
+        snapshot that were not in this run.'''
+        cursor = self.__connection.execute(
+            'SELECT key FROM rows WHERE run != ?', (self.__run,))
+        for key, in cursor:
+            yield json.loads(key)
+
+    def commit(self, resource_id):
+        '''Save this run's rows as the snapshot of the DataStore table of
+        `resource_id`.'''
+        self.__connection.execute('DELETE FROM rows WHERE run != ?',
+                                  (self.__run,))
+        self.__meta = {'resource_id': resource_id,
+                       'schema': self.__schema_digest,
+                       'run': str(self.__run)}
+        self.__connection.executemany(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+            self.__meta.items())
+        self.__connection.commit()
+
+    def close(self):
+        '''Close the file, keeping the previous snapshot unless this run
+        was committed.'''
+        self.__connection.close()
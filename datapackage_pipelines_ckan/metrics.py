@@ -0,0 +1,123 @@
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    '''Return the nearest-rank `percent` percentile of the sorted `values`,
+    or None if there are none.'''
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class Metrics(object):
+    '''Counts and timings of a run: the CKAN calls made per action, the bytes
+    they sent and received and their latencies, and the seconds spent in each
+    phase of the work, in total and per resource.'''
+
+    def __init__(self):
+        self.calls = {}
+        self.errors = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.phases = {}
+        self.resources = {}
+        self.__latencies = {}
+        self.__lock = threading.Lock()
+
+    def record_request(self, action, latency, request_bytes=0,
+                       response_bytes=0, ok=True):
+        '''Record a call to the CKAN `action` that took `latency` seconds.'''
+        with self.__lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            if not ok:
+                self.errors[action] = self.errors.get(action, 0) + 1
+            self.request_bytes += request_bytes
+            self.response_bytes += response_bytes
+            self.__latencies.setdefault(action, []).append(latency)
+
+    def add_time(self, phase, seconds, resource=None):
+        '''Add `seconds` to the time spent in `phase`, and to the time spent
+        in it for `resource` if given.'''
+        with self.__lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+            if resource is not None:
+                phases = self.resources.setdefault(resource, {})
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, phase, resource=None):
+        '''Time the body of the with statement as part of `phase`.'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - started, resource)
+
+    def latency(self, action=None):
+        '''Return the latency percentiles and maximum, in milliseconds, of
+        the calls to `action`, or of all calls.'''
+        with self.__lock:
+            if action is None:
+                values = [latency for latencies in self.__latencies.values()
+                          for latency in latencies]
+            else:
+                values = list(self.__latencies.get(action, []))
+        values.sort()
+        summary = {}
+        for percent in PERCENTILES:
+            value = percentile(values, percent)
+            summary['p{}'.format(percent)] = \
+                None if value is None else round(value * 1000, 1)
+        summary['max'] = round(values[-1] * 1000, 1) if values else None
+        return summary
+
+    def summary(self):
+        '''Return the metrics as a dict of stats.'''
+        with self.__lock:
+            actions = sorted(self.calls)
+            summary = {
+                'ckan_calls': dict(self.calls),
+                'ckan_errors': dict(self.errors),
+                'ckan_request_bytes': self.request_bytes,
+                'ckan_response_bytes': self.response_bytes,
+                'phase_seconds': _rounded(self.phases),
+                'resource_seconds': dict(
+                    (resource, _rounded(phases))
+                    for resource, phases in self.resources.items())
+            }
+        summary['ckan_latency_ms'] = self.latency()
+        summary['ckan_latency_ms_by_action'] = dict(
+            (action, self.latency(action)) for action in actions)
+        return summary
+
+    def write(self, path):
+        '''Write the metrics to the JSON file at `path`.'''
+        with open(path, 'w', encoding='utf8') as metrics_file:
+            json.dump(self.summary(), metrics_file, indent=2, sort_keys=True)
+
+
+def _rounded(seconds):
+    return dict((key, round(value, 3)) for key, value in seconds.items())
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    '''Return the Metrics that CKAN requests are recorded in.'''
+    return _metrics
+
+
+def reset_metrics():
+    '''Start recording CKAN requests in new Metrics, and return them.'''
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
@@ -0,0 +1,88 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+from datapackage_pipelines_ckan.utils import make_ckan_request, get_ckan_error
+from datapackage_pipelines_ckan.streams import FileSlice
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_PART_WORKERS = 4
+
+
+class MultipartUploader(object):
+    '''Upload files to CKAN resources in parts, through the multipart upload
+    API of ckanext-cloudstorage (`cloudstorage_initiate_multipart`,
+    `cloudstorage_upload_multipart` and `cloudstorage_finish_multipart`).
+
+    Parts of `part_size` bytes are streamed from the file by `workers`
+    threads. Uploading a part can be repeated, so each part is retried on
+    its own if it fails, and only an upload with a part that failed for good
+    is aborted.'''
+
+    def __init__(self, base_endpoint, part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_PART_WORKERS, api_key=None, progress=None):
+        self.base_endpoint = base_endpoint
+        self.part_size = part_size
+        self.workers = max(workers, 1)
+        self.api_key = api_key
+        self.progress = progress
+
+    def upload(self, resource_id, filename, ckan_filename):
+        '''Upload the file `filename` to the resource `resource_id`, as
+        `ckan_filename`.'''
+        size = os.path.getsize(filename)
+        upload = self._action('cloudstorage_initiate_multipart', json={
+            'id': resource_id,
+            'name': ckan_filename,
+            'size': size
+        })
+        upload_id = upload['id']
+
+        part_count = max((size + self.part_size - 1) // self.part_size, 1)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._upload_part, upload_id,
+                                           filename, part_number, size)
+                           for part_number in range(1, part_count + 1)]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in futures:
+                    future.cancel()
+                for future in done:
+                    future.result()
+            return self._action('cloudstorage_finish_multipart',
+                                json={'uploadId': upload_id})
+        except Exception:
+            log.error('Multipart upload of {} failed, aborting it.'.format(
+                ckan_filename))
+            try:
+                self._action('cloudstorage_abort_multipart',
+                             json={'id': resource_id})
+            except Exception:
+                log.exception('Could not abort the multipart upload.')
+            raise
+
+    def _upload_part(self, upload_id, filename, part_number, size):
+        offset = (part_number - 1) * self.part_size
+        length = min(self.part_size, size - offset)
+        with FileSlice(filename, offset, length) as part:
+            return self._action(
+                'cloudstorage_upload_multipart',
+                data={'uploadId': upload_id, 'partNumber': part_number},
+                files={'upload': (str(part_number), part)},
+                upload_progress=self.progress,
+                idempotent=True)
+
+    def _action(self, action, **kwargs):
+        url = '{}/{}'.format(self.base_endpoint, action)
+        response = make_ckan_request(url, method='POST', api_key=self.api_key,
+                                     **kwargs)
+        ckan_error = get_ckan_error(response)
+        if ckan_error:
+            log.exception('CKAN returned an error when calling {}: {}'.format(
+                action, json.dumps(ckan_error)))
+            raise Exception
+        return response['result']
@@ -1,56 +1,174 @@
+import copy
 import json
+from concurrent.futures import ThreadPoolExecutor
 
+from slugify import slugify
 from datapackage_pipelines.utilities.resources import (
     PATH_PLACEHOLDER, PROP_STREAMED_FROM
 )
-from datapackage_pipelines.generators import slugify
 from datapackage_pipelines.wrapper import ingest, spew
 
-from datapackage_pipelines_ckan.utils import make_ckan_request, get_ckan_error
+from datapackage_pipelines_ckan.utils import (
+    send_ckan_request, get_ckan_error, configure_ckan_sessions,
+    DEFAULT_POOL_SIZE, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF_FACTOR
+)
+from datapackage_pipelines_ckan.aio import (
+    AsyncCkanClient, DEFAULT_MAX_IN_FLIGHT
+)
+from datapackage_pipelines_ckan.cache import (
+    MetadataCache, DEFAULT_TTL, DEFAULT_MAX_SIZE
+)
+from datapackage_pipelines_ckan.profiling import Profiler
 
 import logging
 log = logging.getLogger(__name__)
 
 parameters, datapackage, res_iter = ingest()
 
+profiler = Profiler.from_parameters(parameters, pop=True)
+profiler.start()
+
 ckan_host = parameters.pop('ckan-host')
 ckan_api_key = parameters.pop('ckan-api-key', None)
-resource_id = parameters.pop('resource-id')
-resource_show_url = '{ckan_host}/api/3/action/resource_show'.format(
-                    ckan_host=ckan_host)
-
-response = make_ckan_request(resource_show_url,
-                             params=dict(id=resource_id),
-                             api_key=ckan_api_key)
-
-ckan_error = get_ckan_error(response)
-if ckan_error:
-    if 'Not found: Resource was not found.' in ckan_error.get('message', []):
-        log.exception('CKAN resource {} was not found.'.format(resource_id))
-    else:
-        log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
-
-    raise Exception
-
-resource = response['result']
-
-if 'name' in resource:
-    if 'title' not in resource:
-        resource['title'] = resource['name']
-    resource['name'] = slugify(resource['name']).lower()
-
-if 'format' in resource:
-    resource['format'] = resource['format'].lower()
-
-if 'url' in resource:
-    resource['path'] = PATH_PLACEHOLDER
-    resource[PROP_STREAMED_FROM] = resource['url']
-    del resource['url']
-
-del resource['hash']
-
-resource.update(parameters)
-
-datapackage['resources'].append(resource)
-
-spew(datapackage, res_iter)
+resource_ids = parameters.pop('resource-id', None)
+dataset_id = parameters.pop('dataset-id', None)
+include = parameters.pop('include', {})
+exclude = parameters.pop('exclude', {})
+pool_size = parameters.pop('ckan-pool-size', DEFAULT_POOL_SIZE)
+configure_ckan_sessions(
+    pool_size=pool_size,
+    keep_alive=parameters.pop('ckan-keep-alive', True),
+    connect_timeout=parameters.pop('ckan-connect-timeout', None),
+    read_timeout=parameters.pop('ckan-read-timeout', None),
+    max_retries=parameters.pop('ckan-max-retries', DEFAULT_MAX_RETRIES),
+    backoff_factor=parameters.pop('ckan-backoff-factor',
+                                  DEFAULT_BACKOFF_FACTOR),
+    max_concurrency=parameters.pop('ckan-max-concurrency', None))
+
+cache = None
+cache_dir = parameters.pop('cache-dir', None)
+cache_ttl = parameters.pop('cache-ttl', DEFAULT_TTL)
+cache_max_size = parameters.pop('cache-max-size', DEFAULT_MAX_SIZE)
+if cache_dir:
+    cache = MetadataCache(cache_dir, ttl=cache_ttl, max_size=cache_max_size,
+                          api_key=ckan_api_key)
+
+async_client = None
+if parameters.pop('ckan-async-engine', False):
+    async_client = AsyncCkanClient(
+        parameters.pop('ckan-max-in-flight', DEFAULT_MAX_IN_FLIGHT))
+else:
+    parameters.pop('ckan-max-in-flight', None)
+
+if (resource_ids is None) == (dataset_id is None):
+    raise RuntimeError('Exactly one of resource-id or dataset-id is required.')
+if isinstance(resource_ids, str):
+    resource_ids = [resource_ids]
+
+
+def ckan_action(action, **params):
+    '''Call the CKAN `action` with `params` and return its result. If a
+    cache is configured, fresh cached results are returned without a request
+    and stale ones are revalidated.'''
+    action_url = '{ckan_host}/api/3/action/{action}'.format(
+                 ckan_host=ckan_host, action=action)
+
+    entry = None
+    headers = {}
+    if cache is not None:
+        entry = cache.get(ckan_host, action, params['id'])
+        if entry is not None and entry['fresh']:
+            return entry['result']
+        if entry is not None:
+            headers = cache.conditional_headers(entry)
+
+    http_response = send_ckan_request(action_url,
+                                      params=params,
+                                      headers=headers,
+                                      api_key=ckan_api_key)
+    if entry is not None and http_response.status_code == 304:
+        cache.touch(ckan_host, action, params['id'])
+        return entry['result']
+
+    try:
+        response = http_response.json()
+    except json.decoder.JSONDecodeError:
+        log.error('Expected JSON in response from: {}'.format(action_url))
+        raise
+
+    ckan_error = get_ckan_error(response)
+    if ckan_error:
+        if 'Not found' in ckan_error.get('message', ''):
+            log.exception('CKAN {} {} was not found.'.format(
+                'dataset' if action == 'package_show' else 'resource',
+                params['id']))
+        else:
+            log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
+
+        raise Exception
+
+    if cache is not None:
+        cache.set(ckan_host, action, params['id'], response['result'],
+                  http_response.headers.get('ETag'))
+    return response['result']
+
+
+def matches(resource, filters):
+    '''Return True if the resource's name or format is listed in the `names`
+    or `formats` of `filters`.'''
+    name = resource.get('name', '')
+    names = filters.get('names', [])
+    formats = [f.lower() for f in filters.get('formats', [])]
+    return name in names or slugify(name).lower() in names \
+        or (resource.get('format') or '').lower() in formats
+
+
+def normalize(resource):
+    '''Turn a CKAN resource dict into a datapackage resource to be streamed
+    from its url.'''
+    if 'name' in resource:
+        if 'title' not in resource:
+            resource['title'] = resource['name']
+        resource['name'] = slugify(resource['name']).lower()
+
+    if 'format' in resource:
+        resource['format'] = resource['format'].lower()
+
+    if 'url' in resource:
+        resource['path'] = PATH_PLACEHOLDER
+        resource[PROP_STREAMED_FROM] = resource['url']
+        del resource['url']
+
+    resource.pop('hash', None)
+
+    resource.update(copy.deepcopy(parameters))
+    return resource
+
+
+if dataset_id is not None:
+    resources = ckan_action('package_show', id=dataset_id)['resources']
+elif len(resource_ids) == 1:
+    resources = [ckan_action('resource_show', id=resource_ids[0])]
+elif async_client is not None:
+    resources = async_client.map(
+        lambda resource_id: ckan_action('resource_show', id=resource_id),
+        resource_ids)
+else:
+    # Fetch the resources concurrently, keeping their order
+    with ThreadPoolExecutor(max_workers=min(len(resource_ids),
+                                            pool_size)) as executor:
+        resources = list(executor.map(
+            lambda resource_id: ckan_action('resource_show', id=resource_id),
+            resource_ids))
+if async_client is not None:
+    async_client.close()
+profiler.snapshot('fetching the resources')
+
+for resource in resources:
+    if include and not matches(resource, include):
+        continue
+    if exclude and matches(resource, exclude):
+        continue
+    datapackage['resources'].append(normalize(resource))
+
+spew(datapackage, res_iter, finalizer=profiler.stop)
@@ -1,18 +1,56 @@
+import io
 import os
 import json
+import time
 import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from tabulator import Stream
 import datapackage as datapackage_lib
 from ckan_datapackage_tools import converter
 from datapackage_pipelines.lib.dump.dumper_base import FileDumper, DumperBase
-from tableschema_ckan_datastore import Storage
 
-from datapackage_pipelines_ckan.utils import make_ckan_request, get_ckan_error
+from datapackage_pipelines_ckan.utils import (
+    make_ckan_request, get_ckan_error, configure_ckan_sessions,
+    DEFAULT_POOL_SIZE, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF_FACTOR
+)
+from datapackage_pipelines_ckan.streams import (
+    HashingWriter, BoundedPipe, MultipartEncoder, HASH_ALGORITHMS
+)
+from datapackage_pipelines_ckan.datastore import (
+    DatastoreWriter, RowSnapshot, DEFAULT_BATCH_SIZE
+)
+from datapackage_pipelines_ckan.aio import (
+    AsyncCkanClient, DEFAULT_MAX_IN_FLIGHT
+)
+from datapackage_pipelines_ckan.multipart import (
+    MultipartUploader, DEFAULT_PART_SIZE, DEFAULT_PART_WORKERS
+)
+from datapackage_pipelines_ckan.metrics import reset_metrics
+from datapackage_pipelines_ckan.profiling import Profiler
 
 import logging
 log = logging.getLogger(__name__)
 
+# Dataset extra used by skip_unchanged to recognise an unchanged dataset
+DATASET_HASH_EXTRA = 'dataset_hash'
+
+# Resource fields used by the 'replace' DataStore method: a resource records
+# the DataStore alias of its rows and the resource holding the table the
+# alias points to, and that resource records the name of the resource whose
+# rows it holds
+DATASTORE_ALIAS_FIELD = 'datastore_alias'
+DATASTORE_TABLE_FIELD = 'datastore_table'
+DATASTORE_TABLE_OF_FIELD = 'datastore_table_of'
+DEFAULT_DATASTORE_ALIAS = '{dataset}_{resource}'
+
+DEFAULT_COMPRESSION_LEVEL = 6
+MIMETYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json'
+}
+
 
 class CkanDumper(FileDumper):
 
@@ -24,17 +62,178 @@ class CkanDumper(FileDumper):
         self.__base_endpoint = self.__base_url + base_path
 
         self.__ckan_api_key = parameters.get('ckan-api-key')
+
+        # Record this run's CKAN calls and timings
+        self.__metrics = reset_metrics()
+        self.__metrics_file = parameters.get('metrics_file')
+        # Profile the rest of the run, if asked to
+        self.__profiler = Profiler.from_parameters(parameters)
+        self.__profiler.start()
+
+        # Keep enough pooled connections for all concurrent workers
+        upload_workers = parameters.get('upload_workers', 0)
+        self.__datastore_batch_size = parameters.get('datastore_batch_size')
+        self.__datastore_workers = parameters.get('datastore_workers')
+        upload_backend = parameters.get('upload_backend', 'default')
+        if upload_backend not in ['default', 'multipart']:
+            raise RuntimeError(
+                'upload_backend must be one of \'default\' or '
+                '\'multipart\'.')
+        part_workers = parameters.get('upload_part_workers',
+                                      DEFAULT_PART_WORKERS)
+        self.__async_client = None
+        if parameters.get('ckan-async-engine', False):
+            self.__async_client = AsyncCkanClient(
+                parameters.get('ckan-max-in-flight', DEFAULT_MAX_IN_FLIGHT))
+        default_pool_size = max(
+            DEFAULT_POOL_SIZE,
+            max(upload_workers, 1) * max(
+                self.__datastore_workers or 1,
+                part_workers if upload_backend == 'multipart' else 1),
+            self.__async_client.max_in_flight if self.__async_client else 0)
+        configure_ckan_sessions(
+            pool_size=parameters.get('ckan-pool-size', default_pool_size),
+            keep_alive=parameters.get('ckan-keep-alive', True),
+            connect_timeout=parameters.get('ckan-connect-timeout'),
+            read_timeout=parameters.get('ckan-read-timeout'),
+            max_retries=parameters.get('ckan-max-retries',
+                                       DEFAULT_MAX_RETRIES),
+            backoff_factor=parameters.get('ckan-backoff-factor',
+                                          DEFAULT_BACKOFF_FACTOR),
+            max_concurrency=parameters.get('ckan-max-concurrency'))
         self.__dataset_resources = []
         self.__dataset_id = None
+        self.__dataset_name = None
+        self._parse_datastore_options(parameters)
+        self._parse_hash_options(parameters)
+
+        self.__reconcile_resources = \
+            parameters.get('reconcile_resources', False)
+        self.__bulk_resources = parameters.get('bulk_resources', False)
+
+        self.__dataset_sync = parameters.get('dataset_sync', 'create')
+        if self.__dataset_sync not in ['create', 'patch']:
+            raise RuntimeError(
+                'dataset_sync must be one of \'create\' or \'patch\'.')
+
+        self._parse_upload_options(parameters)
+        self.__existing_resources = {}
+        self.__skipped_resources = 0
+        self.__patched_resources = 0
+        self.__deleted_resources = 0
+        self.__datapackage_hash = None
+        self.__dataset_hash = None
+        self.__resource_writes = 0
+        self.__dataset_extras = []
+        self.__dataset_unchanged = False
+
+        self.__datastore_rows = 0
+        self.__datastore_rows_unchanged = 0
+        self.__datastore_rows_deleted = 0
+        self.__datastore_seconds = 0.0
+        self.__datastore_stats_lock = threading.Lock()
+        self.__bytes_uploaded = 0
+        self.__upload_stats_lock = threading.Lock()
+
+        self.__multipart_uploader = None
+        if upload_backend == 'multipart':
+            if self.__direct_upload:
+                raise RuntimeError(
+                    'The multipart upload_backend cannot be used with '
+                    'direct_upload.')
+            self.__multipart_uploader = MultipartUploader(
+                self.__base_endpoint,
+                part_size=parameters.get('upload_part_size',
+                                         DEFAULT_PART_SIZE),
+                workers=part_workers,
+                api_key=self.__ckan_api_key,
+                progress=self._count_uploaded_bytes)
+
+        self.__upload_executor = None
+        self.__upload_slots = None
+        self.__uploads = []
+        if upload_workers:
+            self.__upload_executor = \
+                ThreadPoolExecutor(max_workers=upload_workers)
+            self.__upload_slots = threading.BoundedSemaphore(upload_workers)
+
+    def _parse_datastore_options(self, parameters):
+        '''Read the options of the DataStore push.'''
         self.__push_to_datastore = \
             parameters.get('push_resources_to_datastore', False)
         self.__push_to_datastore_method = \
             parameters.get('push_resources_to_datastore_method', 'insert')
         if self.__push_to_datastore_method \
-           not in ['insert', 'upsert', 'update']:
+           not in ['insert', 'upsert', 'update', 'replace', 'delta']:
             raise RuntimeError(
                 'push_resources_to_datastore_method must be one of '
-                '\'insert\', \'upsert\' or \'update\'.')
+                '\'insert\', \'upsert\', \'update\', \'replace\' or '
+                '\'delta\'.')
+        self.__datastore_alias = \
+            parameters.get('datastore_alias', DEFAULT_DATASTORE_ALIAS)
+        self.__datastore_stream_rows = \
+            parameters.get('datastore_stream_rows', False)
+        self.__datastore_snapshot_dir = \
+            parameters.get('datastore_snapshot_dir')
+        if self.__push_to_datastore_method == 'delta':
+            if not self.__datastore_snapshot_dir:
+                raise RuntimeError(
+                    'The \'delta\' push_resources_to_datastore_method '
+                    'requires a datastore_snapshot_dir.')
+            # The rows are compared with the snapshot as they stream
+            self.__datastore_stream_rows = True
+        self.__datastore_defer_indexes = \
+            parameters.get('datastore_defer_indexes', False)
+        if self.__datastore_defer_indexes and \
+           self.__push_to_datastore_method not in ['insert', 'replace']:
+            raise RuntimeError(
+                'datastore_defer_indexes can only be used with the '
+                '\'insert\' or \'replace\' '
+                'push_resources_to_datastore_method.')
+
+    def _parse_hash_options(self, parameters):
+        '''Read the hash_algorithm and skip_unchanged options.'''
+        self.__hash_algorithm = parameters.get('hash_algorithm', 'md5')
+        if self.__hash_algorithm not in HASH_ALGORITHMS + ['none']:
+            raise RuntimeError(
+                'hash_algorithm must be one of {} or \'none\'.'.format(
+                    ', '.join('\'{}\''.format(a) for a in HASH_ALGORITHMS)))
+        if self.__hash_algorithm == 'none':
+            self.__hash_algorithm = None
+
+        self.__skip_unchanged = parameters.get('skip_unchanged', False)
+        if self.__skip_unchanged and self.__hash_algorithm is None:
+            raise RuntimeError(
+                'skip_unchanged requires a hash_algorithm other than '
+                '\'none\'.')
+        if self.__skip_unchanged and self.__datastore_stream_rows:
+            raise RuntimeError(
+                'skip_unchanged cannot be used with datastore_stream_rows.')
+
+    def _parse_upload_options(self, parameters):
+        '''Read the options of how files are uploaded.'''
+        self.__compression_level = None
+        if parameters.get('compress_uploads', False):
+            self.__compression_level = \
+                parameters.get('compression_level', DEFAULT_COMPRESSION_LEVEL)
+            if self.__compression_level not in range(1, 10):
+                raise RuntimeError(
+                    'compression_level must be a number from 1 to 9.')
+
+        self.__direct_upload = parameters.get('direct_upload', False)
+        self.__direct_upload_executor = None
+        if self.__direct_upload and self.__skip_unchanged:
+            raise RuntimeError(
+                'skip_unchanged cannot be used with direct_upload.')
+        if self.__direct_upload:
+            # There is no file to push to the DataStore afterwards
+            self.__datastore_stream_rows = True
+            self.__direct_upload_executor = ThreadPoolExecutor(max_workers=1)
+        if self.__datastore_stream_rows and \
+           self.__push_to_datastore_method == 'replace':
+            raise RuntimeError(
+                'The \'replace\' push_resources_to_datastore_method cannot '
+                'be used with datastore_stream_rows or direct_upload.')
 
     def handle_resources(self, datapackage,
                          resource_iterator,
@@ -48,33 +247,24 @@ class CkanDumper(FileDumper):
         '''
 
         # Calculate datapackage hash
+        self.__datapackage_hash = hashlib.md5(
+                    json.dumps(datapackage,
+                               sort_keys=True,
+                               ensure_ascii=True).encode('ascii')
+                ).hexdigest()
         if self.datapackage_hash:
-            datapackage_hash = hashlib.md5(
-                        json.dumps(datapackage,
-                                   sort_keys=True,
-                                   ensure_ascii=True).encode('ascii')
-                    ).hexdigest()
             DumperBase.set_attr(datapackage, self.datapackage_hash,
-                                datapackage_hash)
+                                self.__datapackage_hash)
 
         # Handle the datapackage first!
-        self.handle_datapackage(datapackage, parameters, stats)
+        with self.__metrics.timer('dataset'):
+            self.handle_datapackage(datapackage, parameters, stats)
 
         # Handle non-streaming resources
-        for resource in datapackage['resources']:
-            if not resource.get('dpp:streaming', False):
-                resource_metadata = {
-                    'package_id': self.__dataset_id,
-                    'url': resource['dpp:streamedFrom'],
-                    'name': resource['name'],
-                }
-                if 'format' in resource:
-                    resource_metadata.update({'format': resource['format']})
-                request_params = {
-                    'json': resource_metadata
-                }
-
-                self._create_ckan_resource(request_params)
+        non_streaming_resources = self._non_streaming_resources(datapackage)
+        with self.__metrics.timer('resources'):
+            self._map(lambda args: self._ckan_resource_action(*args),
+                      non_streaming_resources)
 
         # Handle each resource in resource_iterator
         for resource in resource_iterator:
@@ -84,14 +274,99 @@ class CkanDumper(FileDumper):
                                        parameters,
                                        datapackage)
             ret = self.row_counter(datapackage, resource_spec, ret)
+            if self.__profiler.tracing:
+                ret = self.__profiler.trace(ret, resource_spec['name'])
             yield ret
 
+        # Wait for any background uploads before reporting
+        self._wait_for_uploads()
+
+        if self.__reconcile_resources:
+            self._delete_removed_resources(datapackage)
+
+        if self.__skip_unchanged:
+            self._update_dataset_hashes()
+        if self.__async_client is not None:
+            self.__async_client.close()
+
+        self._report_stats(datapackage, stats)
+
+    def _report_stats(self, datapackage, stats):
+        '''Add the stats of the run to `stats`.'''
         stats['count_of_rows'] = DumperBase.get_attr(datapackage,
                                                      self.datapackage_rowcount)
         stats['bytes'] = DumperBase.get_attr(datapackage,
                                              self.datapackage_bytes)
         stats['hash'] = DumperBase.get_attr(datapackage, self.datapackage_hash)
         stats['dataset_name'] = datapackage['name']
+        stats['bytes_uploaded'] = self.__bytes_uploaded
+        if self.__skip_unchanged or self.__reconcile_resources:
+            stats['skipped_resources'] = self.__skipped_resources
+        if self.__skip_unchanged:
+            stats['dataset_unchanged'] = self.__dataset_unchanged
+        if self.__reconcile_resources:
+            stats['patched_resources'] = self.__patched_resources
+            stats['deleted_resources'] = self.__deleted_resources
+        if self.__datastore_seconds:
+            stats['datastore_rows'] = self.__datastore_rows
+            stats['datastore_rows_per_second'] = \
+                round(self.__datastore_rows / self.__datastore_seconds, 1)
+        if self.__push_to_datastore_method == 'delta':
+            stats['datastore_rows_unchanged'] = \
+                self.__datastore_rows_unchanged
+            stats['datastore_rows_deleted'] = self.__datastore_rows_deleted
+        stats.update(self.__metrics.summary())
+        if self.__metrics_file:
+            self.__metrics.write(self.__metrics_file)
+
+    def finalize(self):
+        super(CkanDumper, self).finalize()
+        self.__profiler.stop()
+
+    def _non_streaming_resources(self, datapackage):
+        '''Return the actions for the non-streaming resources of
+        `datapackage` that must be created or updated.'''
+        non_streaming_resources = []
+        for resource in datapackage['resources']:
+            if not resource.get('dpp:streaming', False):
+                if self.__bulk_resources:
+                    # Already sent with the dataset
+                    continue
+                action = self._non_streaming_resource_action(resource)
+                if action is not None:
+                    non_streaming_resources.append(action)
+        return non_streaming_resources
+
+    def _non_streaming_resource_action(self, resource):
+        '''Return the action and request parameters that create or update
+        the CKAN resource of the non-streaming `resource`, or None if it is
+        skipped.'''
+        existing = self.__existing_resources.get(resource['name'])
+        if existing is not None and not self.__reconcile_resources \
+           and existing.get('url') == resource['dpp:streamedFrom']:
+            self.__skipped_resources += 1
+            return None
+        resource_metadata = {
+            'package_id': self.__dataset_id,
+            'url': resource['dpp:streamedFrom'],
+            'name': resource['name'],
+        }
+        if 'format' in resource:
+            resource_metadata.update({'format': resource['format']})
+        action = 'resource_create'
+        if existing is not None and self.__reconcile_resources:
+            # Send only the changed metadata, if any
+            resource_metadata = \
+                self._resource_changes(existing, resource_metadata)
+            if not resource_metadata:
+                self.__skipped_resources += 1
+                return None
+            self.__patched_resources += 1
+        if existing is not None:
+            # Update the existing resource in place
+            resource_metadata.update({'id': existing['id']})
+            action = 'resource_patch'
+        return action, {'json': resource_metadata}
 
     def handle_datapackage(self, datapackage, parameters, stats):
         '''Create or update a ckan dataset from datapackage and parameters'''
@@ -123,8 +398,131 @@ class CkanDumper(FileDumper):
         dataset_props_from_params = parameters.get('dataset-properties')
         if dataset_props_from_params:
             dataset.update(dataset_props_from_params)
+        self.__dataset_name = dataset['name']
+
+        existing_dataset = self._show_existing_dataset(dataset['name'])
 
-        package_create_url = '{}/package_create'.format(self.__base_endpoint)
+        # In bulk mode, the non-streaming resources are sent along with the
+        # dataset, rather than created one by one.
+        url_resources = []
+        if self.__bulk_resources:
+            url_resources = self._url_resources(datapackage)
+        self.__dataset_hash = self._dataset_hash(dataset, datapackage,
+                                                 url_resources)
+
+        if existing_dataset is not None \
+           and parameters.get('overwrite_existing') \
+           and self._extras(existing_dataset).get(DATASET_HASH_EXTRA) \
+           == self.__dataset_hash:
+            # The dataset is unchanged since the last run, so there is
+            # nothing to update.
+            log.info('CKAN dataset is unchanged, skipping package_update.')
+            self.__dataset_id = existing_dataset['id']
+            self.__dataset_extras = existing_dataset.get('extras', [])
+            return
+
+        if existing_dataset is not None \
+           and parameters.get('overwrite_existing') \
+           and self.__dataset_sync == 'patch':
+            response = self._patch_dataset(existing_dataset, dataset,
+                                           url_resources)
+            if response is None:
+                return
+        elif existing_dataset is not None \
+                and parameters.get('overwrite_existing'):
+            response = self._update_dataset(existing_dataset, dataset,
+                                            datapackage, url_resources)
+        else:
+            response = self._create_dataset(dataset, parameters,
+                                            url_resources)
+        ckan_error = get_ckan_error(response)
+
+        if ckan_error:
+            log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
+            raise Exception
+
+        if response['success']:
+            self.__dataset_id = response['result']['id']
+            self.__dataset_extras = \
+                response['result'].get('extras', dataset.get('extras', []))
+
+    def _show_existing_dataset(self, name):
+        '''In incremental, patch, reconcile and delta modes, list the current
+        resources of the dataset `name` once, and return the dataset, or None
+        if it does not exist or is not needed.'''
+        if not (self.__skip_unchanged or self.__dataset_sync == 'patch' or
+                self.__reconcile_resources or
+                self.__push_to_datastore_method == 'delta'):
+            return None
+        existing_dataset = self._show_dataset(name)
+        if existing_dataset is not None:
+            self.__existing_resources = dict(
+                (r['name'], r) for r in existing_dataset['resources']
+                if not r.get(DATASTORE_TABLE_OF_FIELD))
+        return existing_dataset
+
+    def _patch_dataset(self, existing_dataset, dataset, url_resources):
+        '''Send only the fields of `dataset` that changed with package_patch,
+        and return the response, or None if nothing changed.'''
+        # The existing resources are kept so that they are updated in place
+        changes = self._dataset_changes(existing_dataset, dataset)
+        if any(r['name'] not in self.__existing_resources or
+               self._resource_changes(
+                   self.__existing_resources[r['name']], r)
+               for r in url_resources):
+            # package_patch replaces the whole list of resources
+            changes['resources'] = self._merge_resources(
+                existing_dataset['resources'], url_resources)
+        if not changes:
+            log.info('CKAN dataset is unchanged, skipping '
+                     'package_patch.')
+            self.__dataset_id = existing_dataset['id']
+            self.__dataset_extras = existing_dataset.get('extras', [])
+            return None
+        changes['id'] = existing_dataset['id']
+        package_patch_url = \
+            '{}/package_patch'.format(self.__base_endpoint)
+        return make_ckan_request(package_patch_url,
+                                 method='POST',
+                                 json=changes,
+                                 api_key=self.__ckan_api_key)
+
+    def _update_dataset(self, existing_dataset, dataset, datapackage,
+                        url_resources):
+        '''Replace the existing dataset with `dataset` with package_update,
+        and return the response.'''
+        # Keep the existing resources that are still in the datapackage, so
+        # that unchanged ones need not be uploaded again. Leaving out the
+        # removed ones deletes them, as a package_update without resources
+        # does, but not the DataStore tables of the 'replace' method.
+        names = set(r['name'] for r in datapackage['resources'])
+        dataset['resources'] = [
+            r for r in existing_dataset['resources']
+            if r['name'] in names or r.get(DATASTORE_TABLE_OF_FIELD)]
+        if self.__reconcile_resources:
+            self.__deleted_resources += \
+                len(existing_dataset['resources']) - \
+                len(dataset['resources'])
+        self.__existing_resources = dict(
+            (r['name'], r) for r in dataset['resources']
+            if not r.get(DATASTORE_TABLE_OF_FIELD))
+        if url_resources:
+            dataset['resources'] = self._merge_resources(
+                dataset['resources'], url_resources)
+        package_update_url = '{}/package_update'.format(self.__base_endpoint)
+        return make_ckan_request(package_update_url,
+                                 method='POST',
+                                 json=dataset,
+                                 api_key=self.__ckan_api_key)
+
+    def _create_dataset(self, dataset, parameters, url_resources):
+        '''Create `dataset` with package_create, or update it with
+        package_update if it exists and overwrite_existing is set, and
+        return the response.'''
+        package_create_url = \
+            '{}/package_create'.format(self.__base_endpoint)
+        if url_resources:
+            dataset['resources'] = url_resources
 
         response = make_ckan_request(package_create_url,
                                      method='POST',
@@ -134,104 +532,705 @@ class CkanDumper(FileDumper):
         ckan_error = get_ckan_error(response)
         if ckan_error \
            and parameters.get('overwrite_existing') \
-           and 'That URL is already in use.' in ckan_error.get('name', []):
-
-            package_update_url = \
-                '{}/package_update'.format(self.__base_endpoint)
+           and 'That URL is already in use.' in \
+           ckan_error.get('name', []):
 
             log.info('CKAN dataset with url already exists. '
                      'Attempting package_update.')
+            package_update_url = \
+                '{}/package_update'.format(self.__base_endpoint)
             response = make_ckan_request(package_update_url,
                                          method='POST',
                                          json=dataset,
                                          api_key=self.__ckan_api_key)
-            ckan_error = get_ckan_error(response)
+        return response
 
-        if ckan_error:
-            log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
-            raise Exception
+    def handle_resource(self, resource, spec, _, datapackage):
+        if spec['name'] not in self.file_formatters:
+            return resource
 
-        if response['success']:
-            self.__dataset_id = response['result']['id']
+        # Hash and count the file's bytes as they are written, rather than
+        # re-reading the file afterwards.
+        if self.__direct_upload:
+            # Stream the bytes to the upload instead of a file
+            temp_file = BoundedPipe()
+        else:
+            temp_file = tempfile.NamedTemporaryFile(mode='wb', delete=False)
+        hashing_file = HashingWriter(temp_file, self.__hash_algorithm,
+                                     self.__compression_level)
+        text_file = io.TextIOWrapper(hashing_file, encoding='utf-8',
+                                     newline='')
+
+        fields = spec['schema']['fields']
+        headers = [field['name'] for field in fields]
+        writer = self.file_formatters[spec['name']].initialize_file(
+            text_file, headers)
+        fields = dict((field['name'], field) for field in fields)
+
+        return self.rows_processor(resource, spec, text_file, writer, fields,
+                                   datapackage)
 
     def rows_processor(self, resource, spec, temp_file, writer, fields,
                        datapackage):
-        file_formatter = self.file_formatters[spec['name']]
-        for row in resource:
-            file_formatter.write_row(writer, row, fields)
-            yield row
-        file_formatter.finalize_file(writer)
+        resource_metadata, existing = self._streamed_resource_metadata(spec)
 
-        # File size:
-        filesize = temp_file.tell()
-        DumperBase.inc_attr(datapackage, self.datapackage_bytes, filesize)
-        DumperBase.inc_attr(spec, self.resource_bytes, filesize)
+        # When streaming rows to the DataStore, the CKAN resource is created
+        # along with its DataStore table, and the file is uploaded to it
+        # afterwards.
+        datastore_writer = None
+        snapshot = None
+        if self.__push_to_datastore and self.__datastore_stream_rows:
+            datastore_writer, snapshot = self._start_datastore_stream(
+                spec, existing, resource_metadata)
 
-        # File Hash:
-        if self.resource_hash:
-            temp_file.seek(0)
-            hasher = hashlib.md5()
-            data = 'x'
-            while len(data) > 0:
-                data = temp_file.read(1024)
-                hasher.update(data.encode('utf8'))
-            DumperBase.set_attr(spec, self.resource_hash, hasher.hexdigest())
-
-        # Finalise
-        filename = temp_file.name
+        direct_upload = None
+        if self.__direct_upload:
+            direct_upload = self._start_direct_upload(
+                temp_file.buffer, resource_metadata, spec)
+
+        try:
+            datastore_seconds = yield from self._write_rows(
+                resource, spec, writer, fields, datastore_writer, snapshot)
+            with self.__metrics.timer('write', spec['name']):
+                self.file_formatters[spec['name']].finalize_file(writer)
+                temp_file.flush()
+            if direct_upload is not None:
+                # Mark the end of the file, and wait for its upload
+                with self.__metrics.timer('upload', spec['name']):
+                    temp_file.close()
+                    direct_upload.result()
+        except BrokenPipeError:
+            if direct_upload is not None:
+                # Raise the error that stopped the upload
+                direct_upload.result()
+            raise
+        finally:
+            if direct_upload is not None and not direct_upload.done():
+                temp_file.buffer.stream.abort()
+        if datastore_writer is not None:
+            self._finish_datastore_stream(datastore_writer, snapshot, spec,
+                                          datastore_seconds)
+
+        # Finalise, so that the size and hash include all of the file
+        filename = temp_file.name if direct_upload is None else None
         temp_file.close()
+        filesize, file_hash = self._record_file_stats(temp_file.buffer, spec,
+                                                      datapackage)
+        if file_hash:
+            resource_metadata.update({'hash': file_hash})
 
+        if direct_upload is None:
+            self._upload_file(filename, existing, resource_metadata, spec,
+                              filesize, datastore_writer is not None)
+
+    def _streamed_resource_metadata(self, spec):
+        '''Return the metadata of the CKAN resource of the streamed
+        resource `spec`, and the existing CKAN resource it replaces, if
+        any.'''
         resource_metadata = {
             'package_id': self.__dataset_id,
             'url': 'url',
             'url_type': 'upload',
-            'name': spec['name'],
-            'hash': spec['hash']
+            'name': spec['name']
         }
         if 'encoding' in spec:
             resource_metadata.update({'encoding': spec['encoding']})
         if 'format' in spec:
             resource_metadata.update({'format': spec['format']})
-        ckan_filename = os.path.basename(spec['path'])
-        resource_files = {
-            'upload': (ckan_filename, open(temp_file.name, 'rb'))
-        }
+        if self.__compression_level is not None:
+            file_format = spec.get('format', 'csv')
+            resource_metadata.update({
+                'format': '{}.gz'.format(file_format),
+                'compression': 'gzip',
+                'mimetype': 'application/gzip',
+                'mimetype_inner': MIMETYPES.get(file_format.lower())
+            })
+
+        # Replace the content of an existing resource
+        existing = self.__existing_resources.get(spec['name'])
+        if existing is not None:
+            resource_metadata.update({'id': existing['id']})
+        return resource_metadata, existing
+
+    def _start_datastore_stream(self, spec, existing, resource_metadata):
+        '''Prepare the DataStore table that the rows of `spec` are streamed
+        to, creating the CKAN resource described by `resource_metadata`
+        unless it has an `existing` one, and return its DatastoreWriter and
+        RowSnapshot, if any.'''
+        datastore_writer = self._get_datastore_writer(spec)
+        snapshot = self._open_snapshot(spec)
+        if snapshot is not None and existing is not None \
+           and snapshot.matches(existing['id']):
+            # Only send the rows that changed to the existing table
+            datastore_writer.resource_id = existing['id']
+        else:
+            if snapshot is not None:
+                snapshot.clear()
+            if existing is not None:
+                datastore_writer.delete(existing['id'])
+                datastore_writer.create(resource_id=existing['id'])
+            else:
+                # CKAN hands a new resource with a url to the DataPusher
+                # rather than creating its table, so the url is only set by
+                # the upload.
+                datastore_writer.create(resource=dict(
+                    (key, value) for key, value in resource_metadata.items()
+                    if key not in ('url', 'url_type')))
+        resource_metadata.update({'id': datastore_writer.resource_id})
+        return datastore_writer, snapshot
+
+    def _finish_datastore_stream(self, datastore_writer, snapshot, spec,
+                                 datastore_seconds):
+        '''Wait for the streamed rows of `spec` to be written, then delete
+        the rows removed since the `snapshot`, if any, and save it.'''
+        try:
+            with self.__metrics.timer('datastore', spec['name']):
+                datastore_writer.close()
+                if snapshot is not None:
+                    # Delete the removed rows, then keep this run's
+                    datastore_writer.delete_rows(snapshot.removed())
+                    snapshot.commit(datastore_writer.resource_id)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        self.__metrics.add_time('datastore', datastore_seconds,
+                                spec['name'])
+        self._add_datastore_stats(datastore_writer, snapshot)
+
+    def _write_rows(self, resource, spec, writer, fields, datastore_writer,
+                    snapshot):
+        '''Write each row of `resource` to the file of `spec`, and with
+        `datastore_writer` if given, and yield it. Return the seconds spent
+        writing to the DataStore.'''
+        file_formatter = self.file_formatters[spec['name']]
+        write_seconds = datastore_seconds = 0.0
+        try:
+            for row in resource:
+                # Time the rows' writing, but not the following processors
+                started = time.perf_counter()
+                file_formatter.write_row(writer, row, fields)
+                written = time.perf_counter()
+                write_seconds += written - started
+                if datastore_writer is not None:
+                    if snapshot is None or snapshot.changed(row):
+                        datastore_writer.write(row)
+                    datastore_seconds += time.perf_counter() - written
+                yield row
+        finally:
+            self.__metrics.add_time('write', write_seconds, spec['name'])
+        return datastore_seconds
+
+    def _record_file_stats(self, hashing_file, spec, datapackage):
+        '''Record the timings, size and hash of the written file of `spec`,
+        and return its size and hash.'''
+        self.__metrics.add_time('hash', hashing_file.hash_seconds,
+                                spec['name'])
+        if self.__compression_level is not None:
+            self.__metrics.add_time('compress',
+                                    hashing_file.compress_seconds,
+                                    spec['name'])
+
+        # File size:
+        filesize = hashing_file.size
+        DumperBase.inc_attr(datapackage, self.datapackage_bytes, filesize)
+        DumperBase.inc_attr(spec, self.resource_bytes, filesize)
+
+        # File Hash:
+        file_hash = hashing_file.hexdigest()
+        if self.resource_hash and file_hash:
+            DumperBase.set_attr(spec, self.resource_hash, file_hash)
+        return filesize, file_hash
+
+    def _upload_file(self, filename, existing, resource_metadata, spec,
+                     filesize, rows_streamed):
+        '''Upload the written file `filename` of `spec`, unless the content
+        of the `existing` resource is unchanged, and push it to the DataStore
+        if required and its rows were not streamed there.'''
+        if existing is not None and not rows_streamed \
+           and (self.__skip_unchanged or self.__reconcile_resources) \
+           and self._resource_unchanged(
+               existing, resource_metadata.get('hash'), filesize):
+            os.unlink(filename)
+            self._patch_unchanged_resource(existing, resource_metadata, spec)
+            return
+        self._queue_upload(filename, resource_metadata, spec,
+                           self.__push_to_datastore and not rows_streamed)
+
+    def _patch_unchanged_resource(self, existing, resource_metadata, spec):
+        '''Skip the upload of the `existing` resource of `spec`, whose
+        content is unchanged, patching only its changed metadata, if
+        any.'''
+        changes = {}
+        if self.__reconcile_resources:
+            changes = self._resource_changes(existing, resource_metadata)
+        if not changes:
+            log.info('CKAN resource {} is unchanged, skipping '
+                     'upload.'.format(spec['name']))
+            self.__skipped_resources += 1
+            return
+        # Only the metadata changed, so the file is not uploaded again
+        log.info('CKAN resource {} content is unchanged, patching its '
+                 'metadata.'.format(spec['name']))
+        self.__patched_resources += 1
+        self._ckan_resource_action('resource_patch', {'json': changes})
+
+    def _queue_upload(self, filename, resource_metadata, spec,
+                      push_to_datastore):
+        '''Upload `filename` now, or in the background if there are
+        upload_workers.'''
+        ckan_filename = self._ckan_filename(spec)
+        if self.__upload_executor is None:
+            self._upload_resource(filename, ckan_filename,
+                                  resource_metadata, spec,
+                                  push_to_datastore)
+            return
+        self._raise_upload_errors()
+        self.__upload_slots.acquire()
+        future = self.__upload_executor.submit(
+            self._upload_resource, filename, ckan_filename,
+            resource_metadata, spec, push_to_datastore)
+        future.add_done_callback(
+            lambda _: self.__upload_slots.release())
+        self.__uploads.append(future)
+
+    def _upload_resource(self, filename, ckan_filename, resource_metadata,
+                         spec, push_to_datastore):
+        '''Upload `filename` to the CKAN resource described by
+        `resource_metadata`, creating it unless it has an id. Push the file
+        to the DataStore if required, replacing the existing table of a
+        resource that has an id, and remove the file.'''
+        replace = 'id' in resource_metadata
+        try:
+            with self.__metrics.timer('upload', spec['name']):
+                if self.__multipart_uploader is not None:
+                    create_result = self._upload_resource_in_parts(
+                        filename, ckan_filename, resource_metadata)
+                else:
+                    create_result = self._upload_resource_file(
+                        filename, ckan_filename, resource_metadata)
+            if push_to_datastore:
+                with self.__metrics.timer('datastore', spec['name']):
+                    self._push_to_datastore(filename, create_result, spec,
+                                            replace)
+        finally:
+            os.unlink(filename)
+
+    def _push_to_datastore(self, filename, resource, spec, replace):
+        '''Push the rows of `filename` to the DataStore table of the CKAN
+        `resource` dict, replacing its existing table if `replace`.'''
+        if self.__push_to_datastore_method == 'replace':
+            self._replace_datastore_table(filename, resource, spec)
+            return
+        resource_id = resource['id']
+        if self.__datastore_batch_size or self.__datastore_workers or \
+           self.__datastore_defer_indexes:
+            self._push_file_to_datastore(filename, resource_id, spec,
+                                         replace)
+            return
+        # Only imported when pushing to the DataStore, to start up faster
+        from tabulator import Stream
+        from tableschema_ckan_datastore import Storage
+
+        # Create the DataStore resource
+        storage = Storage(base_url=self.__base_url,
+                          dataset_id=self.__dataset_id,
+                          api_key=self.__ckan_api_key)
+        storage.create(resource_id, spec['schema'], force=replace)
+        storage.write(resource_id,
+                      Stream(filename, format='csv',
+                             compression=self._compression()).open(),
+                      method=self.__push_to_datastore_method)
+
+    def _upload_resource_file(self, filename, ckan_filename,
+                              resource_metadata):
+        '''Upload `filename` in a single request to the CKAN resource
+        described by `resource_metadata`, creating it unless it has an id.'''
+        with open(filename, 'rb') as upload_file:
+            request_params = {
+                'data': resource_metadata,
+                'files': {'upload': (ckan_filename, upload_file)},
+                'upload_progress': self._count_uploaded_bytes
+            }
+            if 'id' in resource_metadata:
+                return self._patch_ckan_resource(request_params)
+            # Create the CKAN resource
+            return self._create_ckan_resource(request_params)
+
+    def _upload_resource_in_parts(self, filename, ckan_filename,
+                                  resource_metadata):
+        '''Create or update the CKAN resource described by
+        `resource_metadata`, then upload `filename` to it in parts.'''
         request_params = {
-            'data': resource_metadata,
-            'files': resource_files
+            'json': dict(resource_metadata, url=ckan_filename)
         }
+        if 'id' in resource_metadata:
+            result = self._patch_ckan_resource(request_params)
+        else:
+            result = self._create_ckan_resource(request_params)
+        self.__multipart_uploader.upload(result['id'], filename,
+                                         ckan_filename)
+        return result
+
+    def _ckan_filename(self, spec):
+        '''Return the name of the file uploaded for `spec`.'''
+        ckan_filename = os.path.basename(spec['path'])
+        if self.__compression_level is not None:
+            ckan_filename += '.gz'
+        return ckan_filename
+
+    def _compression(self):
+        '''Return the compression of the written files, for tabulator.'''
+        return 'gz' if self.__compression_level is not None else None
+
+    def _start_direct_upload(self, hashing_file, resource_metadata, spec):
+        '''Start uploading the bytes written to `hashing_file` to the CKAN
+        resource described by `resource_metadata`, as they are written, and
+        return the future result of the upload. The file's hash is sent after
+        its content.'''
+        def late_fields():
+            file_hash = hashing_file.hexdigest()
+            return {'hash': file_hash} if file_hash else {}
+
+        pipe = hashing_file.stream
+        encoder = MultipartEncoder(
+            dict(resource_metadata),
+            {'upload': (self._ckan_filename(spec), pipe)},
+            callback=self._count_uploaded_bytes,
+            late_fields=late_fields)
+        action = 'resource_patch' if 'id' in resource_metadata \
+            else 'resource_create'
+
+        def upload():
+            try:
+                return self._ckan_resource_action(action, {'data': encoder})
+            except BaseException:
+                # Stop the rows from being written to the pipe
+                pipe.abort()
+                raise
+
+        return self.__direct_upload_executor.submit(upload)
+
+    def _get_datastore_writer(self, spec):
+        # The 'replace' method only inserts rows into a new table, and the
+        # 'delta' method upserts the changed rows of a table with a key
+        method = self.__push_to_datastore_method
+        if method == 'replace':
+            method = 'insert'
+        elif method == 'delta':
+            method = 'upsert' if spec['schema'].get('primaryKey') \
+                else 'insert'
+        return DatastoreWriter(
+            self.__base_endpoint, spec['schema'],
+            method=method,
+            batch_size=self.__datastore_batch_size or DEFAULT_BATCH_SIZE,
+            workers=self.__datastore_workers or 1,
+            api_key=self.__ckan_api_key,
+            client=self.__async_client,
+            defer_indexes=self.__datastore_defer_indexes)
+
+    def _open_snapshot(self, spec):
+        '''Return the RowSnapshot of the resource `spec` for the 'delta'
+        method, or None if it does not apply to the resource.'''
+        if self.__push_to_datastore_method != 'delta' or \
+           not spec['schema'].get('primaryKey'):
+            return None
+        if not os.path.isdir(self.__datastore_snapshot_dir):
+            os.makedirs(self.__datastore_snapshot_dir)
+        path = os.path.join(self.__datastore_snapshot_dir,
+                            '{}.{}.sqlite'.format(self.__dataset_name,
+                                                  spec['name']))
+        return RowSnapshot(path, spec['schema'])
+
+    def _push_file_to_datastore(self, filename, resource_id, spec,
+                                replace=False):
+        '''Push the rows of the CSV file `filename` to a new DataStore table
+        for `resource_id`, first deleting its existing table if `replace`.'''
+        datastore_writer = self._get_datastore_writer(spec)
+        if replace:
+            datastore_writer.delete(resource_id)
+        datastore_writer.create(resource_id=resource_id)
+        self._write_file_to_datastore(datastore_writer, filename, spec)
+
+    def _replace_datastore_table(self, filename, resource, spec):
+        '''Insert the rows of `filename` into the DataStore table of a new
+        CKAN resource, then point the DataStore alias of the CKAN `resource`
+        dict at it and delete its previous table, so that readers of the
+        alias never see a partly loaded table.'''
+        alias = self.__datastore_alias.format(dataset=self.__dataset_name,
+                                              resource=spec['name'])
+        datastore_writer = self._get_datastore_writer(spec)
+        previous = resource.get(DATASTORE_TABLE_FIELD) or \
+            datastore_writer.alias_of(alias)
+        datastore_writer.create(resource={
+            'package_id': self.__dataset_id,
+            'name': '{} (DataStore)'.format(spec['name']),
+            DATASTORE_TABLE_OF_FIELD: spec['name']
+        })
+        self._write_file_to_datastore(datastore_writer, filename, spec)
+
+        # CKAN refuses an alias that another table has, so it is taken
+        # from the previous table first, and given back to it if the new
+        # table cannot have it
+        if previous:
+            datastore_writer.set_aliases([], resource_id=previous,
+                                         allow_not_found=True)
         try:
-            # Create the CKAN resource
-            create_result = self._create_ckan_resource(request_params)
-            if self.__push_to_datastore:
-                # Create the DataStore resource
-                storage = Storage(base_url=self.__base_url,
-                                  dataset_id=self.__dataset_id,
-                                  api_key=self.__ckan_api_key)
-                resource_id = create_result['id']
-                storage.create(resource_id, spec['schema'])
-                storage.write(resource_id,
-                              Stream(temp_file.name, format='csv').open(),
-                              method=self.__push_to_datastore_method)
-        except Exception as e:
-            raise e
+            datastore_writer.set_aliases([alias])
+        except Exception:
+            if previous:
+                datastore_writer.set_aliases([alias], resource_id=previous,
+                                             allow_not_found=True)
+            raise
+        self._patch_ckan_resource({'json': {
+            'id': resource['id'],
+            DATASTORE_ALIAS_FIELD: alias,
+            DATASTORE_TABLE_FIELD: datastore_writer.resource_id
+        }})
+        if previous:
+            self._ckan_resource_action('resource_delete',
+                                       {'json': {'id': previous}},
+                                       allow_not_found=True)
+
+    def _write_file_to_datastore(self, datastore_writer, filename, spec):
+        '''Write the rows of the CSV file `filename` with `datastore_writer`,
+        and wait for them to be written.'''
+        import tableschema
+        from tabulator import Stream
+        from tableschema_ckan_datastore.mapper import Mapper
+
+        schema = tableschema.Schema(spec['schema'])
+        mapper = Mapper()
+        with Stream(filename, format='csv', headers=1,
+                    compression=self._compression()) as stream:
+            for row in stream.iter():
+                datastore_writer.write(mapper.convert_row(row, schema))
+        datastore_writer.close()
+        self._add_datastore_stats(datastore_writer)
+
+    def _count_uploaded_bytes(self, count):
+        with self.__upload_stats_lock:
+            self.__bytes_uploaded += count
+
+    def _add_datastore_stats(self, datastore_writer, snapshot=None):
+        with self.__datastore_stats_lock:
+            self.__datastore_rows += datastore_writer.rows_written
+            self.__datastore_seconds += datastore_writer.seconds
+            self.__datastore_rows_deleted += datastore_writer.rows_deleted
+            if snapshot is not None:
+                self.__datastore_rows_unchanged += snapshot.rows_unchanged
+
+    def _raise_upload_errors(self):
+        '''Raise the error of the first background upload that failed.'''
+        for future in self.__uploads:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _wait_for_uploads(self):
+        '''Wait for all background uploads to finish, raising the first
+        error.'''
+        if self.__direct_upload_executor is not None:
+            self.__direct_upload_executor.shutdown(wait=True)
+        if self.__upload_executor is None:
+            return
+        try:
+            for future in self.__uploads:
+                future.result()
         finally:
-            os.unlink(filename)
+            self.__upload_executor.shutdown(wait=True)
+
+    @staticmethod
+    def _resource_unchanged(existing, file_hash, filesize):
+        '''Return True if the CKAN resource dict `existing` has `file_hash`
+        and, where CKAN recorded one, `filesize`.'''
+        if not file_hash or existing.get('hash') != file_hash:
+            return False
+        size = existing.get('size')
+        return size in (None, '') or int(size) == filesize
+
+    @staticmethod
+    def _url_resources(datapackage):
+        '''Return the CKAN resource dicts of the non-streaming resources of
+        `datapackage`.'''
+        url_resources = []
+        for resource in datapackage['resources']:
+            if resource.get('dpp:streaming', False):
+                continue
+            resource_metadata = {
+                'url': resource['dpp:streamedFrom'],
+                'name': resource['name'],
+            }
+            if 'format' in resource:
+                resource_metadata.update({'format': resource['format']})
+            url_resources.append(resource_metadata)
+        return url_resources
+
+    @staticmethod
+    def _merge_resources(resources, url_resources):
+        '''Return the CKAN resource dicts `resources`, updated in place by
+        name with `url_resources`, followed by the new ones.'''
+        by_name = dict((r['name'], r) for r in url_resources)
+        merged = []
+        for resource in resources:
+            resource_metadata = by_name.pop(resource['name'], None)
+            if resource_metadata is not None:
+                resource = dict(resource, **resource_metadata)
+            merged.append(resource)
+        return merged + [r for r in url_resources if r['name'] in by_name]
+
+    @staticmethod
+    def _resource_changes(existing, resource_metadata):
+        '''Return the fields of `resource_metadata` that differ from the CKAN
+        resource dict `existing`, with its id, for resource_patch, or an
+        empty dict if none do. Upload fields and empty values are ignored,
+        and formats are compared regardless of case, as CKAN changes it.'''
+        changes = {}
+        for key, value in resource_metadata.items():
+            if key in ('id', 'package_id', 'url_type') or \
+               (key == 'url' and resource_metadata.get('url_type')):
+                continue
+            compared, current = value, existing.get(key)
+            if key == 'format' and compared and current:
+                # e.g. CKAN stores 'csv' as 'CSV'
+                compared, current = compared.lower(), current.lower()
+            if (compared if compared != '' else None) != \
+                    (current if current != '' else None):
+                changes[key] = value
+        if changes:
+            changes['id'] = existing['id']
+        return changes
+
+    def _delete_removed_resources(self, datapackage):
+        '''Delete the existing CKAN resources that are no longer in the
+        datapackage.'''
+        names = set(resource['name'] for resource in datapackage['resources'])
+        removed = [existing for name, existing
+                   in sorted(self.__existing_resources.items())
+                   if name not in names]
+        for existing in removed:
+            log.info('CKAN resource {} is no longer in the datapackage, '
+                     'deleting it.'.format(existing['name']))
+        self._map(lambda existing: self._ckan_resource_action(
+            'resource_delete', {'json': {'id': existing['id']}}), removed)
+        self.__deleted_resources += len(removed)
+
+    @staticmethod
+    def _extras(dataset):
+        '''Return the extras of a CKAN dataset dict as a dict.'''
+        return dict((extra['key'], extra['value'])
+                    for extra in dataset.get('extras', []))
+
+    @classmethod
+    def _dataset_changes(cls, existing, dataset):
+        '''Return the fields of `dataset` that differ from the CKAN dataset
+        dict `existing`, for package_patch. Extras are merged with the
+        existing ones, and empty values are treated as equal.'''
+        changes = {}
+        for key, value in dataset.items():
+            current = existing.get(key)
+            if key == 'extras':
+                extras = cls._extras(existing)
+                merged = dict(extras, **cls._extras(dataset))
+                if merged != extras:
+                    changes[key] = [{'key': k, 'value': v}
+                                    for k, v in sorted(merged.items())]
+            elif key in ('tags', 'groups'):
+                if sorted(item['name'] for item in value) != \
+                   sorted(item['name'] for item in current or []):
+                    changes[key] = value
+            elif key == 'owner_org':
+                organization = existing.get('organization') or {}
+                if value is not None and \
+                   value not in (current, organization.get('name')):
+                    changes[key] = value
+            elif (value if value != '' else None) != \
+                    (current if current != '' else None):
+                changes[key] = value
+        return changes
+
+    @staticmethod
+    def _dataset_hash(dataset, datapackage, url_resources):
+        '''Return a hash of the `dataset` dict, with the `url_resources` sent
+        along with it, as they would be sent to CKAN, and of the names of the
+        resources of `datapackage`, so that removing one changes it.'''
+        names = sorted(r['name'] for r in datapackage['resources'])
+        return hashlib.md5(json.dumps(
+            [dict(dataset, resources=url_resources), names],
+            sort_keys=True, ensure_ascii=True).encode('ascii')).hexdigest()
+
+    def _update_dataset_hashes(self):
+        '''Record the dataset hash in the dataset extras, unless it is
+        already there. The dataset is unchanged if it was, and no resource
+        was written.'''
+        extras = self._extras({'extras': self.__dataset_extras})
+        if extras.get(DATASET_HASH_EXTRA) == self.__dataset_hash:
+            self.__dataset_unchanged = self.__resource_writes == 0
+            return
+        extras[DATASET_HASH_EXTRA] = self.__dataset_hash
+
+        package_patch_url = '{}/package_patch'.format(self.__base_endpoint)
+        response = make_ckan_request(
+            package_patch_url,
+            method='POST',
+            json={
+                'id': self.__dataset_id,
+                'extras': [{'key': key, 'value': value}
+                           for key, value in sorted(extras.items())]
+            },
+            api_key=self.__ckan_api_key)
+        ckan_error = get_ckan_error(response)
+        if ckan_error:
+            log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
+            raise Exception
+
+    def _show_dataset(self, name_or_id):
+        '''Return the CKAN dataset dict for `name_or_id`, or None if it does
+        not exist.'''
+        package_show_url = '{}/package_show'.format(self.__base_endpoint)
+        response = make_ckan_request(package_show_url,
+                                     params=dict(id=name_or_id),
+                                     api_key=self.__ckan_api_key)
+        ckan_error = get_ckan_error(response)
+        if ckan_error:
+            if ckan_error.get('__type') == 'Not Found Error':
+                return None
+            log.exception('CKAN returned an error: ' + json.dumps(ckan_error))
+            raise Exception
+        return response['result']
+
+    def _map(self, function, items):
+        '''Call `function` with each of `items`, concurrently if the async
+        engine is used, and return the results in order.'''
+        if self.__async_client is not None:
+            return self.__async_client.map(function, items)
+        return [function(item) for item in items]
 
     def _create_ckan_resource(self, request_params):
-        resource_create_url = '{}/resource_create'.format(self.__base_endpoint)
+        return self._ckan_resource_action('resource_create', request_params)
+
+    def _patch_ckan_resource(self, request_params):
+        return self._ckan_resource_action('resource_patch', request_params)
 
-        create_response = make_ckan_request(resource_create_url,
+    def _ckan_resource_action(self, action, request_params,
+                              allow_not_found=False):
+        resource_action_url = '{}/{}'.format(self.__base_endpoint, action)
+
+        action_response = make_ckan_request(resource_action_url,
                                             api_key=self.__ckan_api_key,
                                             method='POST',
                                             **request_params)
 
-        ckan_error = get_ckan_error(create_response)
+        with self.__upload_stats_lock:
+            self.__resource_writes += 1
+
+        ckan_error = get_ckan_error(action_response)
+        if ckan_error and allow_not_found \
+           and ckan_error.get('__type') == 'Not Found Error':
+            return None
         if ckan_error:
-            log.exception('CKAN returned an error when creating '
-                          'a resource: ' + json.dumps(ckan_error))
+            log.exception('CKAN returned an error when calling '
+                          '{}: {}'.format(action, json.dumps(ckan_error)))
             raise Exception
-        return create_response['result']
+        return action_response['result']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import os
+import time
+import random
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Processor parameters, and the environment variables used when they are
+# not given
+PROFILE_PARAMETERS = {
+    'profile-file': 'CKAN_PROFILE_FILE',
+    'profile-tracemalloc-top': 'CKAN_PROFILE_TRACEMALLOC_TOP',
+    'profile-slow-requests': 'CKAN_PROFILE_SLOW_REQUESTS',
+    'profile-slow-requests-sample-rate':
+        'CKAN_PROFILE_SLOW_REQUESTS_SAMPLE_RATE'
+}
+
+_slow_requests = None
+
+
+class SlowRequestLog(object):
+    '''Log the CKAN requests that take at least `threshold` seconds, or a
+    `sample_rate` share of them.'''
+
+    def __init__(self, threshold, sample_rate=1.0):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+
+    def record(self, method, url, latency, outcome):
+        '''Log a request to `url` that took `latency` seconds if it was slow,
+        with its status code or error as the `outcome`.'''
+        if latency < self.threshold or random.random() >= self.sample_rate:
+            return
+        log.warning('Slow CKAN request: {} {} took {:.2f}s ({})'.format(
+            method, url, latency, outcome))
+
+
+def get_slow_request_log():
+    '''Return the SlowRequestLog of the running Profiler, or None.'''
+    return _slow_requests
+
+
+class Profiler(object):
+    '''Opt-in profiling of a processor run. All of it is off by default.
+
+    If `profile_file` is given, the run is profiled with cProfile and the
+    stats are dumped to it in pstats format. `{pid}` and `{timestamp}` in
+    the path are replaced, to keep a file per run. If `tracemalloc_top` is
+    given, memory allocations are traced and that many of the top
+    allocating lines are logged at each `snapshot()`. If `slow_requests` is
+    given, CKAN requests that take at least that many seconds are logged,
+    or a `slow_requests_sample_rate` share of them.'''
+
+    def __init__(self, profile_file=None, tracemalloc_top=0,
+                 slow_requests=None, slow_requests_sample_rate=1.0):
+        self.profile_file = profile_file
+        self.tracemalloc_top = int(tracemalloc_top or 0)
+        self.slow_requests = None
+        if slow_requests is not None:
+            self.slow_requests = SlowRequestLog(
+                float(slow_requests), float(slow_requests_sample_rate))
+        self.__profile = None
+        self.__tracing_started = False
+
+    @classmethod
+    def from_parameters(cls, parameters, pop=False):
+        '''Return a Profiler configured by the profile-* `parameters`, or
+        their environment variables, removing the parameters if `pop`.'''
+        options = {}
+        for name, variable in PROFILE_PARAMETERS.items():
+            value = parameters.pop(name, None) if pop \
+                else parameters.get(name)
+            if value is None:
+                value = os.environ.get(variable) or None
+            options[name] = value
+        return cls(
+            profile_file=options['profile-file'],
+            tracemalloc_top=options['profile-tracemalloc-top'],
+            slow_requests=options['profile-slow-requests'],
+            slow_requests_sample_rate=(
+                options['profile-slow-requests-sample-rate'] or 1.0))
+
+    @property
+    def tracing(self):
+        return self.tracemalloc_top > 0
+
+    def start(self):
+        global _slow_requests
+        # The profilers are only imported when used, to start up faster
+        if self.profile_file:
+            import cProfile
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        if self.tracing:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__tracing_started = True
+        if self.slow_requests is not None:
+            _slow_requests = self.slow_requests
+
+    def snapshot(self, label):
+        '''Log the lines that allocated the most memory still in use.'''
+        if not self.tracing:
+            return
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        statistics = snapshot.statistics('lineno')
+        log.info('Top {} memory allocations after {}:'.format(
+            self.tracemalloc_top, label))
+        for statistic in statistics[:self.tracemalloc_top]:
+            log.info('  {}'.format(statistic))
+
+    def trace(self, rows, label):
+        '''Yield `rows`, then log a snapshot labelled `label`.'''
+        for row in rows:
+            yield row
+        self.snapshot(label)
+
+    def stop(self):
+        '''Stop profiling, and dump the profile.'''
+        global _slow_requests
+        if self.__profile is not None:
+            self.__profile.disable()
+            path = self.profile_file.format(
+                pid=os.getpid(),
+                timestamp=time.strftime('%Y%m%dT%H%M%S'))
+            self.__profile.dump_stats(path)
+            log.info('Wrote profile to {}'.format(path))
+            self.__profile = None
+        if self.__tracing_started:
+            import tracemalloc
+            tracemalloc.stop()
+            self.__tracing_started = False
+        if self.slow_requests is not None:
+            _slow_requests = None
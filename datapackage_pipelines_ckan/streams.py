@@ -0,0 +1,382 @@
+import io
+import os
+import time
+import zlib
+import queue
+import hashlib
+import binascii
+
+
+HASH_ALGORITHMS = ['md5', 'sha256', 'blake2b']
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# The text writers flush about 8KB at a time, so a pipe holds about 1MB
+DEFAULT_PIPE_CHUNKS = 128
+PIPE_POLL_INTERVAL = 0.1
+
+
+class HashingWriter(io.RawIOBase):
+    '''A writable binary stream that hashes and counts the bytes written to
+    it on their way to `stream`. If `algorithm` is None only the size is
+    kept. If `compresslevel` is given, the bytes are gzip-compressed on the
+    way, and the hash and size are those of the compressed bytes. The
+    seconds spent hashing and compressing are kept in `hash_seconds` and
+    `compress_seconds`.'''
+
+    def __init__(self, stream, algorithm='md5', compresslevel=None):
+        super(HashingWriter, self).__init__()
+        self.stream = stream
+        self.size = 0
+        self.hasher = hashlib.new(algorithm) if algorithm else None
+        self.hash_seconds = 0.0
+        self.compress_seconds = 0.0
+        self.compressor = None
+        if compresslevel is not None:
+            # A gzip stream, with no file name or time in its header so that
+            # the same content always compresses to the same bytes
+            self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+
+    @property
+    def name(self):
+        return self.stream.name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        if self.compressor is not None:
+            started = time.perf_counter()
+            data = self.compressor.compress(data)
+            self.compress_seconds += time.perf_counter() - started
+        self._write(data)
+        return size
+
+    def _write(self, data):
+        if self.hasher is not None:
+            started = time.perf_counter()
+            self.hasher.update(data)
+            self.hash_seconds += time.perf_counter() - started
+        self.stream.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        super(HashingWriter, self).flush()
+        self.stream.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.compressor is not None:
+                    self._write(self.compressor.flush())
+                super(HashingWriter, self).close()
+            finally:
+                self.stream.close()
+
+    def hexdigest(self):
+        '''Return the hex digest of the bytes written so far, or None if
+        hashing is disabled.'''
+        if self.hasher is None:
+            return None
+        return self.hasher.hexdigest()
+
+
+class BoundedPipe(io.RawIOBase):
+    '''A binary pipe from a writing thread to a reading thread. At most
+    `max_chunks` written chunks are held, and writes block while the pipe is
+    full, so a slow reader slows the writer down. Closing the pipe marks the
+    end of the data for the reader, and `abort()` makes both ends fail.'''
+
+    def __init__(self, max_chunks=DEFAULT_PIPE_CHUNKS):
+        super(BoundedPipe, self).__init__()
+        self.__chunks = queue.Queue(maxsize=max_chunks)
+        self.__buffer = b''
+        self.__eof = False
+        self.__finished = False
+        self.__aborted = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._put(bytes(data))
+        return len(data)
+
+    def close(self):
+        super(BoundedPipe, self).close()
+        self.__finished = True
+
+    def abort(self):
+        '''Stop the transfer: pending and further writes and reads raise
+        BrokenPipeError.'''
+        self.__aborted = True
+
+    def read(self, size=-1):
+        '''Return up to `size` bytes, waiting for the writer if the pipe is
+        empty, or all the bytes up to the end if `size` is negative. Return
+        b'' at the end of the data.'''
+        chunks = []
+        while not self.__eof and (not self.__buffer or size is None or
+                                  size < 0):
+            chunks.append(self.__buffer)
+            self.__buffer = self._get()
+            if self.__buffer is None:
+                self.__buffer = b''
+                self.__eof = True
+        if size is None or size < 0:
+            size = len(self.__buffer)
+        chunks.append(self.__buffer[:size])
+        self.__buffer = self.__buffer[size:]
+        return b''.join(chunks)
+
+    def _put(self, chunk):
+        while True:
+            if self.__aborted:
+                raise BrokenPipeError('The pipe was aborted')
+            try:
+                self.__chunks.put(chunk, timeout=PIPE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self):
+        while True:
+            if self.__aborted:
+                raise BrokenPipeError('The pipe was aborted')
+            # Chunks are all queued before the writer finishes
+            finished = self.__finished
+            try:
+                return self.__chunks.get(block=not finished,
+                                         timeout=PIPE_POLL_INTERVAL)
+            except queue.Empty:
+                if finished:
+                    return None
+
+
+class FileSlice(io.RawIOBase):
+    '''A readable, seekable view of `length` bytes of the file at `path`,
+    starting at `offset`.'''
+
+    def __init__(self, path, offset, length):
+        super(FileSlice, self).__init__()
+        self.file = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.__position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.__position = min(max(offset, 0), self.length)
+        return self.__position
+
+    def read(self, size=-1):
+        remaining = self.length - self.__position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self.file.seek(self.offset + self.__position)
+        data = self.file.read(size)
+        self.__position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            super(FileSlice, self).close()
+            self.file.close()
+
+
+class MultipartEncoder(io.RawIOBase):
+    '''A readable multipart/form-data body made of the form `fields` and the
+    `files` of a request, in the forms requests accepts. File contents are
+    read from their streams as the body is read, so the whole body is never
+    held in memory. `callback`, if given, is called with the number of bytes
+    read each time part of the body is read.
+
+    Files may be unseekable streams such as a BoundedPipe, and
+    `late_fields`, a function returning more form fields, is only called
+    once the files have been read, e.g. to send their hash. The body then
+    has no known length and can only be read once.'''
+
+    def __init__(self, fields=None, files=None, callback=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, late_fields=None):
+        super(MultipartEncoder, self).__init__()
+        self.boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.content_type = \
+            'multipart/form-data; boundary={}'.format(self.boundary)
+        self.callback = callback
+        self.chunk_size = chunk_size
+        self.__parts = []
+        self.__index = 0
+        self.__offset = 0
+        self.__position = 0
+
+        self._add_bytes(self._render_fields(fields))
+
+        if isinstance(files, dict):
+            files = files.items()
+        for name, value in files or []:
+            filename, content_type = name, None
+            if isinstance(value, (tuple, list)):
+                if len(value) > 2:
+                    content_type = value[2]
+                filename, value = value[0], value[1]
+            self._add_bytes(
+                self._part_headers(name, filename, content_type))
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            if isinstance(value, bytes):
+                self._add_bytes(value)
+            else:
+                self._add_stream(value)
+            self._add_bytes(b'\r\n')
+
+        if late_fields is not None:
+            self.__parts.append(
+                (lambda: self._render_fields(late_fields()), 0, None))
+        self._add_bytes('--{}--\r\n'.format(self.boundary).encode('ascii'))
+
+        lengths = [length for _, _, length in self.__parts]
+        self.len = None if None in lengths else sum(lengths)
+
+    def _render_fields(self, fields):
+        if isinstance(fields, dict):
+            fields = fields.items()
+        rendered = []
+        for name, values in fields or []:
+            if isinstance(values, (str, bytes)) \
+               or not hasattr(values, '__iter__'):
+                values = [values]
+            for value in values:
+                if value is None:
+                    continue
+                if not isinstance(value, bytes):
+                    value = str(value).encode('utf-8')
+                rendered.append(self._part_headers(name) + value + b'\r\n')
+        return b''.join(rendered)
+
+    def _part_headers(self, name, filename=None, content_type=None):
+        disposition = 'form-data; name="{}"'.format(_quote(name))
+        if filename is not None:
+            disposition += '; filename="{}"'.format(_quote(filename))
+        headers = '--{}\r\nContent-Disposition: {}\r\n'.format(
+            self.boundary, disposition)
+        if content_type:
+            headers += 'Content-Type: {}\r\n'.format(content_type)
+        return (headers + '\r\n').encode('utf-8')
+
+    def _add_bytes(self, data):
+        if data:
+            self.__parts.append((data, 0, len(data)))
+
+    def _add_stream(self, stream):
+        if not stream.seekable():
+            self.__parts.append((stream, 0, None))
+            return
+        start = stream.tell()
+        length = stream.seek(0, io.SEEK_END) - start
+        stream.seek(start)
+        self.__parts.append((stream, start, length))
+
+    def __len__(self):
+        if self.len is None:
+            raise TypeError('The multipart body has no known length')
+        return self.len
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.len is not None
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self.seekable():
+            raise io.UnsupportedOperation('seek')
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.len
+        self.__position = min(max(offset, 0), self.len)
+        self.__index, self.__offset = 0, self.__position
+        while self.__index < len(self.__parts) \
+                and self.__offset >= self.__parts[self.__index][2]:
+            self.__offset -= self.__parts[self.__index][2]
+            self.__index += 1
+        return self.__position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        chunks = []
+        while size != 0 and self.__index < len(self.__parts):
+            data, start, length = self.__parts[self.__index]
+            if callable(data):
+                data = data()
+                self.__parts[self.__index] = (data, 0, len(data))
+                continue
+            chunk = self._read_part(data, start, length, size)
+            chunks.append(chunk)
+            self.__offset += len(chunk)
+            self.__position += len(chunk)
+            if size is not None:
+                size -= len(chunk)
+            if not chunk or self.__offset == length:
+                self.__index += 1
+                self.__offset = 0
+        chunk = b''.join(chunks)
+        if chunk and self.callback is not None:
+            self.callback(len(chunk))
+        return chunk
+
+    def _read_part(self, data, start, length, size):
+        '''Read up to `size` bytes, or the rest, of the current part.'''
+        count = size
+        if length is not None:
+            remaining = length - self.__offset
+            count = remaining if size is None else min(size, remaining)
+        if isinstance(data, bytes):
+            return data[self.__offset:self.__offset + count]
+        if length is None:
+            return data.read(-1 if count is None else count)
+        data.seek(start + self.__offset)
+        chunk = data.read(count)
+        if len(chunk) != count:
+            raise IOError('Upload file changed while reading')
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _quote(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
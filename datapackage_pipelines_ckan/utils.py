@@ -1,15 +1,246 @@
 import os
 import json
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from datapackage_pipelines_ckan.streams import MultipartEncoder
+from datapackage_pipelines_ckan.metrics import get_metrics
+from datapackage_pipelines_ckan.profiling import get_slow_request_log
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def make_ckan_request(url, method='GET', headers=None, api_key=None, **kwargs):
-    '''Make a CKAN API request to `url` and return the json response. **kwargs
-    are passed to requests.request()'''
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 60
+
+# Responses for which CKAN (or the proxy in front of it) did not process the
+# request, so any request may be sent again.
+THROTTLE_STATUSES = (429, 503)
+# Responses and errors after which the request may or may not have been
+# processed, so only idempotent requests are sent again.
+RETRY_STATUSES = (500, 502, 504)
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+# Actions that can be repeated without changing the result.
+IDEMPOTENT_ACTION_SUFFIXES = ('_show', '_list', '_search', '_read',
+                              '_patch', '_update')
+IDEMPOTENT_ACTIONS = ('datastore_delete', 'resource_delete',
+                      'package_delete', 'status_show')
+
+_session_options = {
+    'pool_size': DEFAULT_POOL_SIZE,
+    'keep_alive': True,
+    'connect_timeout': None,
+    'read_timeout': None,
+    'max_retries': DEFAULT_MAX_RETRIES,
+    'backoff_factor': DEFAULT_BACKOFF_FACTOR
+}
+_sessions = {}
+_sessions_lock = threading.Lock()
+_limiter = None
+
+
+class AdaptiveLimiter(object):
+    '''Limit the number of CKAN requests in flight, adjusting the limit
+    between 1 and `max_concurrency` with additive increase and
+    multiplicative decrease: each successful request raises the limit by
+    1/limit, while a throttled or failed request, or one much slower than
+    usual for its action, halves it.'''
+
+    LATENCY_FACTOR = 3
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.__latencies = {}
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while self.in_flight >= int(self.limit):
+                self.__condition.wait()
+            self.in_flight += 1
+
+    def release(self, action, latency, ok):
+        '''Finish a request to `action` that took `latency` seconds, and
+        adjust the limit by whether it was `ok`.'''
+        with self.__condition:
+            self.in_flight -= 1
+            average = self.__latencies.get(action)
+            slow = average is not None \
+                and latency > average * self.LATENCY_FACTOR
+            if ok:
+                self.__latencies[action] = latency if average is None \
+                    else average + (latency - average) * \
+                    self.LATENCY_SMOOTHING
+            if ok and not slow:
+                self.limit = min(self.limit + 1 / self.limit,
+                                 self.max_concurrency)
+            else:
+                self.limit = max(self.limit / 2, 1)
+            self.__condition.notify_all()
+
+
+def configure_ckan_sessions(pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                            connect_timeout=None, read_timeout=None,
+                            max_retries=DEFAULT_MAX_RETRIES,
+                            backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                            max_concurrency=None):
+    '''Set the options used by the pooled per-host sessions. Any open sessions
+    are closed, so the next request to each host picks up the new options.'''
+    global _limiter
+    with _sessions_lock:
+        _session_options.update({
+            'pool_size': int(pool_size),
+            'keep_alive': bool(keep_alive),
+            'connect_timeout': connect_timeout,
+            'read_timeout': read_timeout,
+            'max_retries': int(max_retries),
+            'backoff_factor': float(backoff_factor)
+        })
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _limiter = AdaptiveLimiter(max_concurrency) \
+            if max_concurrency else None
+
+
+def get_ckan_session(url):
+    '''Return the pooled requests.Session used for the host of `url`,
+    creating it on first use.'''
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = _session_options['pool_size']
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not _session_options['keep_alive']:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+    return session
+
+
+def get_ckan_timeout():
+    '''Return the (connect, read) timeout tuple for CKAN requests, or None if
+    no timeout is configured.'''
+    connect_timeout = _session_options['connect_timeout']
+    read_timeout = _session_options['read_timeout']
+    if connect_timeout is None and read_timeout is None:
+        return None
+    return (connect_timeout, read_timeout)
+
+
+def is_idempotent(url, method):
+    '''Return True if the request can be repeated without changing the
+    result.'''
+    if method.upper() in ('GET', 'HEAD', 'OPTIONS'):
+        return True
+    action = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    return action in IDEMPOTENT_ACTIONS \
+        or action.endswith(IDEMPOTENT_ACTION_SUFFIXES)
+
+
+def get_retry_delay(response, attempt):
+    '''Return the seconds to wait before retry number `attempt`: the
+    response's Retry-After if it has one, or an exponential backoff with
+    full jitter.'''
+    retry_after = response.headers.get('Retry-After') \
+        if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp()
+                       - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+    backoff = _session_options['backoff_factor'] * (2 ** attempt)
+    return random.uniform(0, min(backoff, MAX_BACKOFF))
+
+
+def send_ckan_request(url, method='GET', headers=None, api_key=None,
+                      idempotent=None, upload_progress=None, **kwargs):
+    '''Make a CKAN API request to `url` and return the requests.Response.
+    **kwargs are passed to requests.Session.request()
 
+    `files` are streamed from disk in a multipart body instead of being read
+    into memory, and `upload_progress`, if given, is called with the number
+    of bytes sent as the body is sent. `data` may also be a
+    MultipartEncoder.
+
+    Throttled requests (429 and 503 responses) are retried, as long as any
+    uploaded file can be rewound. Idempotent requests are also retried on
+    connection errors, timeouts and server errors. Whether a request is
+    idempotent is guessed from its method and action unless `idempotent` is
+    given.
+
+    Each attempt is recorded in the current Metrics, with its latency and
+    the bytes sent and received, and logged if it was slow and slow requests
+    are being profiled.'''
+
+    headers, encoder = _prepare_request(headers, api_key, upload_progress,
+                                        kwargs)
+
+    if idempotent is None:
+        idempotent = is_idempotent(url, method)
+    # A streamed body can only be sent again if it can be rewound
+    body = encoder if encoder is not None else kwargs.get('data')
+    if not hasattr(body, 'read'):
+        body = None
+    replayable = body is None or body.seekable()
+    position = body.tell() if body is not None and replayable else None
+    max_retries = _session_options['max_retries']
+
+    attempt = 0
+    while True:
+        response, error = _send_attempt(url, method, headers, encoder,
+                                        kwargs)
+
+        if response is not None:
+            status = response.status_code
+            retry = (status in THROTTLE_STATUSES and replayable) or \
+                (status in RETRY_STATUSES and idempotent and replayable)
+        else:
+            retry = idempotent and replayable
+
+        if not retry or attempt >= max_retries:
+            if error is not None:
+                raise error
+            return response
+
+        delay = get_retry_delay(response, attempt)
+        log.warning('CKAN request to {} failed ({}), retrying in {:.1f}s'
+                    .format(url, error or response.status_code, delay))
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+        if position is not None:
+            body.seek(position)
+        attempt += 1
+
+
+def _prepare_request(headers, api_key, upload_progress, kwargs):
+    '''Return the headers of a request and the MultipartEncoder of its
+    body, if it has one, setting the timeout and multipart body in
+    `kwargs`.'''
     if headers is None:
         headers = {}
 
@@ -18,8 +249,89 @@ def make_ckan_request(url, method='GET', headers=None, api_key=None, **kwargs):
             api_key = os.environ.get(api_key[4:])
         headers.update({'Authorization': api_key})
 
-    response = requests.request(method=method, url=url, headers=headers,
-                                allow_redirects=True, **kwargs)
+    kwargs.setdefault('timeout', get_ckan_timeout())
+
+    if kwargs.get('files'):
+        kwargs['data'] = MultipartEncoder(kwargs.pop('data', None),
+                                          kwargs.pop('files'),
+                                          callback=upload_progress)
+    encoder = kwargs.get('data')
+    if not isinstance(encoder, MultipartEncoder):
+        return headers, None
+    headers['Content-Type'] = encoder.content_type
+    if encoder.len is None:
+        # Send a body of unknown length with chunked transfer encoding
+        kwargs['data'] = iter(encoder)
+    return headers, encoder
+
+
+def _send_attempt(url, method, headers, encoder, kwargs):
+    '''Send one attempt of a request, and return its response, or the
+    error it failed with, after recording it in the current Metrics and
+    the slow request log.'''
+    response = None
+    error = None
+    action = urlsplit(url).path.rsplit('/', 1)[-1]
+    limiter = _limiter
+    if limiter is not None:
+        limiter.acquire()
+    started = time.time()
+    sent = encoder.tell() if encoder is not None else 0
+    try:
+        response = get_ckan_session(url).request(
+            method=method, url=url, headers=headers,
+            allow_redirects=True, **kwargs)
+    except RETRY_EXCEPTIONS as e:
+        error = e
+    finally:
+        latency = time.time() - started
+        ok = response is not None and response.status_code < 500 and \
+            response.status_code != 429
+        if limiter is not None:
+            limiter.release(action, latency, ok)
+        if encoder is not None:
+            request_bytes = encoder.tell() - sent
+        else:
+            request_bytes = _body_size(response)
+        get_metrics().record_request(
+            action, latency, request_bytes,
+            _content_size(response, kwargs.get('stream')), ok)
+        slow_requests = get_slow_request_log()
+        if slow_requests is not None:
+            slow_requests.record(
+                method, url, latency,
+                response.status_code if response is not None else error)
+    return response, error
+
+
+def _body_size(response):
+    '''Return the size of the body sent for `response`.'''
+    if response is None:
+        return 0
+    body = response.request.body
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    return len(body) if isinstance(body, bytes) else 0
+
+
+def _content_size(response, stream=False):
+    '''Return the size of the body of `response`, without reading it if it
+    is streamed.'''
+    if response is None:
+        return 0
+    if stream:
+        return int(response.headers.get('Content-Length') or 0)
+    return len(response.content)
+
+
+def make_ckan_request(url, method='GET', headers=None, api_key=None,
+                      idempotent=None, upload_progress=None, **kwargs):
+    '''Make a CKAN API request to `url` and return the json response. **kwargs
+    are passed to requests.Session.request()'''
+
+    response = send_ckan_request(url, method=method, headers=headers,
+                                 api_key=api_key, idempotent=idempotent,
+                                 upload_progress=upload_progress, **kwargs)
 
     try:
         return response.json()
@@ -0,0 +1,76 @@
+import re
+import hashlib
+import collections
+
+
+def parse_multipart(body, content_type):
+    '''Return the fields of a multipart/form-data body, as bytes.'''
+    boundary = content_type.split('boundary=')[1].encode('ascii')
+    fields = {}
+    for part in body.split(b'--' + boundary)[1:-1]:
+        headers, _, value = part[2:-2].partition(b'\r\n\r\n')
+        name = re.search(b'name="([^"]*)"', headers).group(1)
+        fields[name.decode('utf-8')] = value
+    return fields
+
+
+class MockCloudStorage(object):
+    '''A stand-in for the multipart upload API of ckanext-cloudstorage,
+    served through requests_mock. The first attempts to upload the parts in
+    `fail_parts` get a 503 response, and parts in `reject_parts` always get
+    a CKAN error.'''
+
+    def __init__(self, mock_request, base_url, fail_parts=(),
+                 reject_parts=()):
+        self.uploads = {}
+        self.files = {}
+        self.aborted = []
+        self.attempts = collections.Counter()
+        self.fail_parts = set(fail_parts)
+        self.reject_parts = set(reject_parts)
+        for action, callback in [
+                ('cloudstorage_initiate_multipart', self.initiate),
+                ('cloudstorage_upload_multipart', self.upload_part),
+                ('cloudstorage_finish_multipart', self.finish),
+                ('cloudstorage_abort_multipart', self.abort)]:
+            mock_request.post(base_url + action, json=callback)
+
+    def initiate(self, request, context):
+        data = request.json()
+        upload_id = 'upload-{}'.format(len(self.uploads))
+        self.uploads[upload_id] = dict(data, parts={})
+        return {'success': True, 'result': {
+            'id': upload_id,
+            'name': data['name'],
+            'resource_id': data['id']
+        }}
+
+    def upload_part(self, request, context):
+        fields = parse_multipart(request.body.read(),
+                                 request.headers['Content-Type'])
+        part_number = int(fields['partNumber'])
+        self.attempts[part_number] += 1
+        if part_number in self.fail_parts:
+            self.fail_parts.remove(part_number)
+            context.status_code = 503
+            return {'success': False, 'error': {'message': 'Unavailable'}}
+        if part_number in self.reject_parts:
+            return {'success': False, 'error': {'__type': 'Upload Error'}}
+        upload = self.uploads[fields['uploadId'].decode('utf-8')]
+        upload['parts'][part_number] = fields['upload']
+        return {'success': True, 'result': {
+            'partNumber': part_number,
+            'ETag': hashlib.md5(fields['upload']).hexdigest()
+        }}
+
+    def finish(self, request, context):
+        upload = self.uploads.pop(request.json()['uploadId'])
+        content = b''.join(upload['parts'][part_number]
+                           for part_number in sorted(upload['parts']))
+        assert len(content) == upload['size']
+        self.files[upload['id']] = content
+        return {'success': True, 'result': {'commited': True}}
+
+    def abort(self, request, context):
+        self.aborted.append(request.json()['id'])
+        return {'success': True, 'result': None}
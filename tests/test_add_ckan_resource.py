@@ -1,5 +1,7 @@
 import os
 import json
+import shutil
+import tempfile
 import unittest
 
 import requests_mock
@@ -38,6 +40,33 @@ MOCK_CKAN_RESPONSE = {
     }
 }
 
+MOCK_CKAN_PACKAGE_RESPONSE = {
+    'success': True,
+    'result': {
+        'id': 'b9076e40-80ea-480b-b330-e399d7a8c09b',
+        'name': 'newcastle-spend',
+        'resources': [{
+            'id': 'resource-01',
+            'name': 'January 2012',
+            'format': 'CSV',
+            'hash': '',
+            'url': 'http://example.com/january_2012.csv'
+        }, {
+            'id': 'resource-02',
+            'name': 'February 2012',
+            'format': 'CSV',
+            'hash': '',
+            'url': 'http://example.com/february_2012.csv'
+        }, {
+            'id': 'resource-03',
+            'name': 'Notes',
+            'format': 'PDF',
+            'hash': '',
+            'url': 'http://example.com/notes.pdf'
+        }]
+    }
+}
+
 MOCK_CKAN_NOT_FOUND = {
     'success': False,
     'error':  {
@@ -132,6 +161,44 @@ class TestAddCkanResourceProcessor(unittest.TestCase):
         request_history = mock_request.request_history
         assert request_history[0].headers['Authorization'] == 'my-api-key'
 
+    @requests_mock.mock()
+    def test_add_ckan_resource_processor_connection_options(self,
+                                                            mock_request):
+
+        mock_request.get('https://demo.ckan.org/api/3/action/resource_show',
+                         json=MOCK_CKAN_RESPONSE)
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'resource-id': 'd51c9bd4-8256-4289-bdd7-962f8572efb0',
+            'ckan-pool-size': 2,
+            'ckan-keep-alive': False,
+            'ckan-read-timeout': 30
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'add_ckan_resource.py')
+
+        spew_args, _ = mock_processor_test(processor_path,
+                                           (params, datapackage, []))
+
+        # connection options are consumed, not added to the resource
+        dp_resource = spew_args[0]['resources'][0]
+        assert 'ckan-pool-size' not in dp_resource
+        assert 'ckan-read-timeout' not in dp_resource
+
+        request_history = mock_request.request_history
+        assert request_history[0].headers['Connection'] == 'close'
+        assert request_history[0].timeout == (None, 30)
+
     @requests_mock.mock()
     def test_add_ckan_resource_processor_invalid_json(self, mock_request):
 
@@ -212,3 +279,132 @@ class TestAddCkanResourceProcessor(unittest.TestCase):
         with self.assertRaises(Exception):
             spew_args, _ = mock_processor_test(processor_path,
                                                (params, datapackage, []))
+
+    @requests_mock.mock()
+    def test_add_ckan_resource_processor_resource_ids(self, mock_request):
+
+        resources = MOCK_CKAN_PACKAGE_RESPONSE['result']['resources']
+        for resource in resources:
+            mock_request.get(
+                'https://demo.ckan.org/api/3/action/resource_show'
+                '?id={}'.format(resource['id']),
+                json={'success': True, 'result': dict(resource)})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'resource-id': ['resource-03', 'resource-01', 'resource-02'],
+            'exclude': {'formats': ['pdf']},
+            'headers': 1
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'add_ckan_resource.py')
+
+        spew_args, _ = mock_processor_test(processor_path,
+                                           (params, datapackage, []))
+
+        dp_resources = spew_args[0]['resources']
+        assert [r['name'] for r in dp_resources] == \
+            ['january-2012', 'february-2012']
+        assert dp_resources[1]['dpp:streamedFrom'] == \
+            'http://example.com/february_2012.csv'
+        assert all(r['headers'] == 1 for r in dp_resources)
+        assert all('hash' not in r for r in dp_resources)
+        assert len(mock_request.request_history) == 3
+
+    @requests_mock.mock()
+    def test_add_ckan_resource_processor_dataset_id(self, mock_request):
+
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json=MOCK_CKAN_PACKAGE_RESPONSE)
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'dataset-id': 'newcastle-spend',
+            'include': {'formats': ['csv']},
+            'exclude': {'names': ['february-2012']}
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'add_ckan_resource.py')
+
+        spew_args, _ = mock_processor_test(processor_path,
+                                           (params, datapackage, []))
+
+        dp_resources = spew_args[0]['resources']
+        assert len(dp_resources) == 1
+        assert dp_resources[0]['name'] == 'january-2012'
+        assert dp_resources[0]['title'] == 'January 2012'
+        assert dp_resources[0]['format'] == 'csv'
+        assert 'include' not in dp_resources[0]
+
+        request_history = mock_request.request_history
+        assert len(request_history) == 1
+        assert request_history[0].qs == {'id': ['newcastle-spend']}
+
+    @requests_mock.mock()
+    def test_add_ckan_resource_processor_cache(self, mock_request):
+
+        resource_show_url = 'https://demo.ckan.org/api/3/action/resource_show'
+        mock_request.get(resource_show_url,
+                         json=MOCK_CKAN_RESPONSE,
+                         headers={'ETag': '"v1"'})
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'add_ckan_resource.py')
+
+        def run_processor(cache_ttl):
+            datapackage = {
+                'name': 'my-datapackage',
+                'project': 'my-project',
+                'resources': []
+            }
+            params = {
+                'ckan-host': 'https://demo.ckan.org',
+                'resource-id': 'd51c9bd4-8256-4289-bdd7-962f8572efb0',
+                'cache-dir': cache_dir,
+                'cache-ttl': cache_ttl
+            }
+            spew_args, _ = mock_processor_test(processor_path,
+                                               (params, datapackage, []))
+            return spew_args[0]['resources']
+
+        # first run fills the cache
+        dp_resources = run_processor(60)
+        assert dp_resources[0]['name'] == 'january-2012'
+        assert 'cache-dir' not in dp_resources[0]
+        assert len(mock_request.request_history) == 1
+
+        # a fresh entry is used without a request
+        assert run_processor(60) == dp_resources
+        assert len(mock_request.request_history) == 1
+
+        # a stale entry is revalidated, and kept on 304 Not Modified
+        mock_request.get(resource_show_url, status_code=304)
+        assert run_processor(0) == dp_resources
+        request_history = mock_request.request_history
+        assert len(request_history) == 2
+        assert request_history[1].headers['If-None-Match'] == '"v1"'
+        assert request_history[1].headers['If-Modified-Since'] == \
+            'Tue, 14 Aug 2012 12:39:35 GMT'
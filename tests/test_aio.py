@@ -0,0 +1,56 @@
+import time
+import threading
+import unittest
+
+import requests_mock
+
+from datapackage_pipelines_ckan.aio import AsyncCkanClient
+from datapackage_pipelines_ckan.utils import make_ckan_request
+
+
+class TestAsyncCkanClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = AsyncCkanClient(max_in_flight=3)
+        self.addCleanup(self.client.close)
+
+    def test_in_flight_limit(self):
+        lock = threading.Lock()
+        in_flight = []
+        most_in_flight = []
+
+        def call(i):
+            with lock:
+                in_flight.append(i)
+                most_in_flight.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(i)
+            return i * 2
+
+        assert self.client.map(call, range(12)) == \
+            [i * 2 for i in range(12)]
+        assert max(most_in_flight) == 3
+
+    def test_submit_error(self):
+        def fail():
+            raise ValueError('Failed')
+
+        future = self.client.submit(fail)
+        with self.assertRaises(ValueError):
+            future.result()
+
+    @requests_mock.mock()
+    def test_requests(self, mock_request):
+        url = 'https://demo.ckan.org/api/3/action/resource_show'
+        mock_request.get(url, json={'success': True, 'result': {}})
+
+        response = self.client.submit(make_ckan_request, url,
+                                      params={'id': 'a'}).result()
+        assert response == {'success': True, 'result': {}}
+
+        responses = self.client.map(
+            lambda i: make_ckan_request(url, params={'id': str(i)}),
+            range(5))
+        assert len(responses) == 5
+        assert mock_request.call_count == 6
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from datapackage_pipelines_ckan.cache import MetadataCache, get_modified
+
+HOST = 'https://demo.ckan.org'
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_set(self):
+        cache = MetadataCache(self.cache_dir, ttl=60)
+        assert cache.get(HOST, 'resource_show', 'r1') is None
+
+        cache.set(HOST, 'resource_show', 'r1', {'id': 'r1'}, etag='"abc"')
+        entry = cache.get(HOST, 'resource_show', 'r1')
+        assert entry['result'] == {'id': 'r1'}
+        assert entry['etag'] == '"abc"'
+        assert entry['fresh'] is True
+
+        # keyed by host and action as well as id
+        assert cache.get('https://other.org', 'resource_show', 'r1') is None
+        assert cache.get(HOST, 'package_show', 'r1') is None
+
+    def test_api_key(self):
+        cache = MetadataCache(self.cache_dir, api_key='key-1')
+        cache.set(HOST, 'package_show', 'd1', {'id': 'd1', 'private': True})
+        assert cache.get(HOST, 'package_show', 'd1') is not None
+
+        # keyed by the api key too
+        other_key = MetadataCache(self.cache_dir, api_key='key-2')
+        assert other_key.get(HOST, 'package_show', 'd1') is None
+        no_key = MetadataCache(self.cache_dir)
+        assert no_key.get(HOST, 'package_show', 'd1') is None
+
+    def test_stale(self):
+        cache = MetadataCache(self.cache_dir, ttl=0)
+        cache.set(HOST, 'resource_show', 'r1', {'id': 'r1'})
+        assert cache.get(HOST, 'resource_show', 'r1')['fresh'] is False
+
+    def test_conditional_headers(self):
+        cache = MetadataCache(self.cache_dir)
+        headers = cache.conditional_headers({
+            'etag': '"abc"',
+            'result': {'metadata_modified': '2012-08-14T12:39:35.638235'}
+        })
+        assert headers == {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Tue, 14 Aug 2012 12:39:35 GMT'
+        }
+        assert cache.conditional_headers({'result': {}}) == {}
+
+    def test_evict(self):
+        cache = MetadataCache(self.cache_dir, max_size=1000)
+        for i in range(20):
+            cache.set(HOST, 'resource_show', str(i), {'padding': 'x' * 100})
+            entry_path = cache._entry_path(HOST, 'resource_show', str(i))
+            os.utime(entry_path, (i, i))
+
+        sizes = [os.path.getsize(os.path.join(self.cache_dir, name))
+                 for name in os.listdir(self.cache_dir)]
+        assert sum(sizes) <= 1000
+        assert cache.get(HOST, 'resource_show', '19') is not None
+        assert cache.get(HOST, 'resource_show', '0') is None
+
+    def test_get_modified(self):
+        assert get_modified({'last_modified': '2012-08-14T12:39:35'}).year \
+            == 2012
+        assert get_modified({'last_modified': None}) is None
+        assert get_modified({'metadata_modified': 'nope'}) is None
@@ -0,0 +1,248 @@
+import os
+import decimal
+import shutil
+import tempfile
+import unittest
+
+import requests_mock
+
+from datapackage_pipelines_ckan.datastore import DatastoreWriter, RowSnapshot
+from datapackage_pipelines_ckan.aio import AsyncCkanClient
+
+BASE_ENDPOINT = 'https://demo.ckan.org/api/3/action'
+DATASTORE_UPSERT_URL = '{}/datastore_upsert'.format(BASE_ENDPOINT)
+DATASTORE_CREATE_URL = '{}/datastore_create'.format(BASE_ENDPOINT)
+DATASTORE_DELETE_URL = '{}/datastore_delete'.format(BASE_ENDPOINT)
+
+SCHEMA = {
+    'fields': [
+        {'name': 'id', 'type': 'integer'},
+        {'name': 'value', 'type': 'string'}
+    ],
+    'primaryKey': ['id']
+}
+
+
+class TestDatastoreWriter(unittest.TestCase):
+
+    @requests_mock.mock()
+    def test_batches(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=2)
+        writer.resource_id = 'ckan-resource-id'
+        for i in range(5):
+            writer.write({'id': i, 'value': str(i), 'extra': 'ignored'})
+        writer.close()
+
+        requests = mock_request.request_history
+        assert [len(r.json()['records']) for r in requests] == [2, 2, 1]
+        assert requests[0].json()['records'][0] == {'id': 0, 'value': '0'}
+        assert writer.rows_written == 5
+        assert writer.seconds > 0
+
+    @requests_mock.mock()
+    def test_decimal_precision(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA)
+        writer.resource_id = 'ckan-resource-id'
+        writer.write({'id': 1,
+                      'value': decimal.Decimal('0.12345678901234567890')})
+        writer.close()
+
+        records = mock_request.request_history[0].json()['records']
+        assert records == [{'id': 1, 'value': '0.12345678901234567890'}]
+
+    @requests_mock.mock()
+    def test_workers_keep_key_order(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, method='upsert',
+                                 batch_size=3, workers=4)
+        writer.resource_id = 'ckan-resource-id'
+        for version in range(10):
+            for i in range(8):
+                writer.write({'id': i, 'value': 'v{}'.format(version)})
+        writer.close()
+
+        assert writer.rows_written == 80
+        seen = {}
+        for request in mock_request.request_history:
+            for record in request.json()['records']:
+                seen.setdefault(record['id'], []).append(record['value'])
+        for values in seen.values():
+            assert values == ['v{}'.format(v) for v in range(10)]
+
+    @requests_mock.mock()
+    def test_workers_insert(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=10,
+                                 workers=3)
+        writer.resource_id = 'ckan-resource-id'
+        for i in range(95):
+            writer.write({'id': i, 'value': str(i)})
+        writer.close()
+
+        requests = mock_request.request_history
+        assert len(requests) == 10
+        assert sorted(record['id']
+                      for r in requests
+                      for record in r.json()['records']) == list(range(95))
+
+    @requests_mock.mock()
+    def test_workers_error(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL,
+                          json={'success': False,
+                                'error': {'__type': 'Validation Error'}})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=2,
+                                 workers=2)
+        writer.resource_id = 'ckan-resource-id'
+        with self.assertRaises(Exception):
+            for i in range(10):
+                writer.write({'id': i, 'value': str(i)})
+            writer.close()
+
+    @requests_mock.mock()
+    def test_async_client_keeps_key_order(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        client = AsyncCkanClient(max_in_flight=3)
+        self.addCleanup(client.close)
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, method='upsert',
+                                 batch_size=3, workers=4, client=client)
+        writer.resource_id = 'ckan-resource-id'
+        for version in range(10):
+            for i in range(8):
+                writer.write({'id': i, 'value': 'v{}'.format(version)})
+        writer.close()
+
+        assert writer.rows_written == 80
+        seen = {}
+        for request in mock_request.request_history:
+            for record in request.json()['records']:
+                seen.setdefault(record['id'], []).append(record['value'])
+        for values in seen.values():
+            assert values == ['v{}'.format(v) for v in range(10)]
+
+    @requests_mock.mock()
+    def test_async_client_error(self, mock_request):
+        mock_request.post(DATASTORE_UPSERT_URL,
+                          json={'success': False,
+                                'error': {'__type': 'Validation Error'}})
+
+        client = AsyncCkanClient()
+        self.addCleanup(client.close)
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=2,
+                                 workers=2, client=client)
+        writer.resource_id = 'ckan-resource-id'
+        with self.assertRaises(Exception):
+            for i in range(10):
+                writer.write({'id': i, 'value': str(i)})
+            writer.close()
+
+    @requests_mock.mock()
+    def test_defer_indexes(self, mock_request):
+        mock_request.post(DATASTORE_CREATE_URL,
+                          json={'success': True,
+                                'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(DATASTORE_UPSERT_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=2,
+                                 defer_indexes=True)
+        writer.create('ckan-resource-id')
+        for i in range(3):
+            writer.write({'id': i, 'value': str(i)})
+        writer.close()
+
+        requests = mock_request.request_history
+        assert [r.url.rsplit('/', 1)[1] for r in requests] == [
+            'datastore_create', 'datastore_upsert', 'datastore_upsert',
+            'datastore_create']
+        assert 'primary_key' not in requests[0].json()
+        assert requests[0].json()['fields']
+        assert requests[-1].json() == {'resource_id': 'ckan-resource-id',
+                                       'primary_key': ['id'],
+                                       'force': True}
+
+    def test_defer_indexes_requires_insert(self):
+        with self.assertRaises(RuntimeError):
+            DatastoreWriter(BASE_ENDPOINT, SCHEMA, method='upsert',
+                            defer_indexes=True)
+
+    @requests_mock.mock()
+    def test_delete_rows(self, mock_request):
+        mock_request.post(DATASTORE_DELETE_URL, json={'success': True})
+
+        writer = DatastoreWriter(BASE_ENDPOINT, SCHEMA, batch_size=2)
+        writer.resource_id = 'ckan-resource-id'
+        writer.delete_rows([[i] for i in range(5)])
+
+        requests = mock_request.request_history
+        assert [r.json()['filters'] for r in requests] == [
+            {'id': [0, 1]}, {'id': [2, 3]}, {'id': [4]}]
+        assert writer.rows_deleted == 5
+
+    @requests_mock.mock()
+    def test_delete_rows_composite_key(self, mock_request):
+        mock_request.post(DATASTORE_DELETE_URL, json={'success': True})
+
+        schema = dict(SCHEMA, primaryKey=['id', 'value'])
+        writer = DatastoreWriter(BASE_ENDPOINT, schema)
+        writer.resource_id = 'ckan-resource-id'
+        writer.delete_rows([[1, 'a'], [2, 'b']])
+
+        requests = mock_request.request_history
+        assert [r.json()['filters'] for r in requests] == [
+            {'id': 1, 'value': 'a'}, {'id': 2, 'value': 'b'}]
+
+
+class TestRowSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        self.path = os.path.join(self.snapshot_dir, 'snapshot.sqlite')
+
+    def run_rows(self, rows, resource_id='ckan-resource-id', commit=True):
+        snapshot = RowSnapshot(self.path, SCHEMA)
+        changed = [row['id'] for row in rows if snapshot.changed(row)]
+        removed = list(snapshot.removed())
+        if commit:
+            snapshot.commit(resource_id)
+        snapshot.close()
+        return changed, removed, snapshot.rows_unchanged
+
+    def test_changes(self):
+        assert self.run_rows([{'id': 1, 'value': 'a'},
+                              {'id': 2, 'value': 'b'},
+                              {'id': 3, 'value': 'c'}]) == ([1, 2, 3], [], 0)
+        assert self.run_rows([{'id': 1, 'value': 'a'},
+                              {'id': 3, 'value': 'changed'},
+                              {'id': 4, 'value': 'd'}]) == \
+            ([3, 4], [[2]], 1)
+        assert self.run_rows([{'id': 1, 'value': 'a'},
+                              {'id': 3, 'value': 'changed'},
+                              {'id': 4, 'value': 'd'}]) == ([], [], 3)
+
+    def test_uncommitted_run_is_discarded(self):
+        self.run_rows([{'id': 1, 'value': 'a'}])
+        self.run_rows([{'id': 1, 'value': 'b'}], commit=False)
+        assert self.run_rows([{'id': 1, 'value': 'a'}]) == ([], [], 1)
+
+    def test_matches(self):
+        snapshot = RowSnapshot(self.path, SCHEMA)
+        self.addCleanup(snapshot.close)
+        assert not snapshot.matches('ckan-resource-id')
+        snapshot.commit('ckan-resource-id')
+
+        snapshot = RowSnapshot(self.path, SCHEMA)
+        self.addCleanup(snapshot.close)
+        assert snapshot.matches('ckan-resource-id')
+        assert not snapshot.matches('other-resource-id')
+        other_schema = dict(SCHEMA, fields=SCHEMA['fields'][:1])
+        snapshot = RowSnapshot(self.path, other_schema)
+        self.addCleanup(snapshot.close)
+        assert not snapshot.matches('ckan-resource-id')
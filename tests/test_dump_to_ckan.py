@@ -1,7 +1,13 @@
+import copy
+import gzip
+import hashlib
 import importlib
 import io
 import json
 import os
+import pstats
+import shutil
+import tempfile
 import unittest
 
 import requests_mock
@@ -11,6 +17,8 @@ from datapackage_pipelines.wrapper.input_processor import ResourceIterator
 
 import datapackage_pipelines_ckan.processors
 
+from tests.mock_cloudstorage import MockCloudStorage
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -35,6 +43,19 @@ def mock_dump_test(processor, ingest_tuple, mock_spew, mock_ingest):
     return mock_spew.call_args
 
 
+def read_upload(response_json):
+    '''Return a requests_mock json callback that reads a streamed upload
+    body, so that it can be checked in the request history.'''
+    def callback(request, context):
+        if hasattr(request.body, 'read'):
+            request._request.body = request.body.read()
+        elif hasattr(request.body, '__next__'):
+            # a chunked body
+            request._request.body = b''.join(request.body)
+        return response_json
+    return callback
+
+
 class TestDumpToCkanProcessor(unittest.TestCase):
 
     @requests_mock.mock()
@@ -79,6 +100,95 @@ class TestDumpToCkanProcessor(unittest.TestCase):
         assert len(requests) == 1
         assert requests[0].url == package_create_url
 
+    @requests_mock.mock()
+    def test_dump_to_ckan_metrics_file(self, mock_request):
+        '''Write the stats of the CKAN calls to a metrics file.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        metrics_path = os.path.join(metrics_dir, 'metrics.json')
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'metrics_file': metrics_path
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+
+        with open(metrics_path) as metrics_file:
+            metrics = json.load(metrics_file)
+        assert metrics['ckan_calls'] == {'package_create': 1}
+        assert metrics['ckan_calls'] == spew_args[2]['ckan_calls']
+        assert metrics['ckan_latency_ms']['p50'] is not None
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_profile_file(self, mock_request):
+        '''Profile the run and dump the profile to a file.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'profile-file': os.path.join(profile_dir, 'to_ckan-{pid}.pstats')
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        spew_args, kwargs = mock_dump_test(processor_path,
+                                           (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+        # spew calls the finalizer once the run is over
+        kwargs['finalizer']()
+
+        profile_path = os.path.join(profile_dir,
+                                    'to_ckan-{}.pstats'.format(os.getpid()))
+        stats = pstats.Stats(profile_path)
+        assert any(function == 'handle_datapackage'
+                   for _, _, function in stats.stats)
+
     @requests_mock.mock()
     def test_dump_to_ckan_package_create_error(self, mock_request):
         '''Create failed due to existing package, no overwrite so raise
@@ -230,6 +340,266 @@ class TestDumpToCkanProcessor(unittest.TestCase):
         assert requests[1].url == resource_create_url
         assert requests[2].url == resource_create_url
 
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_resources_bulk(self, mock_request):
+        '''Create package with its non-streaming resources in the same
+        request.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "name": "resource_not_streamed",
+                "path": ".",
+                "format": "csv"
+            }, {
+                "dpp:streamedFrom": "https://example.com/file_02.csv",
+                "name": "resource_not_streamed_02",
+                "path": "."
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'bulk_resources': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+
+        requests = mock_request.request_history
+        assert len(requests) == 1
+        assert requests[0].url == package_create_url
+        assert requests[0].json()['resources'] == [{
+            'url': 'https://example.com/file.csv',
+            'name': 'resource_not_streamed',
+            'format': 'csv'
+        }, {
+            'url': 'https://example.com/file_02.csv',
+            'name': 'resource_not_streamed_02'
+        }]
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_patch_resources_bulk(self, mock_request):
+        '''Add and update the non-streaming resources of an existing
+        package with a single package_patch.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+
+        existing_resources = [{
+            'id': 'streamed-resource-id',
+            'name': 'resource_streamed.csv',
+            'url': 'https://demo.ckan.org/file.csv'
+        }, {
+            'id': 'not-streamed-resource-id',
+            'name': 'resource_not_streamed',
+            'url': 'https://example.com/old.csv'
+        }]
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'state': 'active',
+                                'private': False,
+                                'extras': [
+                                    {'key': 'profile',
+                                     'value': 'data-package'}],
+                                'resources': existing_resources
+                            }})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "name": "resource_not_streamed",
+                "path": "."
+            }, {
+                "dpp:streamedFrom": "https://example.com/file_02.csv",
+                "name": "resource_not_streamed_02",
+                "path": "."
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'dataset_sync': 'patch',
+            'bulk_resources': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+
+        requests = mock_request.request_history
+        assert len(requests) == 2
+        assert requests[1].url == package_patch_url
+        assert requests[1].json()['resources'] == [
+            existing_resources[0], {
+                'id': 'not-streamed-resource-id',
+                'name': 'resource_not_streamed',
+                'url': 'https://example.com/file.csv'
+            }, {
+                'name': 'resource_not_streamed_02',
+                'url': 'https://example.com/file_02.csv'
+            }]
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_patch_resources_bulk_unchanged(self, mock_request):  # noqa
+        '''Skip package_patch when the non-streaming resources are unchanged,
+        even though CKAN changed the case of their format.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "name": "resource_not_streamed",
+                "format": "csv",
+                "path": "."
+            }]
+        }
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'state': 'active',
+                                'private': False,
+                                # As sent by a previous run
+                                'extras': [
+                                    {'key': 'hash',
+                                     'value': hashlib.md5(json.dumps(
+                                        datapackage, sort_keys=True
+                                     ).encode('ascii')).hexdigest()},
+                                    {'key': 'profile',
+                                     'value': 'data-package'}],
+                                'resources': [{
+                                    'id': 'not-streamed-resource-id',
+                                    'name': 'resource_not_streamed',
+                                    'url': 'https://example.com/file.csv',
+                                    'format': 'CSV'
+                                }]
+                            }})
+
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'dataset_sync': 'patch',
+            'bulk_resources': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [package_show_url]
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_resources_async(self, mock_request):
+        '''Create package with non-streaming resources created concurrently
+        by the async engine.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file_{}.csv".format(i),
+                "name": "resource_not_streamed_{}".format(i),
+                "path": "."
+            } for i in range(5)]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'ckan-async-engine': True,
+            'ckan-max-in-flight': 3
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, []))
+
+        spew_res_iter = spew_args[1]
+        assert list(spew_res_iter) == []
+
+        requests = mock_request.request_history
+        assert len(requests) == 6
+        assert requests[0].url == package_create_url
+        assert sorted(r.json()['name'] for r in requests[1:]) == \
+            ['resource_not_streamed_{}'.format(i) for i in range(5)]
+
     @requests_mock.mock()
     def test_dump_to_ckan_package_create_streaming_resource(self,
                                                             mock_request):
@@ -548,3 +918,2058 @@ class TestDumpToCkanProcessor(unittest.TestCase):
                                         datapackage['resources'][0],
                                         {'schema': {'fields': []}})
                        ])))
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resources_background(self, mock_request):  # noqa
+        '''Create package with streaming resources uploaded by background
+        workers.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }, {
+                "dpp:streamedFrom": "https://example.com/file_02.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed_02.csv",
+                "path": "data/file_02.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'upload_workers': 2
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = {'first': 'Fred', 'last': 'Smith'}
+        json_file = json.dumps(json_file)
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}}),
+                   ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][1],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert len(requests) == 3
+        assert requests[0].url == package_create_url
+        assert requests[1].url == resource_create_url
+        assert requests[2].url == resource_create_url
+
+        spew_stats = spew_args[2]
+        assert spew_stats['count_of_rows'] == 2
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_background_fail(self, mock_request):  # noqa
+        '''Create package with streaming resource uploaded by a background
+        worker, which failed to create resource.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': False,
+                            'error': {"__type": "Validation Error",
+                                      "name": ["Some validation error."]}
+                            })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'upload_workers': 2
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = {'first': 'Fred', 'last': 'Smith'}
+        json_file = json.dumps(json_file)
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        with self.assertRaises(Exception):
+            for r in spew_res_iter:
+                list(r)  # iterate the row to yield it
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_hash(self,
+                                                                 mock_request):
+        '''Create package with streaming resource, hashed with a configured
+        algorithm while the file is written.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        for algorithm in ['md5', 'sha256', 'none']:
+            mock_request.reset_mock()
+
+            # input arguments used by our mock `ingest`
+            datapackage = {
+                'name': 'my-datapackage',
+                'project': 'my-project',
+                'resources': [{
+                    "dpp:streamedFrom": "https://example.com/file.csv",
+                    "dpp:streaming": True,
+                    "name": "resource_streamed.csv",
+                    "path": "data/file.csv",
+                    'schema': {'fields': [
+                        {'name': 'first', 'type': 'string'},
+                        {'name': 'last', 'type': 'string'}
+                    ]}
+                }]
+            }
+            params = {
+                'ckan-host': 'https://demo.ckan.org',
+                'ckan-api-key': 'my-api-key',
+                'force-format': True,
+                'hash_algorithm': algorithm
+            }
+
+            # Path to the processor we want to test
+            processor_dir = \
+                os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+            processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+            # Trigger the processor with our mock `ingest` and capture what it
+            # will returned to `spew`.
+            json_file = {'first': 'Fred', 'last': 'Smith'}
+            json_file = json.dumps(json_file)
+            spew_args, _ = mock_dump_test(
+                processor_path,
+                (params, datapackage,
+                 iter([ResourceIterator(io.StringIO(json_file),
+                                        datapackage['resources'][0],
+                                        {'schema': {'fields': []}})
+                       ])))
+
+            spew_res_iter = spew_args[1]
+            for r in spew_res_iter:
+                list(r)  # iterate the row to yield it
+
+            expected_file = b'first,last\r\nFred,Smith\r\n'
+            spew_dp = spew_args[0]
+            assert spew_dp['resources'][0]['bytes'] == len(expected_file)
+
+            requests = mock_request.request_history
+            assert requests[1].url == resource_create_url
+            assert expected_file in requests[1].body
+            if algorithm == 'none':
+                assert 'hash' not in spew_dp['resources'][0]
+                assert b'name="hash"' not in requests[1].body
+            else:
+                expected_hash = \
+                    hashlib.new(algorithm, expected_file).hexdigest()
+                assert spew_dp['resources'][0]['hash'] == expected_hash
+                assert expected_hash.encode('ascii') in requests[1].body
+            assert spew_args[2]['bytes_uploaded'] == len(requests[1].body)
+
+            # CKAN calls and the time of each phase are reported
+            spew_stats = spew_args[2]
+            assert spew_stats['ckan_calls'] == {
+                'package_create': 1, 'resource_create': 1}
+            assert spew_stats['ckan_request_bytes'] == \
+                len(requests[0].body) + len(requests[1].body)
+            phases = spew_stats['resource_seconds']['resource_streamed.csv']
+            assert sorted(phases) == ['hash', 'upload', 'write']
+            assert sorted(spew_stats['phase_seconds']) == \
+                ['dataset', 'hash', 'resources', 'upload', 'write']
+
+    @requests_mock.mock()
+    @mock.patch('tempfile.NamedTemporaryFile',
+                side_effect=AssertionError('No temporary file expected'))
+    def test_dump_to_ckan_direct_upload(self, mock_request, _):
+        '''Create package with streaming resource uploaded as it is written,
+        without a temporary file.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'direct_upload': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join(json.dumps({'first': 'Fred', 'last': name})
+                              for name in ['Smith', 'Jones'])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        expected_file = b'first,last\r\nFred,Smith\r\nFred,Jones\r\n'
+        expected_hash = hashlib.md5(expected_file).hexdigest()
+        spew_dp = spew_args[0]
+        assert spew_dp['resources'][0]['bytes'] == len(expected_file)
+        assert spew_dp['resources'][0]['hash'] == expected_hash
+
+        requests = mock_request.request_history
+        assert len(requests) == 2
+        assert requests[1].url == resource_create_url
+        assert requests[1].headers['Transfer-Encoding'] == 'chunked'
+        body = requests[1].body
+        # the hash is sent after the file
+        assert body.index(expected_file) < \
+            body.index(b'name="hash"\r\n\r\n' + expected_hash.encode())
+        assert spew_args[2]['bytes_uploaded'] == len(body)
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_direct_upload_fail(self, mock_request):
+        '''A failed direct upload stops the rows and raises its error.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          exc=requests_mock.exceptions.MockException(
+                              'Upload failed'))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'name', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'direct_upload': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Enough rows to fill the pipe to the upload
+        json_file = '\n'.join(json.dumps({'name': 'x' * 1000})
+                              for _ in range(2000))
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        with self.assertRaisesRegex(requests_mock.exceptions.MockException,
+                                    'Upload failed'):
+            for r in spew_res_iter:
+                list(r)  # iterate the row to yield it
+
+    def test_dump_to_ckan_hash_algorithm_invalid(self):
+        '''An unknown hash algorithm is rejected.'''
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'hash_algorithm': 'crc32'
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        with self.assertRaises(RuntimeError):
+            mock_dump_test(processor_path, (params, datapackage, []))
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_rows(self, mock_request):  # noqa
+        '''Create package with streaming resource, pushing its rows to the
+        datastore as they are streamed.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'name', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'},
+                    {'name': 'born', 'type': 'date'},
+                    {'name': 'score', 'type': 'number'}
+                ], 'primaryKey': ['name']}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'push_resources_to_datastore_method': 'upsert',
+            'datastore_stream_rows': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join([
+            json.dumps({'name': 'Fred', 'age': 42,
+                        'born': {'type{date}': '1975-05-13'},
+                        'score': {'type{decimal}': '1.5'}}),
+            json.dumps({'name': 'Wilma', 'age': 40,
+                        'born': {'type{date}': '1977-01-02'},
+                        'score': None})
+        ])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert len(requests) == 4
+        assert requests[0].url == package_create_url
+        assert requests[1].url == datastore_create_url
+        assert requests[2].url == datastore_upsert_url
+        assert requests[3].url == resource_patch_url
+
+        datastore_create = requests[1].json()
+        assert datastore_create['resource']['package_id'] == 'ckan-package-id'
+        assert datastore_create['resource']['name'] == 'resource_streamed.csv'
+        # The url is set by the upload, or CKAN would not create the table
+        assert 'url' not in datastore_create['resource']
+        assert 'url_type' not in datastore_create['resource']
+        assert datastore_create['primary_key'] == ['name']
+        assert [f['type'] for f in datastore_create['fields']] == \
+            ['text', 'int', 'date', 'float']
+
+        datastore_upsert = requests[2].json()
+        assert datastore_upsert['resource_id'] == 'ckan-resource-id'
+        assert datastore_upsert['method'] == 'upsert'
+        assert datastore_upsert['records'] == [
+            {'name': 'Fred', 'age': 42, 'born': '1975-05-13', 'score': '1.5'},
+            {'name': 'Wilma', 'age': 40, 'born': '1977-01-02', 'score': None}
+        ]
+
+        assert b'ckan-resource-id' in requests[3].body
+        assert b'Fred,42,1975-05-13,1.5' in requests[3].body
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_batches(self, mock_request):  # noqa
+        '''Create package with streaming resource, and pushing the file to
+        the datastore in configured batches.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'datastore_batch_size': 2,
+            'datastore_workers': 2
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join(json.dumps({'first': 'Fred', 'age': age})
+                              for age in [40, 41, None])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert len(requests) == 5
+        assert requests[0].url == package_create_url
+        assert requests[1].url == resource_create_url
+        assert requests[2].url == datastore_create_url
+        assert requests[2].json()['resource_id'] == 'ckan-resource-id'
+        assert requests[3].url == datastore_upsert_url
+        assert requests[4].url == datastore_upsert_url
+        records = requests[3].json()['records'] + \
+            requests[4].json()['records']
+        assert sorted(records, key=lambda r: r['age'] or '') == [
+            {'first': 'Fred', 'age': None},
+            {'first': 'Fred', 'age': '40'},
+            {'first': 'Fred', 'age': '41'}
+        ]
+
+        spew_stats = spew_args[2]
+        assert spew_stats['datastore_rows'] == 3
+        assert spew_stats['datastore_rows_per_second'] > 0
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_defer_indexes(self, mock_request):  # noqa
+        '''Create package with streaming resource, pushing the file to the
+        datastore and only adding its primary key once the rows are
+        loaded.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ], 'primaryKey': ['first']}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'datastore_defer_indexes': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join([
+            json.dumps({'first': 'Fred', 'age': 42}),
+            json.dumps({'first': 'Wilma', 'age': 40})
+        ])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_create_url, resource_create_url, datastore_create_url,
+            datastore_upsert_url, datastore_create_url]
+        datastore_create = requests[2].json()
+        assert datastore_create['resource_id'] == 'ckan-resource-id'
+        assert 'primary_key' not in datastore_create
+        assert len(datastore_create['fields']) == 2
+        assert requests[3].json()['method'] == 'insert'
+        assert len(requests[3].json()['records']) == 2
+        assert requests[4].json() == {
+            'resource_id': 'ckan-resource-id',
+            'primary_key': ['first'],
+            'force': True
+        }
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_rows_defer_indexes(self, mock_request):  # noqa
+        '''Create package with streaming resource, pushing its rows to the
+        datastore as they are streamed, and only adding its primary key once
+        they are loaded.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ], 'primaryKey': ['first']}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'datastore_stream_rows': True,
+            'datastore_defer_indexes': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join([
+            json.dumps({'first': 'Fred', 'age': 42}),
+            json.dumps({'first': 'Wilma', 'age': 40})
+        ])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_create_url, datastore_create_url, datastore_upsert_url,
+            datastore_create_url, resource_patch_url]
+        datastore_create = requests[1].json()
+        assert datastore_create['resource']['name'] == 'resource_streamed.csv'
+        assert 'primary_key' not in datastore_create
+        assert len(datastore_create['fields']) == 2
+        assert requests[2].json()['method'] == 'insert'
+        assert requests[2].json()['records'] == [
+            {'first': 'Fred', 'age': 42},
+            {'first': 'Wilma', 'age': 40}
+        ]
+        assert requests[3].json() == {
+            'resource_id': 'ckan-resource-id',
+            'primary_key': ['first'],
+            'force': True
+        }
+        assert b'ckan-resource-id' in requests[4].body
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_replace(self, mock_request):  # noqa
+        '''Create package with streaming resource, loading its rows into a
+        new DataStore table and moving its alias there from the previous
+        table.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        resource_delete_url = '{}resource_delete'.format(base_url)
+        datastore_search_url = '{}datastore_search'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-table-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+        mock_request.post(datastore_search_url,
+                          json={
+                            'success': True,
+                            'result': {'records': [{
+                                'name': 'my-datapackage_resource_streamed.csv',
+                                'alias_of': 'ckan-old-table-id'}]}})
+        mock_request.post(resource_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(resource_delete_url,
+                          json={
+                            'success': True,
+                            'result': None
+                          })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ], 'primaryKey': ['first']}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'push_resources_to_datastore_method': 'replace'
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join(json.dumps({'first': first, 'age': 40})
+                              for first in ['Fred', 'Wilma'])
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert [r.url.split('?')[0] for r in requests] == [
+            package_create_url, resource_create_url, datastore_search_url,
+            datastore_create_url, datastore_upsert_url, datastore_create_url,
+            datastore_create_url, resource_patch_url, resource_delete_url]
+
+        # The new resource has no table yet, so its alias is looked up
+        assert requests[2].json()['filters'] == {
+            'name': 'my-datapackage_resource_streamed.csv'}
+
+        # The rows are inserted into a new table
+        datastore_create = requests[3].json()
+        assert datastore_create['resource'] == {
+            'package_id': 'ckan-package-id',
+            'name': 'resource_streamed.csv (DataStore)',
+            'datastore_table_of': 'resource_streamed.csv'
+        }
+        assert datastore_create['primary_key'] == ['first']
+        assert requests[4].json()['resource_id'] == 'ckan-table-id'
+        assert requests[4].json()['method'] == 'insert'
+        assert len(requests[4].json()['records']) == 2
+
+        # The alias is moved to it, and the previous table deleted
+        alias = 'my-datapackage_resource_streamed.csv'
+        assert requests[5].json() == {'resource_id': 'ckan-old-table-id',
+                                      'aliases': [], 'force': True}
+        assert requests[6].json() == {'resource_id': 'ckan-table-id',
+                                      'aliases': [alias], 'force': True}
+        assert requests[7].json() == {'id': 'ckan-resource-id',
+                                      'datastore_alias': alias,
+                                      'datastore_table': 'ckan-table-id'}
+        assert requests[8].json() == {'id': 'ckan-old-table-id'}
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_create_streaming_resource_datastore_replace_alias_fail(self, mock_request):  # noqa
+        '''Create package with streaming resource loaded into a new
+        DataStore table, which could not be given the alias, so the alias is
+        given back to the previous table.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        resource_delete_url = '{}resource_delete'.format(base_url)
+        datastore_search_url = '{}datastore_search'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        created = {'json': {'success': True,
+                            'result': {'resource_id': 'ckan-table-id'}}}
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(datastore_create_url, [
+            created, created,
+            {'json': {'success': False,
+                      'error': {'__type': 'Not Found Error',
+                                'message': 'Not found'}}},
+            created])
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+        mock_request.post(datastore_search_url,
+                          json={
+                            'success': True,
+                            'result': {'records': [{
+                                'name': 'my-datapackage_resource_streamed.csv',
+                                'alias_of': 'ckan-old-table-id'}]}})
+        mock_request.post(resource_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(resource_delete_url,
+                          json={
+                            'success': True,
+                            'result': None
+                          })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ], 'primaryKey': ['first']}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'push_resources_to_datastore_method': 'replace'
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = json.dumps({'first': 'Fred', 'age': 40})
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        with self.assertRaises(Exception):
+            for r in spew_res_iter:
+                list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert [r.url.split('?')[0] for r in requests] == [
+            package_create_url, resource_create_url, datastore_search_url,
+            datastore_create_url, datastore_upsert_url, datastore_create_url,
+            datastore_create_url, datastore_create_url]
+
+        # The alias is given back to the previous table, which is kept
+        alias = 'my-datapackage_resource_streamed.csv'
+        assert requests[6].json() == {'resource_id': 'ckan-table-id',
+                                      'aliases': [alias], 'force': True}
+        assert requests[7].json() == {'resource_id': 'ckan-old-table-id',
+                                      'aliases': [alias], 'force': True}
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_package_patch_streaming_resource_datastore_delta(self, mock_request):  # noqa
+        '''Update an existing package twice, sending only the changed and
+        removed rows of the second run to the DataStore.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+        datastore_delete_url = '{}datastore_delete'.format(base_url)
+
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'resources': [{
+                                    'id': 'ckan-resource-id',
+                                    'name': 'resource_streamed.csv'}]}})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+        mock_request.post(datastore_delete_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ], 'primaryKey': ['first']}
+            }]
+        }
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'dataset_sync': 'patch',
+            'push_resources_to_datastore': True,
+            'push_resources_to_datastore_method': 'delta',
+            'datastore_snapshot_dir': snapshot_dir
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        def run(rows):
+            run_datapackage = copy.deepcopy(datapackage)
+            json_file = '\n'.join(json.dumps(row) for row in rows)
+            spew_args, _ = mock_dump_test(
+                processor_path,
+                (params, run_datapackage,
+                 iter([ResourceIterator(io.StringIO(json_file),
+                                        run_datapackage['resources'][0],
+                                        {'schema': {'fields': []}})
+                       ])))
+            for r in spew_args[1]:
+                list(r)  # iterate the row to yield it
+            return spew_args[2]
+
+        # Without a snapshot, the table is loaded again
+        run([{'first': 'Fred', 'age': 40},
+             {'first': 'Wilma', 'age': 40},
+             {'first': 'Barney', 'age': 41}])
+        urls = [r.url.split('?')[0] for r in mock_request.request_history]
+        assert urls.count(datastore_create_url) == 1
+        assert urls.count(datastore_delete_url) == 1
+        upserts = [r.json() for r in mock_request.request_history
+                   if r.url == datastore_upsert_url]
+        assert [len(upsert['records']) for upsert in upserts] == [3]
+
+        mock_request.reset_mock()
+        stats = run([{'first': 'Fred', 'age': 40},
+                     {'first': 'Wilma', 'age': 41},
+                     {'first': 'Betty', 'age': 30}])
+        urls = [r.url.split('?')[0] for r in mock_request.request_history]
+        assert datastore_create_url not in urls
+        upserts = [r.json() for r in mock_request.request_history
+                   if r.url == datastore_upsert_url]
+        assert upserts[0]['method'] == 'upsert'
+        assert [upsert['records'] for upsert in upserts] == [[
+            {'first': 'Wilma', 'age': 41},
+            {'first': 'Betty', 'age': 30}]]
+        deletes = [r.json() for r in mock_request.request_history
+                   if r.url == datastore_delete_url]
+        assert deletes == [{'resource_id': 'ckan-resource-id',
+                            'filters': {'first': ['Barney']},
+                            'force': True}]
+        assert stats['datastore_rows'] == 2
+        assert stats['datastore_rows_unchanged'] == 1
+        assert stats['datastore_rows_deleted'] == 1
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_compress_uploads(self, mock_request):
+        '''Create package with streaming resource uploaded gzip-compressed,
+        and pushing the uncompressed rows to the datastore.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        datastore_create_url = '{}datastore_create'.format(base_url)
+        datastore_upsert_url = '{}datastore_upsert'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+        mock_request.post(datastore_create_url,
+                          json={
+                            'success': True,
+                            'result': {'resource_id': 'ckan-resource-id'}})
+        mock_request.post(datastore_upsert_url,
+                          json={
+                            'success': True
+                          })
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'age', 'type': 'integer'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'push_resources_to_datastore': True,
+            'datastore_batch_size': 10,
+            'compress_uploads': True,
+            'compression_level': 9
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = '\n'.join(json.dumps({'first': 'Fred', 'age': age})
+                              for age in range(100))
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        expected_file = 'first,age\r\n' + ''.join(
+            'Fred,{}\r\n'.format(age) for age in range(100))
+        expected_file = expected_file.encode('utf-8')
+
+        requests = mock_request.request_history
+        assert requests[1].url == resource_create_url
+        body = requests[1].body
+        assert b'filename="file.csv.gz"' in body
+        assert b'name="format"\r\n\r\ncsv.gz\r\n' in body
+        assert b'name="compression"\r\n\r\ngzip\r\n' in body
+        assert b'name="mimetype_inner"\r\n\r\ntext/csv\r\n' in body
+        compressed = body[body.index(b'\x1f\x8b'):]
+        assert gzip.decompress(compressed[:compressed.index(b'\r\n--')]) \
+            == expected_file
+
+        # the size and hash are those of the uploaded file
+        spew_dp = spew_args[0]
+        assert spew_dp['resources'][0]['bytes'] < len(expected_file)
+        compressed = compressed[:spew_dp['resources'][0]['bytes']]
+        assert spew_dp['resources'][0]['hash'] == \
+            hashlib.md5(compressed).hexdigest()
+
+        assert requests[2].url == datastore_create_url
+        records = []
+        for request in requests[3:]:
+            assert request.url == datastore_upsert_url
+            records.extend(request.json()['records'])
+        assert records == [{'first': 'Fred', 'age': str(age)}
+                           for age in range(100)]
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_multipart_upload(self, mock_request):
+        '''Create package with streaming resource uploaded in parts.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        cloudstorage = MockCloudStorage(mock_request, base_url)
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'force-format': True,
+            'upload_backend': 'multipart',
+            'upload_part_size': 10,
+            'upload_part_workers': 2
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = {'first': 'Fred', 'last': 'Smith'}
+        json_file = json.dumps(json_file)
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert requests[1].url == resource_create_url
+        resource = requests[1].json()
+        assert resource['url'] == 'file.csv'
+        assert resource['hash'] == \
+            hashlib.md5(b'first,last\r\nFred,Smith\r\n').hexdigest()
+        assert requests[2].json() == {
+            'id': 'ckan-resource-id',
+            'name': 'file.csv',
+            'size': 24
+        }
+        assert cloudstorage.attempts == {1: 1, 2: 1, 3: 1}
+        assert cloudstorage.files['ckan-resource-id'] == \
+            b'first,last\r\nFred,Smith\r\n'
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_skip_unchanged(self, mock_request):
+        '''Update package, skipping the resources whose content is unchanged
+        and replacing the content of changed ones.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_update_url = '{}package_update'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+
+        expected_file = b'first,last\r\nFred,Smith\r\n'
+        existing_resources = [{
+            'id': 'unchanged-resource-id',
+            'name': 'resource_streamed.csv',
+            'hash': hashlib.md5(expected_file).hexdigest(),
+            'size': len(expected_file)
+        }, {
+            'id': 'changed-resource-id',
+            'name': 'resource_streamed_02.csv',
+            'hash': 'old-hash',
+            'size': None
+        }, {
+            'id': 'not-streamed-resource-id',
+            'name': 'resource_not_streamed.csv',
+            'url': 'https://example.com/file_02.csv'
+        }]
+        removed_resource = {
+            'id': 'removed-resource-id',
+            'name': 'resource_removed.csv',
+            'url': 'https://example.com/removed.csv'
+        }
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'resources':
+                                    existing_resources + [removed_resource]
+                            }})
+        mock_request.post(package_update_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'changed-resource-id'}}))
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        schema = {'fields': [
+            {'name': 'first', 'type': 'string'},
+            {'name': 'last', 'type': 'string'}
+        ]}
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': schema
+            }, {
+                "dpp:streamedFrom": "https://example.com/file_03.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed_02.csv",
+                "path": "data/file_03.csv",
+                'schema': schema
+            }, {
+                "dpp:streamedFrom": "https://example.com/file_02.csv",
+                "name": "resource_not_streamed.csv",
+                "path": "."
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'skip_unchanged': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        # Trigger the processor with our mock `ingest` and capture what it will
+        # returned to `spew`.
+        json_file = {'first': 'Fred', 'last': 'Smith'}
+        json_file = json.dumps(json_file)
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][0],
+                                    {'schema': {'fields': []}}),
+                   ResourceIterator(io.StringIO(json_file),
+                                    datapackage['resources'][1],
+                                    {'schema': {'fields': []}})
+                   ])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert len(requests) == 4
+        assert requests[0].url == package_show_url
+        assert requests[1].url == package_update_url
+        assert requests[1].json()['resources'] == existing_resources
+        assert requests[2].url == resource_patch_url
+        assert b'changed-resource-id' in requests[2].body
+        assert requests[3].url == package_patch_url
+
+        spew_stats = spew_args[2]
+        assert spew_stats['skipped_resources'] == 2
+        assert spew_stats['dataset_unchanged'] is False
+
+    def test_dump_to_ckan_skip_unchanged_without_hash(self):
+        '''Skipping unchanged resources needs a hash to compare.'''
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': []
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'skip_unchanged': True,
+            'hash_algorithm': 'none'
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        with self.assertRaises(RuntimeError):
+            mock_dump_test(processor_path, (params, datapackage, []))
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_skip_unchanged_dataset(self, mock_request):
+        '''Rerun on an unchanged datapackage makes no writes at all.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_create_url = '{}package_create'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+
+        mock_request.get(package_show_url,
+                         json={
+                            'success': False,
+                            'error': {'__type': 'Not Found Error',
+                                      'message': 'Not found'}})
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'skip_unchanged': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        def run_dump():
+            run_datapackage = copy.deepcopy(datapackage)
+            json_file = json.dumps({'first': 'Fred', 'last': 'Smith'})
+            spew_args, _ = mock_dump_test(
+                processor_path,
+                (params, run_datapackage,
+                 iter([ResourceIterator(io.StringIO(json_file),
+                                        run_datapackage['resources'][0],
+                                        {'schema': {'fields': []}})
+                       ])))
+            for r in spew_args[1]:
+                list(r)  # iterate the row to yield it
+            return spew_args[2]
+
+        # First run creates the dataset and records its hashes
+        spew_stats = run_dump()
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_create_url,
+            resource_create_url,
+            package_patch_url
+        ]
+        assert spew_stats['dataset_unchanged'] is False
+        extras = requests[3].json()['extras']
+        extra_keys = [e['key'] for e in extras]
+        assert 'dataset_hash' in extra_keys
+        assert 'project' in extra_keys
+
+        # Second run finds the same hashes and writes nothing
+        mock_request.reset_mock()
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'extras': extras,
+                                'resources': [{
+                                    'id': 'ckan-resource-id',
+                                    'name': 'resource_streamed.csv',
+                                    'hash': hashlib.md5(
+                                        b'first,last\r\nFred,Smith\r\n'
+                                    ).hexdigest()
+                                }]
+                            }})
+        spew_stats = run_dump()
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [package_show_url]
+        assert spew_stats['dataset_unchanged'] is True
+        assert spew_stats['skipped_resources'] == 1
+
+        # A change to the dataset-properties alone updates the dataset
+        package_update_url = '{}package_update'.format(base_url)
+        mock_request.post(package_update_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.reset_mock()
+        params['dataset-properties'] = {'title': 'New title'}
+        spew_stats = run_dump()
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_update_url,
+            package_patch_url
+        ]
+        assert requests[1].json()['title'] == 'New title'
+        assert spew_stats['dataset_unchanged'] is False
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_skip_unchanged_dataset_resource_removed(self, mock_request):  # noqa
+        '''Rerun without one of the resources updates the dataset, which
+        deletes it, though the dataset metadata is unchanged.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_create_url = '{}package_create'.format(base_url)
+        package_update_url = '{}package_update'.format(base_url)
+        resource_create_url = '{}resource_create'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+
+        mock_request.get(package_show_url,
+                         json={
+                            'success': False,
+                            'error': {'__type': 'Not Found Error',
+                                      'message': 'Not found'}})
+        mock_request.post(package_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(package_update_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_create_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        streamed_resource = {
+            "dpp:streamedFrom": "https://example.com/file.csv",
+            "dpp:streaming": True,
+            "name": "resource_streamed.csv",
+            "path": "data/file.csv",
+            'schema': {'fields': [
+                {'name': 'first', 'type': 'string'},
+                {'name': 'last', 'type': 'string'}
+            ]}
+        }
+        removed_resource = {
+            "dpp:streamedFrom": "https://example.com/removed.csv",
+            "name": "resource_removed.csv",
+            "path": "data/removed.csv"
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'skip_unchanged': True,
+            # Without the datapackage hash in the extras, only the resource
+            # names tell the datapackages apart
+            'counters': {'datapackage-hash': None}
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        def run_dump(resources):
+            datapackage = {
+                'name': 'my-datapackage',
+                'project': 'my-project',
+                'resources': copy.deepcopy(resources)
+            }
+            json_file = json.dumps({'first': 'Fred', 'last': 'Smith'})
+            spew_args, _ = mock_dump_test(
+                processor_path,
+                (params, datapackage,
+                 iter([ResourceIterator(io.StringIO(json_file),
+                                        datapackage['resources'][0],
+                                        {'schema': {'fields': []}})
+                       ])))
+            for r in spew_args[1]:
+                list(r)  # iterate the row to yield it
+            return spew_args[2]
+
+        # First run creates the dataset with both resources
+        run_dump([streamed_resource, removed_resource])
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_create_url,
+            resource_create_url,
+            resource_create_url,
+            package_patch_url
+        ]
+        extras = requests[4].json()['extras']
+
+        # Second run leaves out the removed resource from package_update
+        mock_request.reset_mock()
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'extras': extras,
+                                'resources': [{
+                                    'id': 'ckan-resource-id',
+                                    'name': 'resource_streamed.csv',
+                                    'hash': hashlib.md5(
+                                        b'first,last\r\nFred,Smith\r\n'
+                                    ).hexdigest()
+                                }, {
+                                    'id': 'ckan-removed-id',
+                                    'name': 'resource_removed.csv',
+                                    'url': 'https://example.com/removed.csv'
+                                }]
+                            }})
+        spew_stats = run_dump([streamed_resource])
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_update_url,
+            package_patch_url
+        ]
+        assert [r['id'] for r in requests[1].json()['resources']] == \
+            ['ckan-resource-id']
+        assert spew_stats['dataset_unchanged'] is False
+        assert spew_stats['skipped_resources'] == 1
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_dataset_sync_patch(self, mock_request):
+        '''Update an existing package with only its changed fields, and its
+        resources in place.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+
+        existing_dataset = {
+            'id': 'ckan-package-id',
+            'name': 'my-datapackage',
+            'title': 'Old title',
+            'version': None,
+            'state': 'active',
+            'url': '',
+            'notes': None,
+            'license_id': '',
+            'author': '',
+            'author_email': '',
+            'maintainer': '',
+            'maintainer_email': '',
+            'owner_org': 'org-id',
+            'organization': {'id': 'org-id', 'name': 'my-org'},
+            'private': False,
+            'extras': [{'key': 'project', 'value': 'my-project'},
+                       {'key': 'profile', 'value': 'data-package'},
+                       {'key': 'other', 'value': 'kept'}],
+            'resources': [{
+                'id': 'streamed-resource-id',
+                'name': 'resource_streamed.csv'
+            }, {
+                'id': 'not-streamed-resource-id',
+                'name': 'resource_not_streamed',
+                'url': 'https://example.com/old.csv'
+            }]
+        }
+        mock_request.get(package_show_url,
+                         json={'success': True, 'result': existing_dataset})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'project': 'my-project',
+            'title': 'New title',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/new.csv",
+                "name": "resource_not_streamed",
+                "path": "."
+            }, {
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": "resource_streamed.csv",
+                "path": "data/file.csv",
+                'schema': {'fields': [
+                    {'name': 'first', 'type': 'string'},
+                    {'name': 'last', 'type': 'string'}
+                ]}
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'force-format': True,
+            'dataset_sync': 'patch',
+            'dataset-properties': {'owner_org': 'my-org'}
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        def run_dump():
+            json_file = json.dumps({'first': 'Fred', 'last': 'Smith'})
+            run_datapackage = copy.deepcopy(datapackage)
+            spew_args, _ = mock_dump_test(
+                processor_path,
+                (params, run_datapackage,
+                 iter([ResourceIterator(io.StringIO(json_file),
+                                        run_datapackage['resources'][1],
+                                        {'schema': {'fields': []}})
+                       ])))
+            for r in spew_args[1]:
+                list(r)  # iterate the row to yield it
+
+        run_dump()
+
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_patch_url,
+            resource_patch_url,
+            resource_patch_url
+        ]
+        package_patch = requests[1].json()
+        assert sorted(package_patch) == ['extras', 'id', 'title']
+        assert package_patch['id'] == 'ckan-package-id'
+        assert package_patch['title'] == 'New title'
+        # extras are merged with the existing ones
+        extras = dict((e['key'], e['value']) for e in package_patch['extras'])
+        assert extras['other'] == 'kept'
+        assert 'hash' in extras
+        assert requests[2].json() == {
+            'id': 'not-streamed-resource-id',
+            'package_id': 'ckan-package-id',
+            'name': 'resource_not_streamed',
+            'url': 'https://example.com/new.csv'
+        }
+        assert b'streamed-resource-id' in requests[3].body
+
+        # Once the dataset is up to date, it is not patched
+        mock_request.reset_mock()
+        existing_dataset['title'] = 'New title'
+        existing_dataset['extras'] = package_patch['extras']
+        run_dump()
+        requests = mock_request.request_history
+        assert package_patch_url not in [r.url for r in requests]
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_reconcile_resources(self, mock_request):
+        '''Reconcile the existing resources by name: patch changed metadata,
+        upload changed content and delete removed resources.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_patch_url = '{}package_patch'.format(base_url)
+        resource_patch_url = '{}resource_patch'.format(base_url)
+        resource_delete_url = '{}resource_delete'.format(base_url)
+
+        expected_file = b'first,last\r\nFred,Smith\r\n'
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'title': 'My datapackage',
+                                'resources': [{
+                                    'id': 'unchanged-resource-id',
+                                    'encoding': 'utf-8',
+                                    'name': 'resource_streamed.csv',
+                                    'format': 'CSV',
+                                    'hash': hashlib.md5(
+                                        expected_file).hexdigest(),
+                                    'size': len(expected_file)
+                                }, {
+                                    'id': 'metadata-resource-id',
+                                    'encoding': 'utf-8',
+                                    'name': 'resource_streamed_02.csv',
+                                    'format': 'txt',
+                                    'hash': hashlib.md5(
+                                        expected_file).hexdigest(),
+                                    'size': len(expected_file)
+                                }, {
+                                    'id': 'changed-resource-id',
+                                    'name': 'resource_streamed_03.csv',
+                                    'format': 'csv',
+                                    'hash': 'old-hash'
+                                }, {
+                                    'id': 'not-streamed-resource-id',
+                                    'name': 'resource_not_streamed.csv',
+                                    'url': 'https://example.com/file.csv'
+                                }, {
+                                    'id': 'removed-resource-id',
+                                    'name': 'resource_removed.csv'
+                                }]
+                            }})
+        mock_request.post(package_patch_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+        mock_request.post(resource_patch_url,
+                          json=read_upload({
+                            'success': True,
+                            'result': {'id': 'ckan-resource-id'}}))
+        mock_request.post(resource_delete_url,
+                          json={'success': True, 'result': None})
+
+        # input arguments used by our mock `ingest`
+        schema = {'fields': [
+            {'name': 'first', 'type': 'string'},
+            {'name': 'last', 'type': 'string'}
+        ]}
+        datapackage = {
+            'name': 'my-datapackage',
+            'title': 'My datapackage',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "name": "resource_not_streamed.csv",
+                "path": "."
+            }] + [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "dpp:streaming": True,
+                "name": name,
+                "path": "data/file.csv",
+                "format": "csv",
+                'schema': schema
+            } for name in ['resource_streamed.csv',
+                           'resource_streamed_02.csv',
+                           'resource_streamed_03.csv']]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'dataset_sync': 'patch',
+            'reconcile_resources': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        json_file = json.dumps({'first': 'Fred', 'last': 'Smith'})
+        spew_args, _ = mock_dump_test(
+            processor_path,
+            (params, datapackage,
+             iter([ResourceIterator(io.StringIO(json_file), resource,
+                                    {'schema': {'fields': []}})
+                   for resource in datapackage['resources'][1:]])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert [r.url for r in requests] == [
+            package_show_url,
+            package_patch_url,
+            resource_patch_url,
+            resource_patch_url,
+            resource_delete_url
+        ]
+        # Only the metadata is sent for unchanged content
+        assert requests[2].json() == {
+            'id': 'metadata-resource-id',
+            'format': 'csv'
+        }
+        assert b'changed-resource-id' in requests[3].body
+        assert b'Fred,Smith' in requests[3].body
+        assert requests[4].json() == {'id': 'removed-resource-id'}
+
+        spew_stats = spew_args[2]
+        assert spew_stats['skipped_resources'] == 2
+        assert spew_stats['patched_resources'] == 1
+        assert spew_stats['deleted_resources'] == 1
+
+    @requests_mock.mock()
+    def test_dump_to_ckan_reconcile_resources_update(self, mock_request):
+        '''With package_update, removed resources are left out of the
+        update rather than deleted one by one.'''
+
+        base_url = 'https://demo.ckan.org/api/3/action/'
+        package_show_url = '{}package_show?id=my-datapackage'.format(base_url)
+        package_update_url = '{}package_update'.format(base_url)
+
+        kept_resource = {
+            'id': 'not-streamed-resource-id',
+            'name': 'resource_not_streamed.csv',
+            'url': 'https://example.com/file.csv'
+        }
+        mock_request.get(package_show_url,
+                         json={
+                            'success': True,
+                            'result': {
+                                'id': 'ckan-package-id',
+                                'name': 'my-datapackage',
+                                'resources': [kept_resource, {
+                                    'id': 'removed-resource-id',
+                                    'name': 'resource_removed.csv'
+                                }]
+                            }})
+        mock_request.post(package_update_url,
+                          json={
+                            'success': True,
+                            'result': {'id': 'ckan-package-id'}})
+
+        # input arguments used by our mock `ingest`
+        datapackage = {
+            'name': 'my-datapackage',
+            'resources': [{
+                "dpp:streamedFrom": "https://example.com/file.csv",
+                "name": "resource_not_streamed.csv",
+                "path": "."
+            }]
+        }
+        params = {
+            'ckan-host': 'https://demo.ckan.org',
+            'ckan-api-key': 'my-api-key',
+            'overwrite_existing': True,
+            'reconcile_resources': True
+        }
+
+        # Path to the processor we want to test
+        processor_dir = \
+            os.path.dirname(datapackage_pipelines_ckan.processors.__file__)
+        processor_path = os.path.join(processor_dir, 'dump/to_ckan.py')
+
+        spew_args, _ = mock_dump_test(processor_path,
+                                      (params, datapackage, iter([])))
+
+        spew_res_iter = spew_args[1]
+        for r in spew_res_iter:
+            list(r)  # iterate the row to yield it
+
+        requests = mock_request.request_history
+        assert len(requests) == 2
+        assert requests[1].url == package_update_url
+        assert requests[1].json()['resources'] == [kept_resource]
+
+        spew_stats = spew_args[2]
+        assert spew_stats['skipped_resources'] == 1
+        assert spew_stats['deleted_resources'] == 1
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+
+import requests_mock
+
+from datapackage_pipelines_ckan.metrics import (
+    Metrics, percentile, get_metrics, reset_metrics
+)
+from datapackage_pipelines_ckan.utils import make_ckan_request
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([3], 90) == 3
+        assert percentile([], 50) is None
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.record_request('package_show', 0.1, 0, 200)
+        metrics.record_request('resource_create', 0.5, 1000, 100)
+        metrics.record_request('resource_create', 0.3, 1000, 50, ok=False)
+        metrics.add_time('write', 1.0, 'a')
+        metrics.add_time('write', 0.5, 'b')
+        with metrics.timer('upload', 'a'):
+            pass
+
+        summary = metrics.summary()
+        assert summary['ckan_calls'] == {
+            'package_show': 1, 'resource_create': 2}
+        assert summary['ckan_errors'] == {'resource_create': 1}
+        assert summary['ckan_request_bytes'] == 2000
+        assert summary['ckan_response_bytes'] == 350
+        assert summary['ckan_latency_ms'] == {
+            'p50': 300.0, 'p90': 500.0, 'p99': 500.0, 'max': 500.0}
+        assert summary['ckan_latency_ms_by_action']['package_show'] == {
+            'p50': 100.0, 'p90': 100.0, 'p99': 100.0, 'max': 100.0}
+        assert summary['phase_seconds']['write'] == 1.5
+        assert sorted(summary['phase_seconds']) == ['upload', 'write']
+        assert summary['resource_seconds']['b'] == {'write': 0.5}
+
+    def test_write(self):
+        metrics = Metrics()
+        metrics.record_request('package_show', 0.1)
+        with tempfile.TemporaryDirectory() as path:
+            metrics_path = os.path.join(path, 'metrics.json')
+            metrics.write(metrics_path)
+            with open(metrics_path) as metrics_file:
+                assert json.load(metrics_file) == metrics.summary()
+
+    @requests_mock.mock()
+    def test_ckan_requests_are_recorded(self, mock_request):
+        url = 'https://demo.ckan.org/api/3/action/package_create'
+        bodies = []
+
+        def send(request, context):
+            # requests_mock does not read streamed bodies, unlike urllib3
+            body = request.body
+            bodies.append(body.read() if hasattr(body, 'read') else body)
+            return {'success': True, 'result': {}}
+
+        mock_request.post(url, json=send)
+        metrics = reset_metrics()
+        assert get_metrics() is metrics
+
+        make_ckan_request(url, method='POST', data='{"name": "a"}')
+        make_ckan_request(url, method='POST',
+                          files={'upload': ('a.csv', b'a,b\r\n')})
+
+        assert metrics.calls == {'package_create': 2}
+        assert metrics.request_bytes == len(bodies[0]) + len(bodies[1])
+        assert metrics.response_bytes == \
+            2 * len(b'{"success": true, "result": {}}')
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import requests_mock
+
+from datapackage_pipelines_ckan.multipart import MultipartUploader
+
+from tests.mock_cloudstorage import MockCloudStorage
+
+
+@mock.patch('datapackage_pipelines_ckan.utils.time.sleep')
+class TestMultipartUploader(unittest.TestCase):
+
+    base_url = 'https://demo.ckan.org/api/3/action/'
+
+    def setUp(self):
+        self.content = os.urandom(2500)
+        upload_file = tempfile.NamedTemporaryFile(delete=False)
+        upload_file.write(self.content)
+        upload_file.close()
+        self.filename = upload_file.name
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    @requests_mock.mock()
+    def test_upload_in_parts(self, mock_sleep, mock_request):
+        cloudstorage = MockCloudStorage(mock_request, self.base_url,
+                                        fail_parts=[2])
+        progress = []
+        uploader = MultipartUploader(self.base_url.rstrip('/'),
+                                     part_size=1000, workers=2,
+                                     progress=progress.append)
+
+        result = uploader.upload('resource-id', self.filename, 'file.bin')
+
+        assert result == {'commited': True}
+        assert cloudstorage.files['resource-id'] == self.content
+        # only the failed part was sent again
+        assert cloudstorage.attempts == {1: 1, 2: 2, 3: 1}
+        assert sum(progress) > 2 * len(self.content) / 3
+        assert cloudstorage.aborted == []
+
+    @requests_mock.mock()
+    def test_abort_failed_upload(self, mock_sleep, mock_request):
+        cloudstorage = MockCloudStorage(mock_request, self.base_url,
+                                        reject_parts=[3])
+        uploader = MultipartUploader(self.base_url.rstrip('/'),
+                                     part_size=1000, workers=1)
+
+        with self.assertRaises(Exception):
+            uploader.upload('resource-id', self.filename, 'file.bin')
+
+        assert cloudstorage.aborted == ['resource-id']
+        assert 'resource-id' not in cloudstorage.files
@@ -0,0 +1,94 @@
+import os
+import pstats
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+import mock
+import requests_mock
+
+from datapackage_pipelines_ckan.profiling import (
+    Profiler, get_slow_request_log
+)
+from datapackage_pipelines_ckan.utils import make_ckan_request
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_disabled_by_default(self):
+        profiler = Profiler.from_parameters({})
+        profiler.start()
+        assert not profiler.tracing
+        assert get_slow_request_log() is None
+        profiler.stop()
+        assert os.listdir(self.path) == []
+
+    def test_profile_file(self):
+        profile_file = os.path.join(self.path, 'run-{pid}.pstats')
+        profiler = Profiler(profile_file=profile_file)
+        profiler.start()
+        sorted(range(1000))
+        profiler.stop()
+
+        path = profile_file.format(pid=os.getpid())
+        stats = pstats.Stats(path)
+        assert any('sorted' in function for _, _, function in stats.stats)
+
+    def test_parameters_and_environment(self):
+        parameters = {'profile-tracemalloc-top': 5, 'other': True}
+        with mock.patch.dict(os.environ,
+                             {'CKAN_PROFILE_SLOW_REQUESTS': '2.5',
+                              'CKAN_PROFILE_TRACEMALLOC_TOP': '10'}):
+            profiler = Profiler.from_parameters(parameters, pop=True)
+        assert parameters == {'other': True}
+        assert profiler.tracemalloc_top == 5
+        assert profiler.slow_requests.threshold == 2.5
+        assert profiler.slow_requests.sample_rate == 1.0
+
+    def test_tracemalloc_snapshot(self):
+        profiler = Profiler(tracemalloc_top=3)
+        profiler.start()
+        try:
+            assert tracemalloc.is_tracing()
+            with self.assertLogs('datapackage_pipelines_ckan.profiling',
+                                 level='INFO') as logs:
+                rows = list(profiler.trace(iter([[0] * 1000]), 'resource'))
+        finally:
+            profiler.stop()
+        assert rows == [[0] * 1000]
+        assert not tracemalloc.is_tracing()
+        assert 'Top 3 memory allocations after resource:' in \
+            logs.output[0]
+        assert 1 < len(logs.output) <= 4
+
+    @requests_mock.mock()
+    def test_slow_request_log(self, mock_request):
+        url = 'https://demo.ckan.org/api/3/action/package_show'
+        mock_request.get(url, json={'success': True, 'result': {}})
+
+        profiler = Profiler(slow_requests=0)
+        profiler.start()
+        try:
+            with self.assertLogs('datapackage_pipelines_ckan.profiling',
+                                 level='WARNING') as logs:
+                make_ckan_request(url)
+        finally:
+            profiler.stop()
+        assert 'Slow CKAN request: GET {}'.format(url) in logs.output[0]
+        assert '(200)' in logs.output[0]
+        assert get_slow_request_log() is None
+
+        profiler = Profiler(slow_requests=0, slow_requests_sample_rate=0)
+        profiler.start()
+        try:
+            with mock.patch('datapackage_pipelines_ckan.profiling.log') \
+                    as mock_log:
+                make_ckan_request(url)
+        finally:
+            profiler.stop()
+        assert not mock_log.warning.called
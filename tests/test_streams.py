@@ -0,0 +1,94 @@
+import io
+import gzip
+import hashlib
+import unittest
+
+import requests
+
+from datapackage_pipelines_ckan.streams import HashingWriter, MultipartEncoder
+
+
+class TestHashingWriter(unittest.TestCase):
+
+    def test_hash_and_size(self):
+        target = io.BytesIO()
+        hashing_file = HashingWriter(target, 'sha256')
+        text_file = io.TextIOWrapper(hashing_file, encoding='utf-8',
+                                     newline='')
+        text_file.write('first,last\r\n')
+        text_file.write('Zoë,Smith\r\n')
+        text_file.flush()
+
+        expected = 'first,last\r\nZoë,Smith\r\n'.encode('utf-8')
+        assert target.getvalue() == expected
+        assert hashing_file.size == len(expected)
+        assert hashing_file.hexdigest() == \
+            hashlib.sha256(expected).hexdigest()
+
+    def test_no_hash(self):
+        target = io.BytesIO()
+        hashing_file = HashingWriter(target, None)
+        hashing_file.write(b'abc')
+
+        assert hashing_file.size == 3
+        assert hashing_file.hexdigest() is None
+
+    def test_compress(self):
+        targets = []
+        for _ in range(2):
+            target = io.BytesIO()
+            target.close = lambda: None
+            hashing_file = HashingWriter(target, 'md5', compresslevel=6)
+            hashing_file.write(b'first,last\r\n' * 100)
+            hashing_file.close()
+            targets.append(target.getvalue())
+
+        # the same content always compresses to the same bytes
+        assert targets[0] == targets[1]
+        assert gzip.decompress(targets[0]) == b'first,last\r\n' * 100
+        assert hashing_file.size == len(targets[0])
+        assert hashing_file.hexdigest() == hashlib.md5(targets[0]).hexdigest()
+
+    def test_close_closes_stream(self):
+        target = io.BytesIO()
+        hashing_file = HashingWriter(target)
+        hashing_file.close()
+
+        assert target.closed
+
+
+class TestMultipartEncoder(unittest.TestCase):
+
+    def test_body_matches_requests(self):
+        fields = {'package_id': 'a', 'size': 3, 'tags': ['x', 'y'],
+                  'empty': None}
+        encoder = MultipartEncoder(
+            fields, {'upload': ('file.csv', io.BytesIO(b'a,b\r\n'))})
+
+        prepared = requests.PreparedRequest()
+        prepared.prepare_headers({})
+        prepared.prepare_body(
+            fields, {'upload': ('file.csv', io.BytesIO(b'a,b\r\n'))})
+        boundary = prepared.headers['Content-Type'].split('boundary=')[1]
+        expected = prepared.body.replace(boundary.encode('ascii'),
+                                         encoder.boundary.encode('ascii'))
+
+        body = encoder.read()
+        assert body == expected
+        assert len(encoder) == len(body)
+
+    def test_read_in_chunks(self):
+        progress = []
+        upload = io.BytesIO(b'x' * 1000)
+        encoder = MultipartEncoder({'name': 'a'},
+                                   {'upload': ('a.csv', upload)},
+                                   callback=progress.append)
+
+        chunks = list(iter(lambda: encoder.read(64), b''))
+
+        assert all(len(chunk) <= 64 for chunk in chunks)
+        assert sum(progress) == len(encoder)
+        encoder.seek(0)
+        assert b''.join(chunks) == encoder.read()
+        encoder.seek(100)
+        assert encoder.read(10) == b''.join(chunks)[100:110]
@@ -0,0 +1,165 @@
+import io
+import threading
+import unittest
+
+import mock
+import requests
+import requests_mock
+
+from datapackage_pipelines_ckan.utils import (
+    make_ckan_request, configure_ckan_sessions, get_ckan_session,
+    is_idempotent, get_retry_delay, AdaptiveLimiter
+)
+
+
+class TestCkanSessions(unittest.TestCase):
+
+    def tearDown(self):
+        configure_ckan_sessions()
+
+    def test_session_is_reused_per_host(self):
+        session = get_ckan_session('https://demo.ckan.org/api/3/action/a')
+        assert get_ckan_session('https://demo.ckan.org/other') is session
+        assert get_ckan_session('https://other.ckan.org/') is not session
+        assert get_ckan_session('http://demo.ckan.org/') is not session
+
+    def test_configure_replaces_sessions(self):
+        session = get_ckan_session('https://demo.ckan.org/')
+        configure_ckan_sessions(pool_size=2, keep_alive=False)
+        new_session = get_ckan_session('https://demo.ckan.org/')
+        assert new_session is not session
+        assert new_session.headers['Connection'] == 'close'
+        adapter = new_session.get_adapter('https://demo.ckan.org/')
+        assert adapter._pool_maxsize == 2
+
+    @requests_mock.mock()
+    def test_make_ckan_request_timeout(self, mock_request):
+        mock_request.get('https://demo.ckan.org/api/3/action/site_read',
+                         json={'success': True, 'result': True})
+        configure_ckan_sessions(connect_timeout=5, read_timeout=30)
+
+        make_ckan_request('https://demo.ckan.org/api/3/action/site_read')
+
+        assert mock_request.request_history[0].timeout == (5, 30)
+
+
+@mock.patch('datapackage_pipelines_ckan.utils.time.sleep')
+class TestCkanRetries(unittest.TestCase):
+
+    base_url = 'https://demo.ckan.org/api/3/action/'
+
+    def tearDown(self):
+        configure_ckan_sessions()
+
+    @requests_mock.mock()
+    def test_retry_idempotent_request(self, mock_sleep, mock_request):
+        mock_request.get(self.base_url + 'package_show', [
+            {'status_code': 502},
+            {'exc': requests.exceptions.ConnectTimeout},
+            {'json': {'success': True, 'result': {'id': 'a'}}}
+        ])
+
+        response = make_ckan_request(self.base_url + 'package_show')
+
+        assert response['result'] == {'id': 'a'}
+        assert mock_request.call_count == 3
+        assert mock_sleep.call_count == 2
+
+    @requests_mock.mock()
+    def test_no_retry_non_idempotent_request(self, mock_sleep, mock_request):
+        mock_request.post(self.base_url + 'package_create', [
+            {'status_code': 502, 'text': 'Bad Gateway'},
+            {'json': {'success': True, 'result': {'id': 'a'}}}
+        ])
+
+        with self.assertRaises(ValueError):
+            make_ckan_request(self.base_url + 'package_create',
+                              method='POST', json={'name': 'a'})
+        assert mock_request.call_count == 1
+
+    @requests_mock.mock()
+    def test_retry_throttled_upload(self, mock_sleep, mock_request):
+        uploaded = []
+
+        def record_upload(request, context):
+            uploaded.append(request.body.read())
+            if len(uploaded) == 1:
+                context.status_code = 429
+                context.headers['Retry-After'] = '7'
+                return ''
+            return '{"success": true, "result": {"id": "r"}}'
+
+        mock_request.post(self.base_url + 'resource_create',
+                          text=record_upload)
+
+        make_ckan_request(self.base_url + 'resource_create', method='POST',
+                          data={'package_id': 'a'},
+                          files={'upload': ('a.csv', io.BytesIO(b'a,b'))})
+
+        # the body is rewound and sent again in full
+        assert len(uploaded) == 2
+        assert uploaded[0] == uploaded[1]
+        assert b'\r\n\r\na,b\r\n' in uploaded[1]
+        mock_sleep.assert_called_once_with(7.0)
+
+    @requests_mock.mock()
+    def test_give_up_after_max_retries(self, mock_sleep, mock_request):
+        mock_request.get(self.base_url + 'package_show', status_code=503,
+                         json={'success': False, 'error': {}})
+        configure_ckan_sessions(max_retries=2, backoff_factor=1)
+
+        make_ckan_request(self.base_url + 'package_show')
+
+        assert mock_request.call_count == 3
+        assert all(0 <= call[0][0] <= 2 ** i
+                   for i, call in enumerate(mock_sleep.call_args_list))
+
+    def test_is_idempotent(self, mock_sleep):
+        assert is_idempotent(self.base_url + 'package_create', 'GET')
+        assert is_idempotent(self.base_url + 'package_show', 'POST')
+        assert is_idempotent(self.base_url + 'resource_patch', 'POST')
+        assert is_idempotent(self.base_url + 'datastore_delete', 'POST')
+        assert not is_idempotent(self.base_url + 'resource_create', 'POST')
+        assert not is_idempotent(self.base_url + 'datastore_upsert', 'POST')
+
+    def test_retry_delay(self, mock_sleep):
+        response = requests.Response()
+        response.headers['Retry-After'] = '3'
+        assert get_retry_delay(response, 0) == 3
+        response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        assert get_retry_delay(response, 0) == 0
+        assert 0 <= get_retry_delay(None, 2) <= 2
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_limit_adapts(self):
+        limiter = AdaptiveLimiter(4)
+        limiter.acquire()
+        limiter.release('package_show', 0.1, False)
+        assert limiter.limit == 2
+        limiter.acquire()
+        limiter.release('package_show', 0.1, True)
+        assert limiter.limit == 2.5
+        # much slower than usual for the action
+        limiter.acquire()
+        limiter.release('package_show', 1, True)
+        assert limiter.limit == 1.25
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release('package_show', 0.1, True)
+        assert limiter.limit == 4
+
+    def test_acquire_waits_for_a_slot(self):
+        limiter = AdaptiveLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        assert not acquired.wait(0.05)
+        limiter.release('package_show', 0.1, True)
+        assert acquired.wait(1)